@@ -0,0 +1,2 @@
+from benchmarks.run import main
+main()
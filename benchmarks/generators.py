@@ -0,0 +1,179 @@
+# Python G-Code simulator
+#
+# Copyright (C) 2011 Peter Rogers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+# Generators for synthetic G-code programs. Each generator writes (about) the
+# requested number of lines, and the output only depends on the line count and
+# the seed so the same program can be generated again on another machine.
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import math
+import random
+
+###########
+# Globals #
+###########
+
+# The header written at the start of every program (like the Inkscape output)
+HEADER = """%
+(Synthetic benchmark program)
+G96 S90
+G21
+G90
+F600
+"""
+
+#############
+# Functions #
+#############
+
+# Back and forth raster fill of a rectangle, with the laser turned off between rows
+def generate_raster(fd, lines, rand):
+    count = 0
+    width = 200.0
+    step = 0.1
+    row = 0
+    while count < lines:
+        y = row*step
+        (x1, x2) = (0.0, width) if row % 2 == 0 else (width, 0.0)
+        fd.write("G00 X%.3f Y%.3f\nM3\nG01 X%.3f Y%.3f\nM5\n" % (x1, y, x2, y))
+        count += 4
+        row += 1
+
+# Dense polylines made of very short G01 segments (like curves flattened by a CAM
+# program)
+def generate_polyline(fd, lines, rand):
+    count = 0
+    while count < lines:
+        (cx, cy) = (rand.uniform(0, 300), rand.uniform(0, 300))
+        radius = rand.uniform(5, 50)
+        segments = rand.randint(100, 1000)
+        wobble = rand.uniform(0, 0.2)
+        fd.write("M5\nG00 X%.4f Y%.4f\nM3\n" % (cx+radius, cy))
+        for n in range(1, segments+1):
+            angle = 2*math.pi*n/segments
+            r = radius*(1 + wobble*math.sin(7*angle))
+            fd.write("G01 X%.4f Y%.4f\n" % (cx+r*math.cos(angle), cy+r*math.sin(angle)))
+        count += segments+3
+
+# Contours made of G02/G03 arcs
+def generate_arcs(fd, lines, rand):
+    count = 0
+    while count < lines:
+        (x, y) = (rand.uniform(0, 300), rand.uniform(0, 300))
+        fd.write("M5\nG00 X%.4f Y%.4f\nM3\n" % (x, y))
+        count += 3
+        for n in range(rand.randint(10, 200)):
+            # Swing around a center point a random distance away
+            radius = rand.uniform(0.5, 20)
+            angle = rand.uniform(0, 2*math.pi)
+            (cx, cy) = (x+radius*math.cos(angle), y+radius*math.sin(angle))
+            sweep = rand.uniform(0.1, 3)
+            angle2 = angle + math.pi + sweep
+            (x2, y2) = (cx+radius*math.cos(angle2), cy+radius*math.sin(angle2))
+            code = rand.choice(("G02", "G03"))
+            fd.write("%s X%.4f Y%.4f I%.4f J%.4f\n" % (code, x2, y2, cx-x, cy-y))
+            (x, y) = (x2, y2)
+            count += 1
+
+# Moves whose coordinates are expressions over variables, which are reassigned as
+# the program goes (like the Inkscape gcode_tools output)
+def generate_variables(fd, lines, rand):
+    fd.write("#1 = 1.000000\n#2 = 1.000000\n#3 = 0.282222\n#4 = 300.0\n"
+             "#5 = [#1*#3]\n#6 = [#2*#3]\n#8 = 0.0\n#9 = 0.0\n"
+             "#<scale> = 1.5\n")
+    count = 9
+    while count < lines:
+        fd.write("#8 = %.3f\n#9 = [%.3f*#<scale>]\n" % (rand.uniform(0, 50), rand.uniform(0, 50)))
+        fd.write("G00 X[%.4f*#5+#8] Y[%.4f*#6+#9]\nM3\n" % (rand.uniform(0, 500), rand.uniform(0, 500)))
+        count += 4
+        for n in range(rand.randint(5, 50)):
+            fd.write("G01 X[%.4f*#5+#8] Y[[%.4f+SIN[%d]]*#6+#9] F#4\n" % (
+                rand.uniform(0, 500), rand.uniform(0, 500), rand.randint(0, 360)))
+            count += 1
+        fd.write("M5\n")
+        count += 1
+
+# Like the Inkscape gcode_tools output: every move scales and offsets its own
+# coordinates through variables, so almost no two expressions have the same text
+def generate_constants(fd, lines, rand):
+    fd.write("#1 = 0.282222\n#2 = 0.282222\n#3 = 1.000000\n"
+             "#8 = 0.0\n#9 = 0.0\n#10 = 0.0\n")
+    count = 6
+    while count < lines:
+        fd.write("G00 X[%.6f*#1+#8] Y[%.6f*#2+#9]\nM3\n" % (rand.uniform(0, 500), rand.uniform(0, 500)))
+        count += 2
+        for n in range(rand.randint(5, 50)):
+            fd.write("G01 X[%.6f*#1+#8] Y[%.6f*#2+#9] Z[%.6f*#3+#10] F%.6f\n" % (
+                rand.uniform(0, 500), rand.uniform(0, 500), rand.uniform(-1, 0), rand.uniform(100, 1000)))
+            count += 1
+        fd.write("M5\n")
+        count += 1
+
+# A mix of short moves, dwells and tool changes
+def generate_dwell(fd, lines, rand):
+    count = 0
+    tool = 1
+    while count < lines:
+        kind = rand.random()
+        if (kind < 0.05):
+            tool = tool % 8 + 1
+            fd.write("M5\nT%d\nM06\n" % tool)
+            count += 3
+        elif (kind < 0.3):
+            fd.write("G04 P%.2f\n" % rand.uniform(0.01, 2))
+            count += 1
+        else:
+            fd.write("G00 X%.3f Y%.3f\nM3\nG01 X%.3f Y%.3f\nM5\n" % (
+                rand.uniform(0, 300), rand.uniform(0, 300),
+                rand.uniform(0, 300), rand.uniform(0, 300)))
+            count += 4
+
+GENERATORS = {
+    "raster" : generate_raster,
+    "polyline" : generate_polyline,
+    "arcs" : generate_arcs,
+    "variables" : generate_variables,
+    "constants" : generate_constants,
+    "dwell" : generate_dwell,
+}
+
+# Writes a program of the given kind and (approximate) number of lines to the path
+def generate(kind, lines, path, seed=0):
+    rand = random.Random("%s-%d-%d" % (kind, lines, seed))
+    fd = open(path, "w")
+    try:
+        fd.write(HEADER)
+        GENERATORS[kind](fd, lines, rand)
+        fd.write("M5\nM02\n")
+    finally:
+        fd.close()
+
+# Returns the path of the given program in the directory, generating it first if
+# it doesn't already exist
+def get_program(kind, lines, directory, seed=0):
+    path = os.path.join(directory, "%s-%d-%d.ngc" % (kind, lines, seed))
+    if (not os.path.exists(path)):
+        if (not os.path.isdir(directory)):
+            os.makedirs(directory)
+        tmp = path + ".tmp"
+        generate(kind, lines, tmp, seed)
+        os.rename(tmp, path)
+    return path
@@ -0,0 +1,248 @@
+# Python G-Code simulator
+#
+# Copyright (C) 2011 Peter Rogers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+# Runs the benchmarks. Each (generator, size) case runs in a fresh worker process
+# so its peak memory use can be measured on its own. For each case the following
+# are timed:
+#
+#   parse         gcode.parse_program (without the cache)
+#   run           State.run over the whole program
+#   step          State.step, over at most STEP_LIMIT statements
+#   reduce_paths  gcode.reduce_paths, over at most REDUCE_LIMIT paths
+#   current_path  looking up the path at LOOKUPS random times (as done by
+#                 GCodeRenderWidget.get_current_path)
+#   render        drawing the whole job onto an offscreen cairo surface with
+#                 draw.JobRenderer (skipped if pycairo isn't installed)
+#
+# The results are written as JSON. Passing an earlier results file with
+# --compare prints how each timing has changed.
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import json
+import time
+import random
+import platform
+import tempfile
+import numpy
+
+import gsim
+from gsim import gcode
+from gsim.profiler import get_peak_rss
+from benchmarks import generators
+
+###########
+# Globals #
+###########
+
+DEFAULT_SIZES = (10000, 100000, 1000000)
+
+# Limits on the slower benchmarks, so they finish in a reasonable time on the
+# big programs. The throughput is still comparable between sizes.
+STEP_LIMIT = 100000
+REDUCE_LIMIT = 20000
+LOOKUPS = 10000
+
+# The size of the surface used by the render benchmark
+RENDER_SIZE = 1000
+
+#############
+# Functions #
+#############
+
+# Times the given function, returning (seconds, result)
+def _time(func, *args):
+    start = time.time()
+    result = func(*args)
+    return (time.time()-start, result)
+
+def _record(seconds, items):
+    record = {"seconds" : seconds, "items" : items}
+    if (seconds > 0):
+        record["perSecond"] = items/seconds
+    return record
+
+def _step(prog, limit):
+    state = gcode.State(prog)
+    count = 0
+    while (count < limit and not state.finished):
+        state.step()
+        count += 1
+    return count
+
+def _lookups(paths, times):
+    for tm in times:
+        paths[paths.find_time(tm)]
+
+def _render(state):
+    try:
+        from gsim import draw
+    except ImportError:
+        return None
+    import cairo
+    surface = cairo.ImageSurface(cairo.FORMAT_RGB24, RENDER_SIZE, RENDER_SIZE)
+    (minPos, maxPos) = state.bounds
+    resolution = RENDER_SIZE/max(maxPos[0]-minPos[0], maxPos[1]-minPos[1], 1e-9)
+    renderer = draw.JobRenderer(state.paths, minPos, state.units, RENDER_SIZE, RENDER_SIZE, resolution)
+    renderer.border = 0
+    renderer.render(cairo.Context(surface))
+    surface.flush()
+    return len(state.paths)
+
+# Runs the benchmarks for a single program (in a worker process)
+def run_case(kind, lines, directory, seed=0):
+    path = generators.get_program(kind, lines, directory, seed)
+    result = {
+        "generator" : kind,
+        "lines" : lines,
+        "bytes" : os.path.getsize(path),
+        "timings" : {},
+    }
+    timings = result["timings"]
+
+    (seconds, prog) = _time(gcode.parse_program, path)
+    statements = len(prog.statements)
+    result["statements"] = statements
+    timings["parse"] = _record(seconds, statements)
+
+    state = gcode.State(prog)
+    (seconds, _) = _time(state.run)
+    timings["run"] = _record(seconds, statements)
+    paths = state.paths
+    result["paths"] = len(paths)
+    result["runLength"] = state.get_run_length()
+
+    (seconds, count) = _time(_step, prog, STEP_LIMIT)
+    timings["step"] = _record(seconds, count)
+
+    lst = list(paths.iter_paths(0, min(len(paths), REDUCE_LIMIT)))
+    (seconds, _) = _time(gcode.reduce_paths, lst, 0.01)
+    timings["reduce_paths"] = _record(seconds, len(lst))
+
+    if (len(paths)):
+        rand = random.Random(seed)
+        times = [rand.uniform(0, state.get_run_length()) for n in range(LOOKUPS)]
+        (seconds, _) = _time(_lookups, paths, times)
+        timings["current_path"] = _record(seconds, LOOKUPS)
+
+    if (state.bounds is not None):
+        (seconds, count) = _time(_render, state)
+        if (count is not None):
+            timings["render"] = _record(seconds, count)
+
+    result["peakRSS"] = get_peak_rss()
+    return result
+
+def _run_case_worker(*args):
+    # Keep the simulator's warnings out of the way
+    sys.stdout = open(os.devnull, "w")
+    return run_case(*args)
+
+# Runs each case in a new worker process, yielding the results
+def run_all(kinds, sizes, directory, seed=0):
+    from concurrent.futures import ProcessPoolExecutor
+
+    for lines in sizes:
+        for kind in kinds:
+            pool = ProcessPoolExecutor(1)
+            try:
+                yield pool.submit(_run_case_worker, kind, lines, directory, seed).result()
+            finally:
+                pool.shutdown()
+
+# Returns information about the machine and the version being benchmarked
+def get_environment():
+    info = {
+        "gsim" : gsim.__version__,
+        "python" : platform.python_version(),
+        "numpy" : numpy.__version__,
+        "platform" : platform.platform(),
+        "processor" : platform.processor(),
+        "date" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    import subprocess
+    try:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=root,
+                                         stderr=open(os.devnull, "w"))
+        info["commit"] = commit.decode("ascii").strip()
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        pass
+    return info
+
+# Prints the change in each timing from the baseline results to the new ones
+def compare(baseline, results):
+    old = dict(((r["generator"], r["lines"]), r) for r in baseline["results"])
+    print("%-10s %10s %-14s %10s %10s %8s" % ("generator", "lines", "benchmark", "old (s)", "new (s)", "change"))
+    for result in results["results"]:
+        key = (result["generator"], result["lines"])
+        if (key not in old):
+            continue
+        for (name, timing) in sorted(result["timings"].items()):
+            before = old[key]["timings"].get(name)
+            if (not before or not before["seconds"]):
+                continue
+            change = timing["seconds"]/before["seconds"] - 1
+            print("%-10s %10d %-14s %10.3f %10.3f %+7.1f%%" % (
+                key[0], key[1], name, before["seconds"], timing["seconds"], 100*change))
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run the gsim benchmarks.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, metavar="LINES",
+                        help="program sizes to test (default: %s)" % " ".join(map(str, DEFAULT_SIZES)))
+    parser.add_argument("--generators", nargs="+", choices=sorted(generators.GENERATORS),
+                        default=sorted(generators.GENERATORS), metavar="NAME",
+                        help="the kinds of program to test (default: all of them)")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the generated programs")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "gsim-benchmarks"),
+                        help="where the generated programs are kept between runs")
+    parser.add_argument("-o", "--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", metavar="BASELINE", help="compare against earlier results")
+    args = parser.parse_args()
+
+    results = {"environment" : get_environment(), "results" : []}
+    for result in run_all(args.generators, args.sizes, args.data_dir, args.seed):
+        results["results"].append(result)
+        timings = " ".join("%s=%.3fs" % (name, timing["seconds"])
+                           for (name, timing) in sorted(result["timings"].items()))
+        print("%-10s %10d  %s  peak=%.0fMB" % (result["generator"], result["lines"], timings,
+                                               (result["peakRSS"] or 0)/(1024.0*1024)))
+        sys.stdout.flush()
+
+    if (args.output):
+        fd = open(args.output, "w")
+        try:
+            json.dump(results, fd, indent=2, sort_keys=True)
+        finally:
+            fd.close()
+
+    if (args.compare):
+        fd = open(args.compare, "r")
+        try:
+            baseline = json.load(fd)
+        finally:
+            fd.close()
+        compare(baseline, results)
+
+if (__name__ == "__main__"):
+    main()
@@ -0,0 +1,256 @@
+# Python G-Code simulator
+#
+# Copyright (C) 2011 Peter Rogers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+# Estimates the run length (and other statistics) of many G-code files at once,
+# spreading the files over a pool of worker processes. Installed as 'gsim-batch':
+#
+#   gsim-batch --format csv -o jobs.csv 'jobs/*.ngc' more-jobs/
+#
+# One record is written for each file as soon as it's done. A file which takes
+# longer than --timeout seconds or more than --memory MB to process is given up
+# on, and its record has the reason in the 'error' field.
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import csv
+import glob
+import json
+import signal
+
+from gsim import gcode
+from gsim import motion
+
+###########
+# Globals #
+###########
+
+# The file extensions picked up when searching a directory
+EXTENSIONS = (".ngc", ".nc", ".gcode", ".tap")
+
+# The fields of each record, in the order they're written out
+FIELDS = ("path", "statements", "units", "runLength", "cutLength", "rapidLength",
+          "xmin", "ymin", "xmax", "ymax", "unknownCodes", "invalidLines", "error")
+
+# The worker settings (see _init_worker)
+_timeout = None
+_profile = None
+
+#############
+# Functions #
+#############
+
+# Returns the G-code files named by the given list of paths, glob patterns and
+# directories (which are searched recursively), without duplicates
+def find_files(patterns):
+    files = []
+    seen = set()
+    def add(path):
+        if (path not in seen):
+            seen.add(path)
+            files.append(path)
+
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            if (os.path.isdir(path)):
+                for (dirpath, dirnames, filenames) in os.walk(path):
+                    dirnames.sort()
+                    for name in sorted(filenames):
+                        if (os.path.splitext(name)[1].lower() in EXTENSIONS):
+                            add(os.path.join(dirpath, name))
+            else:
+                add(path)
+    return files
+
+# Parses and simulates a single file, returning its record. The file is processed
+# in a single streaming pass, so memory use doesn't depend on its size.
+def estimate_file(path, profile=None):
+    record = dict((field, None) for field in FIELDS)
+    record["path"] = path
+    invalidLines = []
+    state = gcode.State(profile=profile)
+    state.run_stream(path, keepPaths=False, invalidLines=invalidLines)
+
+    record["statements"] = state.lineno
+    record["units"] = state.units
+    record["runLength"] = state.get_run_length()
+    record["cutLength"] = state.cutLength
+    record["rapidLength"] = state.rapidLength
+    if (state.bounds is not None):
+        (minPos, maxPos) = state.bounds
+        record["xmin"] = float(minPos[0])
+        record["ymin"] = float(minPos[1])
+        record["xmax"] = float(maxPos[0])
+        record["ymax"] = float(maxPos[1])
+    record["unknownCodes"] = list(state.unknownCodes)
+    record["invalidLines"] = len(invalidLines)
+    return record
+
+# Sets up a worker process
+def _init_worker(timeout, memory, profile):
+    global _timeout, _profile
+    _timeout = timeout
+    _profile = profile
+    # The simulator prints warnings (eg about unknown codes) which would get mixed
+    # up with the records, and they end up in the records anyway
+    sys.stdout = open(os.devnull, "w")
+    if (memory):
+        try:
+            import resource
+        except ImportError:
+            # Not available on Windows
+            return
+        limit = int(memory*1024*1024)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+class _Timeout(Exception):
+    pass
+
+def _alarm(signum, frame):
+    raise _Timeout()
+
+# Processes a file in a worker process. Errors are returned in the record rather
+# than raised, so one bad file doesn't spoil the batch.
+def _estimate_worker(path):
+    timer = (_timeout and hasattr(signal, "setitimer"))
+    if (timer):
+        signal.signal(signal.SIGALRM, _alarm)
+        signal.setitimer(signal.ITIMER_REAL, _timeout)
+    try:
+        return estimate_file(path, _profile)
+    except _Timeout:
+        error = "timed out after %g s" % _timeout
+    except MemoryError:
+        error = "out of memory"
+    except (IOError, OSError) as e:
+        error = str(e)
+    except Exception as e:
+        error = "%s: %s" % (e.__class__.__name__, e)
+    finally:
+        if (timer):
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    record = dict((field, None) for field in FIELDS)
+    record["path"] = path
+    record["error"] = error
+    return record
+
+# Processes the given files using a pool of worker processes, yielding the records
+# as they're finished (so not necessarily in order)
+def iter_estimates(files, workers=None, timeout=None, memory=None, profile=None):
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    pool = ProcessPoolExecutor(workers, initializer=_init_worker,
+                               initargs=(timeout, memory, profile))
+    futures = []
+    try:
+        futures = [pool.submit(_estimate_worker, path) for path in files]
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        # Don't start on the remaining files if we're stopped early
+        for future in futures:
+            future.cancel()
+        pool.shutdown()
+
+# Writes records out one per line as JSON
+class JSONWriter(object):
+    def __init__(this, fd):
+        this.fd = fd
+
+    def write(this, record):
+        this.fd.write(json.dumps(dict((field, record[field]) for field in FIELDS)) + "\n")
+        this.fd.flush()
+
+# Writes records out as CSV, with a header row
+class CSVWriter(object):
+    def __init__(this, fd):
+        this.fd = fd
+        this.writer = csv.writer(fd)
+        this.writer.writerow(FIELDS)
+
+    def write(this, record):
+        row = []
+        for field in FIELDS:
+            value = record[field]
+            if (value is None):
+                value = ""
+            elif (isinstance(value, list)):
+                value = " ".join(value)
+            row.append(value)
+        this.writer.writerow(row)
+        this.fd.flush()
+
+WRITERS = {
+    "json" : JSONWriter,
+    "csv" : CSVWriter,
+}
+
+def main():
+    """Command line function to estimate the run length of many G-code files."""
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Estimate the run length, cut length, etc of many G-code files.")
+    parser.add_argument("paths", nargs="+", metavar="PATH",
+                        help="G-code files, glob patterns or directories")
+    parser.add_argument("-f", "--format", choices=sorted(WRITERS), default="json",
+                        help="output format (default: one JSON record per line)")
+    parser.add_argument("-o", "--output", help="write the records to this file")
+    parser.add_argument("-j", "--workers", type=int,
+                        help="number of worker processes (default: one per CPU)")
+    parser.add_argument("--timeout", type=float,
+                        help="give up on a file after this many seconds")
+    parser.add_argument("--memory", type=float, metavar="MB",
+                        help="give up on a file if it needs more than this much memory")
+    parser.add_argument("--machine", metavar="PROFILE",
+                        help="estimate run lengths using the machine limits in the "
+                        "given JSON file (see gsim.motion.MachineProfile)")
+    args = parser.parse_args()
+
+    files = find_files(args.paths)
+    if (not files):
+        print("No G-code files found.", file=sys.stderr)
+        sys.exit(1)
+
+    profile = None
+    if (args.machine):
+        profile = motion.MachineProfile.load(args.machine)
+
+    if (args.output):
+        fd = open(args.output, "w")
+    else:
+        fd = sys.stdout
+    failed = 0
+    try:
+        writer = WRITERS[args.format](fd)
+        for record in iter_estimates(files, args.workers, args.timeout, args.memory, profile):
+            writer.write(record)
+            if (record["error"]):
+                failed += 1
+    finally:
+        if (fd is not sys.stdout):
+            fd.close()
+
+    if (failed):
+        print("%d of %d files failed" % (failed, len(files)), file=sys.stderr)
+        sys.exit(2)
+
+if (__name__ == "__main__"):
+    main()
@@ -0,0 +1,336 @@
+# Python G-Code simulator
+#
+# Copyright (C) 2011 Peter Rogers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+# An on-disk cache of parsed and simulated programs. Each entry is a directory
+# named after a hash of the G-code file contents (and the gsim version), holding
+# the program's statement table and, once the program has been simulated, its
+# path table as plain .npy files. These are loaded with numpy.load(mmap_mode='r')
+# so opening a cached program doesn't need to read the whole thing in.
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy
+
+import gsim
+from gsim import gcode
+from gsim import expression
+
+###########
+# Globals #
+###########
+
+# Changed whenever the layout (or meaning) of the cache entries changes
+CACHE_FORMAT = 3
+
+# The default limit on the total size of the cache, in bytes
+DEFAULT_MAX_SIZE = 1 << 30
+
+# The statement columns stored in each entry (see gcode._StatementColumns)
+STATEMENT_COLUMNS = ("codes", "codeIds", "offsets", "paramCounts", "paramKeys",
+                     "paramValues", "exprIndex", "exprText", "names")
+
+_defaultCache = None
+
+#############
+# Functions #
+#############
+
+# Returns the cache directory to use when none is given. This can be set with the
+# GSIM_CACHE_DIR environment variable.
+def get_default_directory():
+    path = os.environ.get("GSIM_CACHE_DIR")
+    if (path):
+        return path
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "gsim")
+
+# Returns the shared cache in the default directory
+def get_default_cache():
+    global _defaultCache
+    if (_defaultCache is None):
+        _defaultCache = ProgramCache()
+    return _defaultCache
+
+# Returns the text used to store a variable key (eg 5 -> "#5")
+def _variable_text(key):
+    if (isinstance(key, int)):
+        return "#%d" % key
+    return "#<%s>" % key
+
+# Returns the machine profile as stored in the cache
+def _profile_dict(profile):
+    if (profile is None):
+        return None
+    return profile.to_dict()
+
+# Renames a file, replacing the destination if it exists
+def _replace(src, dest):
+    try:
+        os.replace(src, dest)
+    except AttributeError:
+        # Python 2 (rename replaces the destination on POSIX systems)
+        os.rename(src, dest)
+
+###########
+# Classes #
+###########
+
+class ProgramCache(object):
+    # Where the cache entries are stored
+    directory = None
+    # The total size of the entries is kept below this many bytes
+    maxSize = DEFAULT_MAX_SIZE
+
+    def __init__(this, directory=None, maxSize=None):
+        if (directory is None):
+            directory = get_default_directory()
+        this.directory = directory
+        if (maxSize is not None):
+            this.maxSize = maxSize
+
+    # Returns the cache key for the G-code file at the given path
+    def get_key(this, path):
+        digest = hashlib.sha1()
+        digest.update(("gsim-%s-%d\n" % (gsim.__version__, CACHE_FORMAT)).encode("ascii"))
+        fd = open(path, "rb")
+        try:
+            while 1:
+                data = fd.read(1 << 20)
+                if (not data):
+                    break
+                digest.update(data)
+        finally:
+            fd.close()
+        return digest.hexdigest()
+
+    # Returns the cached program for the given key, or None if there isn't one
+    def load_program(this, key, path):
+        entry = os.path.join(this.directory, key)
+        try:
+            meta = this._read_json(entry, "program.json")
+            if (meta is None):
+                return None
+            columns = [this._read_array(entry, name) for name in STATEMENT_COLUMNS]
+        except (IOError, OSError, ValueError, KeyError):
+            # A damaged entry, get rid of it
+            this._remove(entry)
+            return None
+
+        # The small columns are converted back into lists
+        columns[0] = columns[0].tolist()
+        columns[-1] = [expression.variable_key(text) for text in columns[-1].tolist()]
+
+        prog = gcode.Program()
+        prog.statements = gcode.StatementTable(gcode.SourceFile(path), columns)
+        prog.invalidLines = meta["invalidLines"]
+        prog.cache = this
+        prog.cacheKey = key
+        this._touch(entry)
+        return prog
+
+    # Adds a freshly parsed program to the cache
+    def store_program(this, key, prog):
+        prog.cache = this
+        prog.cacheKey = key
+
+        columns = gcode._StatementColumns()
+        for statement in prog.statements:
+            columns.add(statement, statement.offset)
+        (codes, codeIds, offsets, paramCounts, paramKeys, paramValues,
+         exprIndex, exprText, names) = columns.get_columns()
+
+        arrays = {
+            "codes" : numpy.array(codes, dtype=str),
+            "codeIds" : codeIds,
+            "offsets" : offsets,
+            "paramCounts" : paramCounts,
+            # Stored as an array of single characters
+            "paramKeys" : numpy.frombuffer(paramKeys.encode("utf-32-le"), dtype="<U1"),
+            "paramValues" : paramValues,
+            "exprIndex" : exprIndex,
+            "exprText" : numpy.array(exprText, dtype=str),
+            "names" : numpy.array([_variable_text(name) for name in names], dtype=str),
+        }
+        meta = {
+            "version" : gsim.__version__,
+            "statementCount" : len(prog.statements),
+            "invalidLines" : prog.invalidLines,
+        }
+
+        try:
+            if (not os.path.isdir(this.directory)):
+                os.makedirs(this.directory)
+            # Build the entry under a temporary name, then move it into place
+            tmp = tempfile.mkdtemp(prefix="tmp-", dir=this.directory)
+            try:
+                for (name, array) in arrays.items():
+                    numpy.save(os.path.join(tmp, name + ".npy"), array)
+                this._write_json(tmp, "program.json", meta)
+                entry = os.path.join(this.directory, key)
+                if (os.path.isdir(entry)):
+                    # Somebody else got there first
+                    shutil.rmtree(tmp)
+                else:
+                    os.rename(tmp, entry)
+            except:
+                this._remove(tmp)
+                raise
+            this.evict()
+        except (IOError, OSError) as e:
+            print("WARNING - Cannot write to the program cache: %s" % e)
+
+    # Returns a finished State for the given (cached) program, or None if the
+    # program hasn't been simulated yet. If it was simulated with a different
+    # machine profile, the paths are planned again with the program's profile.
+    def load_state(this, prog):
+        entry = os.path.join(this.directory, prog.cacheKey)
+        try:
+            meta = this._read_json(entry, "state.json")
+            if (meta is None):
+                return None
+            paths = this._read_array(entry, "paths")
+        except (IOError, OSError, ValueError):
+            return None
+
+        state = gcode.State(prog)
+        replan = (meta.get("profile") != _profile_dict(prog.profile))
+        if (replan):
+            # The stored array is read only
+            paths = numpy.array(paths)
+        state.paths.set_array(paths)
+        state.paths.cutLength = meta["cutLength"]
+        state.paths.rapidLength = meta["rapidLength"]
+        state.units = meta["units"]
+        state.paths.unitScale = gcode.UNIT_SCALE[state.units]
+        if (replan):
+            state.paths.replan()
+        state.rapidSpeed = meta["rapidSpeed"]
+        state.feedRate = meta["feedRate"]
+        state.spindleOn = meta["spindleOn"]
+        state.unknownCodes = meta["unknownCodes"]
+        state.variables = dict((key, value) for (key, value) in meta["variables"])
+        state.pos = numpy.array(meta["pos"], dtype=float)
+        state.tool = meta["tool"]
+        state.nextTool = meta["nextTool"]
+        state.lineno = meta["lineno"]
+        state.finished = True
+        # So it isn't stored again
+        state.resumed = True
+        this._touch(entry)
+        return state
+
+    # Stores the result of simulating a cached program
+    def store_state(this, state):
+        entry = os.path.join(this.directory, state.program.cacheKey)
+        if (not os.path.isdir(entry)):
+            return
+
+        def as_list(pos):
+            if (pos is None):
+                return None
+            return [float(pos[0]), float(pos[1])]
+
+        meta = {
+            "runLength" : state.get_run_length(),
+            "cutLength" : state.cutLength,
+            "rapidLength" : state.rapidLength,
+            "units" : state.units,
+            "rapidSpeed" : state.rapidSpeed,
+            "feedRate" : state.feedRate,
+            "spindleOn" : state.spindleOn,
+            "unknownCodes" : state.unknownCodes,
+            "variables" : list(state.variables.items()),
+            "pos" : as_list(state.pos),
+            "tool" : state.tool,
+            "nextTool" : state.nextTool,
+            "lineno" : state.lineno,
+            "profile" : _profile_dict(state.paths.profile),
+        }
+        try:
+            # Write the path table first, since state.json marks the entry complete
+            tmp = os.path.join(entry, "paths.tmp.npy")
+            numpy.save(tmp, state.paths.array)
+            _replace(tmp, os.path.join(entry, "paths.npy"))
+            this._write_json(entry, "state.json.tmp", meta)
+            _replace(os.path.join(entry, "state.json.tmp"), os.path.join(entry, "state.json"))
+            this.evict()
+        except (IOError, OSError) as e:
+            print("WARNING - Cannot write to the program cache: %s" % e)
+
+    # Removes the least recently used entries until the cache fits in maxSize
+    def evict(this):
+        entries = []
+        total = 0
+        for name in os.listdir(this.directory):
+            entry = os.path.join(this.directory, name)
+            if (name.startswith("tmp-") or not os.path.isdir(entry)):
+                continue
+            size = 0
+            for filename in os.listdir(entry):
+                size += os.path.getsize(os.path.join(entry, filename))
+            entries.append((os.path.getmtime(entry), size, entry))
+            total += size
+
+        entries.sort()
+        for (mtime, size, entry) in entries:
+            if (total <= this.maxSize):
+                break
+            this._remove(entry)
+            total -= size
+
+    # Removes every entry from the cache
+    def clear(this):
+        if (os.path.isdir(this.directory)):
+            for name in os.listdir(this.directory):
+                this._remove(os.path.join(this.directory, name))
+
+    def _read_array(this, entry, name):
+        return numpy.load(os.path.join(entry, name + ".npy"), mmap_mode="r")
+
+    def _read_json(this, entry, name):
+        path = os.path.join(entry, name)
+        if (not os.path.exists(path)):
+            return None
+        fd = open(path, "r")
+        try:
+            return json.load(fd)
+        finally:
+            fd.close()
+
+    def _write_json(this, entry, name, data):
+        fd = open(os.path.join(entry, name), "w")
+        try:
+            json.dump(data, fd)
+        finally:
+            fd.close()
+
+    # Marks the entry as recently used
+    def _touch(this, entry):
+        try:
+            os.utime(entry, None)
+        except OSError:
+            pass
+
+    def _remove(this, entry):
+        shutil.rmtree(entry, ignore_errors=True)
@@ -0,0 +1,494 @@
+# Python G-Code simulator
+#
+# Copyright (C) 2011 Peter Rogers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+# Draws a simulated job with cairo, without needing any GUI toolkit. JobRenderer
+# draws onto any cairo context: the Gtk canvas uses it (see render.py), and
+# render_file uses it to write previews of a job as PNG, SVG or PDF files.
+# Installed as 'gsim-render':
+#
+#   gsim-render --dpi 300 -o preview.png job.ngc
+#
+# Very large PNG images are drawn in bands of rows by a pool of worker processes,
+# and the bands are compressed by the workers and stitched together as they come
+# in (see gsim.png), so the whole image is never held in memory.
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import math
+import numpy
+
+from gsim import gcode
+from gsim import motion
+from gsim import tessellate
+from gsim import png
+try:
+    import cairo
+except ImportError:
+    print("ERROR - Cannot import cairo module. Please visit https://pycairo.readthedocs.io/\n")
+    raise
+
+###########
+# Globals #
+###########
+
+# How far the polylines used to draw arcs can stray from the true arc, in pixels
+ARC_TOLERANCE = 0.25
+
+# When more paths than this are on screen they're drawn from a level of detail
+# (see PathTable.get_detail_level), with cells of (at most) LOD_CELL_SIZE pixels
+LOD_MIN_PATHS = 20000
+LOD_CELL_SIZE = 1.0
+# The colours of the cells in a level of detail, as ARGB
+LOD_CUT_COLOUR = 0xff000000
+LOD_RAPID_COLOUR = 0xffff80ff
+
+# The colours used for cutting moves and rapid moves
+CUT_COLOUR = (0, 0, 0)
+RAPID_COLOUR = (1, 0.5, 1)
+
+# The number of points added to a cairo path between checks on whether the drawing
+# has been cancelled (see JobRenderer.cancelled)
+CANCEL_POINTS = 65536
+
+# The number of points per mm in SVG and PDF files
+POINTS_PER_MM = 72/25.4
+
+# PNG images with more pixels than this are drawn in bands by worker processes
+TILE_MIN_PIXELS = 4096*4096
+# The number of rows in each band
+TILE_HEIGHT = 512
+
+# The renderer used by a worker process (see _init_worker)
+_renderer = None
+
+#############
+# Functions #
+#############
+
+# Returns the cairo surface for an image file (or band of one) of the given format
+def _create_surface(fmt, path, width, height):
+    if (fmt == "svg"):
+        return cairo.SVGSurface(path, width, height)
+    if (fmt == "pdf"):
+        return cairo.PDFSurface(path, width, height)
+    return cairo.ImageSurface(cairo.FORMAT_RGB24, width, height)
+
+# Returns the pixels of an RGB24 image surface as an array of shape (height, width, 3)
+def surface_to_rgb(surface):
+    surface.flush()
+    (width, height) = (surface.get_width(), surface.get_height())
+    data = numpy.frombuffer(surface.get_data(), dtype=numpy.uint8)
+    data = data.reshape(height, surface.get_stride())[:,:width*4].reshape(height, width, 4)
+    # Each pixel is stored as a native-endian 32 bit word (BGRX on little-endian machines)
+    if (sys.byteorder == "little"):
+        return data[:,:,2::-1]
+    return data[:,:,1:]
+
+# Sets up a worker process to draw bands of an image
+def _init_worker(data, minPos, units, settings):
+    global _renderer
+    paths = gcode.PathTable()
+    paths.set_array(data)
+    _renderer = JobRenderer(paths, minPos, units, **settings)
+
+# Draws the band of rows [top, bottom) of the image in a worker process, returning
+# it compressed (see png.encode_band)
+def _render_band(top, bottom, last, tm, head):
+    surface = cairo.ImageSurface(cairo.FORMAT_RGB24, _renderer.width, bottom-top)
+    cr = cairo.Context(surface)
+    cr.translate(0, -top)
+    _renderer.render(cr, tm, head)
+    return png.encode_band(surface_to_rgb(surface), last)
+
+# Writes a picture of the job to the given file, as it stands at time 'tm' (or
+# when finished, if None). The format comes from the file extension (.png, .svg
+# or .pdf). Images are drawn at the given resolution, unless a width and/or height
+# (in pixels, or points for SVG and PDF) is given to fit the job into. Big PNG
+# images are drawn in bands by 'workers' processes (default: one per CPU).
+def render_file(state, path, tm=None, dpi=96, width=None, height=None, head=None, workers=None):
+    fmt = os.path.splitext(path)[1].lower().lstrip(".")
+    if (fmt not in ("png", "svg", "pdf")):
+        raise ValueError("unknown image format: %s" % path)
+    if (state.bounds is None):
+        raise ValueError("there is nothing to draw")
+    if (head is None):
+        head = (tm is not None)
+
+    if (fmt == "png"):
+        resolution = dpi/25.4
+    else:
+        resolution = POINTS_PER_MM
+    # The size of the job (and its border) in pixels
+    (minPos, maxPos) = state.bounds
+    jobWidth = (maxPos[0]-minPos[0]+2*JobRenderer.border)*resolution
+    jobHeight = (maxPos[1]-minPos[1]+2*JobRenderer.border)*resolution
+    zoom = min(width/jobWidth if width else float("inf"), height/jobHeight if height else float("inf"))
+    if (math.isinf(zoom)):
+        zoom = 1.0
+    width = int(width or math.ceil(jobWidth*zoom))
+    height = int(height or math.ceil(jobHeight*zoom))
+    settings = {"width" : width, "height" : height, "resolution" : resolution, "zoom" : zoom}
+
+    if (fmt != "png" or width*height <= TILE_MIN_PIXELS):
+        renderer = JobRenderer(state.paths, minPos, state.units, **settings)
+        # Vector files keep every path rather than a pixel grid
+        renderer.useDetailLevels = (fmt == "png")
+        surface = _create_surface(fmt, path, width, height)
+        renderer.render(cairo.Context(surface), tm, head)
+        if (fmt == "png"):
+            surface.write_to_png(path)
+        surface.finish()
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    tops = list(range(0, height, TILE_HEIGHT))
+    bottoms = tops[1:] + [height]
+    lasts = [False]*(len(tops)-1) + [True]
+    pool = ProcessPoolExecutor(workers, initializer=_init_worker,
+                               initargs=(state.paths.array, minPos, state.units, settings))
+    fd = open(path, "wb")
+    try:
+        writer = png.PNGWriter(fd, width, height)
+        # The bands come back in order, as soon as each one (and those before it) is done
+        bands = pool.map(_render_band, tops, bottoms, lasts, [tm]*len(tops), [head]*len(tops))
+        for (band, last) in zip(bands, lasts):
+            writer.write_band(*band, last=last)
+        writer.close()
+    finally:
+        fd.close()
+        pool.shutdown()
+
+###########
+# Classes #
+###########
+
+# Draws a job onto a cairo context. The drawing covers a canvas 'width' by 'height'
+# (in device units, eg pixels), which is scrolled by 'offset'. The job is drawn
+# 'resolution' pixels per mm, times the zoom level.
+class JobRenderer(object):
+    # The margin around the job, in mm
+    border = 10
+    # Whether big jobs are drawn from a level of detail when zoomed out (see
+    # draw_paths). This only makes sense when drawing pixels.
+    useDetailLevels = True
+    # Called now and again while drawing the paths, and if it returns true the
+    # drawing is given up (eg when drawing on another thread and a newer frame
+    # has been asked for). See draw_paths.
+    cancelled = None
+
+    def __init__(this, paths, minPos, units, width, height, resolution=1.0, zoom=1.0, offset=(0, 0)):
+        this.paths = paths
+        this.minPos = minPos
+        this.units = units
+        this.width = width
+        this.height = height
+        this.resolution = resolution
+        this.zoom = zoom
+        this.offset = offset
+
+    # The number of pixels per mm
+    @property
+    def scale(this):
+        return this.resolution*this.zoom
+
+    # Everything that changes where the paths end up on the canvas, so drawings
+    # made for one view aren't reused for another
+    @property
+    def view(this):
+        return (this.width, this.height, this.zoom, this.resolution,
+                tuple(this.offset), tuple(this.minPos), this.units, this.border)
+
+    # Converts a position on the canvas (in pixels) to machine coordinates
+    def device_to_model(this, x, y):
+        return ((x-this.offset[0])/this.scale + this.minPos[0] - this.border,
+                (this.offset[1]+this.height-y)/this.scale + this.minPos[1] - this.border)
+
+    # Converts an array of points in machine coordinates to positions on the canvas
+    def model_to_device(this, points):
+        x = (points[:,0]-this.minPos[0]+this.border)*this.scale + this.offset[0]
+        y = this.offset[1] + this.height - (points[:,1]-this.minPos[1]+this.border)*this.scale
+        return (x, y)
+
+    # Returns the area of the job within the given context's clip region, as
+    # (xmin, ymin, xmax, ymax)
+    def get_visible_rect(this, cr):
+        (x1, y1, x2, y2) = cr.clip_extents()
+        (xmin, ymin) = this.device_to_model(x1, y2)
+        (xmax, ymax) = this.device_to_model(x2, y1)
+        return (xmin, ymin, xmax, ymax)
+
+    # Applies the transform from machine coordinates to the canvas
+    def apply_transform(this, cr):
+        cr.translate(this.offset[0], this.offset[1])
+
+        # Change the coordinate system we are using to make things easier below. Since the
+        # screen has (0, 0) in the upper-left corner, we need to translate everything
+        # down to start at the bottom of the screen, then reflect it back up (mathematical
+        # y-axis goes up, but rendering y-axis goes down).
+        cr.translate(0, this.height)
+        cr.scale(1, -1)
+
+        # Convert mm to pixel coordinates
+        cr.scale(this.resolution, this.resolution)
+        # Now apply the user-defined zoom factor
+        cr.scale(this.zoom, this.zoom)
+        # Shift everything so that geometry is always visible
+        cr.translate(-this.minPos[0]+this.border,
+                     -this.minPos[1]+this.border)
+
+        # Make the line thickness constant across all zoom levels
+        cr.set_line_width(0.4/this.zoom)
+
+    # Draws the background, border and scale
+    def draw_background(this, cr):
+        cr.set_source_rgb(1,1,1)
+        cr.rectangle(0, 0, this.width, this.height)
+        cr.fill()
+
+        cr.set_source_rgb(0,0,0)
+        cr.rectangle(0, 0, this.width, this.height)
+        cr.stroke()
+
+        cr.select_font_face("Times")
+        cr.set_font_size(12)
+
+        # Draw the geometry scale in the lower-left corner
+        if (this.units == "mm"):
+            units = "cm"
+            mag = 10
+        else:
+            units = this.units
+            mag = 1
+
+        # Draw the scale in the bottom-right corner
+        w = this.scale*mag
+        h = w/3
+        h = max(h, 5)
+        h = min(h, 15)
+
+        x1 = this.width-w-10
+        yp = this.height-10
+        x2 = x1+w
+
+        # Draw a horizontal line
+        cr.set_source_rgb(0,0,1)
+        cr.move_to(x1, yp)
+        cr.line_to(x2, yp)
+        cr.stroke()
+        # Draw the tick on the left side
+        cr.move_to(x1, yp-h/2)
+        cr.line_to(x1, yp+h/2)
+        cr.stroke()
+        # Draw the tick on the right side
+        cr.move_to(x2, yp-h/2)
+        cr.line_to(x2, yp+h/2)
+        cr.stroke()
+        # Show the units
+        cr.move_to(x1-30, yp)
+        cr.show_text("1 %s" % units)
+        cr.stroke()
+
+    # Draws the completed paths with indices in [start, stop). Only the ones within
+    # the clip region are drawn (see PathTable.find_in_rect), and if there are a
+    # lot of them they're drawn from a level of detail instead (see draw_level).
+    # Returns False if the drawing was cancelled part way (see 'cancelled'), in
+    # which case some of the paths may have been drawn.
+    def draw_paths(this, cr, start, stop):
+        rect = this.get_visible_rect(cr)
+        visible = this.paths.find_in_rect(*rect, start=start, stop=stop)
+        if (this.useDetailLevels and start == 0 and len(visible) > LOD_MIN_PATHS):
+            # Zoomed out on a big job: the work now depends on the number of
+            # pixels covered. Paths added since the level was made are drawn as usual.
+            level = this.paths.get_detail_level(LOD_CELL_SIZE/this.scale)
+            if (level is not None):
+                this.draw_level(cr, level, stop, rect)
+                visible = visible[visible >= level.size]
+
+        cr.save()
+        this.apply_transform(cr)
+        # How closely arcs are followed, in mm (about a quarter of a pixel)
+        tolerance = ARC_TOLERANCE/this.scale
+        data = this.paths.array
+        (points, counts) = tessellate.trace_rows(data, visible, this.paths.get_arcs(tolerance))
+        rapid = data["rapid"][visible]
+        # Each style of path goes into a single cairo path which is stroked once,
+        # rapids first so the cuts are drawn over them. Paths that follow on from
+        # each other are joined into one polyline.
+        for (style, colour) in ((True, RAPID_COLOUR), (False, CUT_COLOUR)):
+            chosen = (rapid == style)
+            if (not chosen.any()):
+                continue
+            (joined, moves) = tessellate.join_polylines(points[numpy.repeat(chosen, counts)], counts[chosen])
+            for first in range(0, len(joined), CANCEL_POINTS):
+                if (this.cancelled and this.cancelled()):
+                    cr.new_path()
+                    cr.restore()
+                    return False
+                last = first + CANCEL_POINTS
+                for ((x, y), move) in zip(joined[first:last].tolist(), moves[first:last].tolist()):
+                    if (move):
+                        cr.move_to(x, y)
+                    else:
+                        cr.line_to(x, y)
+            cr.set_source_rgb(*colour)
+            cr.stroke()
+        cr.restore()
+        return True
+
+    # Draws the cells of a level of detail (see gsim.lod) for the paths before 'stop'
+    # in the given area. The cells are about a pixel across, so they're coloured in
+    # on an image covering the clip region which is then painted over in one go.
+    def draw_level(this, cr, level, stop, rect):
+        (x1, y1, x2, y2) = cr.clip_extents()
+        (left, top) = (int(math.floor(x1)), int(math.floor(y1)))
+        width = int(math.ceil(x2)) - left
+        height = int(math.ceil(y2)) - top
+        if (width <= 0 or height <= 0):
+            return
+        (points, rapid) = level.get_cells(stop, *rect)
+        (x, y) = this.model_to_device(points)
+        x = numpy.floor(x).astype(int) - left
+        y = numpy.floor(y).astype(int) - top
+        inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+
+        stride = cairo.ImageSurface.format_stride_for_width(cairo.FORMAT_ARGB32, width)
+        pixels = numpy.zeros((height, stride//4), dtype=numpy.uint32)
+        # Rapids first, so cuts win out where they share a pixel
+        for (kind, colour) in ((True, LOD_RAPID_COLOUR), (False, LOD_CUT_COLOUR)):
+            chosen = inside & (rapid == kind)
+            pixels[y[chosen], x[chosen]] = colour
+        surface = cairo.ImageSurface.create_for_data(pixels, cairo.FORMAT_ARGB32, width, height, stride)
+        cr.set_source_surface(surface, left, top)
+        cr.paint()
+
+    # Returns the path being cut at the given time (or None if there are no paths),
+    # along with how far through it the cutter is (from 0 to 1)
+    def get_current_path(this, tm):
+        n = this.paths.find_time(tm)
+        if (n < 0):
+            return (None, 0)
+        path = this.paths[n]
+        if (path.duration == 0):
+            return (path, 1)
+        return (path, min(max((tm-path.startTime)/path.duration, 0), 1))
+
+    # Draws as much of the current path as has been cut, returning the position of
+    # the cutting head
+    def draw_current_path(this, cr, path, pathParam):
+        cr.save()
+        this.apply_transform(cr)
+        if (isinstance(path, gcode.Line)):
+            lastPos = path.start + (path.end-path.start)*pathParam
+            if (path.rapid):
+                cr.set_source_rgb(*RAPID_COLOUR)
+            else:
+                cr.set_source_rgb(*CUT_COLOUR)
+            cr.move_to(*path.start)
+            cr.line_to(*lastPos)
+            cr.stroke()
+
+        elif (isinstance(path, gcode.Arc)):
+            points = this.paths.get_arc_points(path.index, ARC_TOLERANCE/this.scale)
+            # Only draw as much of the arc as has been cut so far
+            pos = pathParam*(len(points)-1)
+            n = min(int(pos), len(points)-1)
+            lastPos = points[n].copy()
+            if (n+1 < len(points)):
+                lastPos += (points[n+1]-points[n])*(pos-n)
+            cr.set_source_rgb(*CUT_COLOUR)
+            cr.move_to(*points[0])
+            for pt in points[1:n+1]:
+                cr.line_to(*pt)
+            cr.line_to(*lastPos)
+            cr.stroke()
+
+        else:
+            # Dwelling or changing tools, the head stays where it is
+            lastPos = this.paths.array["start"][path.index].copy()
+        cr.restore()
+        return lastPos
+
+    # Draws the cutting head at the given position
+    def draw_head(this, cr, pos):
+        cr.save()
+        this.apply_transform(cr)
+        (xp, yp) = pos
+        size = 1.5
+        cr.set_source_rgb(1,0,0)
+        cr.arc(xp, yp, size, 0, 2*math.pi)
+        cr.stroke()
+        cr.restore()
+
+    # Draws the whole job as it stands at time 'tm' (or when finished, if None),
+    # with the cutting head if 'head' is set. Returns the position of the head, or
+    # None if there are no paths.
+    def render(this, cr, tm=None, head=True):
+        this.draw_background(cr)
+        if (tm is None):
+            tm = this.paths.get_end_time()
+        (path, pathParam) = this.get_current_path(tm)
+        if (path is None):
+            return None
+        this.draw_paths(cr, 0, path.index)
+        pos = this.draw_current_path(cr, path, pathParam)
+        if (head):
+            this.draw_head(cr, pos)
+        return pos
+
+def main():
+    """Command line function to draw a picture of a G-code job."""
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Draw a G-code job as a PNG, SVG or PDF file.")
+    parser.add_argument("path", help="path to G-code file")
+    parser.add_argument("-o", "--output",
+                        help="the image file to write (default: the G-code file name with .png)")
+    parser.add_argument("-t", "--time", type=float,
+                        help="draw the job as it is this many seconds in (default: when finished)")
+    parser.add_argument("--dpi", type=float, default=96,
+                        help="resolution of PNG images (default: 96)")
+    parser.add_argument("--width", type=int, help="fit the job into this width")
+    parser.add_argument("--height", type=int, help="fit the job into this height")
+    parser.add_argument("--head", action="store_true", default=None,
+                        help="draw the cutting head (the default when --time is given)")
+    parser.add_argument("-j", "--workers", type=int,
+                        help="number of processes for big images (default: one per CPU)")
+    parser.add_argument("--machine", metavar="PROFILE",
+                        help="time the job using the machine limits in the given "
+                        "JSON file (see gsim.motion.MachineProfile)")
+    args = parser.parse_args()
+
+    output = args.output or os.path.splitext(args.path)[0] + ".png"
+    prog = gcode.parse_program(args.path, cache=True)
+    if (args.machine):
+        prog.profile = motion.MachineProfile.load(args.machine)
+    state = prog.start()
+    state.run()
+    try:
+        render_file(state, output, args.time, args.dpi, args.width, args.height,
+                    args.head, args.workers)
+    except ValueError as e:
+        print("%s: %s" % (args.path, e), file=sys.stderr)
+        sys.exit(1)
+
+if (__name__ == "__main__"):
+    main()
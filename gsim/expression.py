@@ -0,0 +1,427 @@
+# Python G-Code simulator
+#
+# Copyright (C) 2011 Peter Rogers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+# Compiles G-code expressions (eg "[#5*123.4+#8]") into Python functions. Each
+# expression is parsed once and turned into a single lambda that reads the
+# variables it needs directly, so evaluating it again later is just a function call.
+#
+# Programs often have a different number on almost every line but only a few
+# shapes of expression (eg "[#5*123.4+#8]" and "[#5*56.7+#8]"), so the numbers
+# are taken out of the text first and each shape is only parsed and compiled
+# once (see Shape). An expression then just binds its own numbers to the shape's
+# function, and expressions without any variables are worked out there and then.
+
+from __future__ import absolute_import, division, print_function
+
+import re
+import math
+import collections
+
+###########
+# Globals #
+###########
+
+# Binary operators, grouped by precedence (lowest first) as in LinuxCNC
+PRECEDENCE = (
+    ("AND", "OR", "XOR"),
+    ("EQ", "NE", "GT", "GE", "LT", "LE"),
+    ("+", "-"),
+    ("*", "/", "MOD"),
+    ("**",),
+)
+
+# Unary functions. Note the trig functions work in degrees like LinuxCNC.
+FUNCTIONS = {
+    "ABS" : abs,
+    "ACOS" : lambda a : math.degrees(math.acos(a)),
+    "ASIN" : lambda a : math.degrees(math.asin(a)),
+    "ATAN" : lambda a : math.degrees(math.atan(a)),
+    "COS" : lambda a : math.cos(math.radians(a)),
+    "EXP" : math.exp,
+    "FIX" : lambda a : float(math.floor(a)),
+    "FUP" : lambda a : float(math.ceil(a)),
+    "LN" : math.log,
+    "ROUND" : lambda a : float(math.floor(abs(a)+0.5))*(1 if a >= 0 else -1),
+    "SIN" : lambda a : math.sin(math.radians(a)),
+    "SQRT" : math.sqrt,
+    "TAN" : lambda a : math.tan(math.radians(a)),
+}
+
+# The two argument form of ATAN (ATAN[y]/[x])
+def _atan2(y, x):
+    return math.degrees(math.atan2(y, x))
+
+def _mod(a, b):
+    result = math.fmod(a, b)
+    if (result < 0):
+        result += abs(b)
+    return result
+
+OPERATIONS = {
+    "**" : lambda a, b : a**b,
+    "*" : lambda a, b : a*b,
+    "/" : lambda a, b : a/float(b),
+    "MOD" : _mod,
+    "+" : lambda a, b : a+b,
+    "-" : lambda a, b : a-b,
+    "EQ" : lambda a, b : float(a == b),
+    "NE" : lambda a, b : float(a != b),
+    "GT" : lambda a, b : float(a > b),
+    "GE" : lambda a, b : float(a >= b),
+    "LT" : lambda a, b : float(a < b),
+    "LE" : lambda a, b : float(a <= b),
+    "AND" : lambda a, b : float(bool(a) and bool(b)),
+    "OR" : lambda a, b : float(bool(a) or bool(b)),
+    "XOR" : lambda a, b : float(bool(a) != bool(b)),
+}
+
+# Python templates used when generating code for the operators above. Operators
+# without a template are called through the OPERATIONS table.
+TEMPLATES = {
+    "**" : "(%s**%s)",
+    "*" : "(%s*%s)",
+    "/" : "(%s/%s)",
+    "+" : "(%s+%s)",
+    "-" : "(%s-%s)",
+}
+
+TOKEN_PATTERN = re.compile(r"""
+    \s*(?:
+      (?P<number>\d+\.?\d*|\.\d+)
+    | (?P<name>[A-Za-z]+)
+    | (?P<var>\#)
+    | (?P<named><[^>]*>)
+    | (?P<op>\*\*|[-+*/\[\]])
+    | (?P<slot>\$)
+    )""", re.VERBOSE)
+
+# Finds the numbers in expression text (the second group), skipping numbered
+# parameters (eg "#5") and named parameters (which may have digits in them)
+NUMBER_PATTERN = re.compile(r"(<[^>]*>|\#\s*\d+(?![\d.]))|(\d+\.?\d*|\.\d+)")
+
+# The same for text without named parameters or spaces (ie nearly all of it), where
+# a parameter number is simply one that comes straight after a "#". This lets the
+# numbers be taken out without calling back into Python for each one.
+SIMPLE_NUMBER_PATTERN = re.compile(r"(?<![#\d.])(\d+\.?\d*|\.\d+)")
+NOT_SIMPLE_PATTERN = re.compile(r"[<\s]")
+
+# A plain number, which needs no compiling
+LITERAL_PATTERN = re.compile(r"[-+]?(?:\d+\.?\d*|\.\d+)\Z")
+
+# Stands in for the numbers taken out of an expression (see compile_expression)
+SLOT = "$"
+
+# The number of compiled expressions remembered by compile_expression, and of
+# expression shapes (see get_shape)
+CACHE_SIZE = 10000
+
+# Both are kept in least recently used order
+_cache = collections.OrderedDict()
+_shapes = collections.OrderedDict()
+
+# The names available to the generated code
+_NAMESPACE = {"OPERATIONS" : OPERATIONS, "FUNCTIONS" : FUNCTIONS, "ATAN2" : _atan2}
+
+#############
+# Functions #
+#############
+
+# Compiles the given expression text. Returns a float if the expression works
+# out to a constant, or an Expression object otherwise. Raises ExpressionError if
+# the text is not a valid expression.
+def compile_expression(text):
+    if (LITERAL_PATTERN.match(text)):
+        # Most values are just numbers, which are converted directly (and not
+        # cached, since they're rarely repeated)
+        return float(text)
+    result = _cache.pop(text, None)
+    if (result is not None):
+        # Most recently used goes last
+        _cache[text] = result
+        return result
+    (shape, constants) = split_expression(text)
+    result = get_shape(shape).bind(text, constants)
+
+    _cache[text] = result
+    if (len(_cache) > CACHE_SIZE):
+        _cache.popitem(last=False)
+    return result
+
+# Takes the numbers out of the given expression text, returning the shape of the
+# expression (the text with SLOT in place of each number) and a list of the numbers
+def split_expression(text):
+    if (SLOT in text):
+        raise ExpressionError("bad expression: %s" % repr(text))
+    if (not NOT_SIMPLE_PATTERN.search(text)):
+        # This gives the text between the numbers, and the numbers themselves
+        parts = SIMPLE_NUMBER_PATTERN.split(text)
+        return (SLOT.join(parts[::2]), [float(number) for number in parts[1::2]])
+    constants = []
+    def take(m):
+        if (m.group(1)):
+            return m.group(1)
+        constants.append(float(m.group(2)))
+        return SLOT
+    return (NUMBER_PATTERN.sub(take, text), constants)
+
+# Returns the compiled Shape for the given shape text (see split_expression).
+# Raises ExpressionError if it is not a valid expression.
+def get_shape(shape):
+    compiled = _shapes.pop(shape, None)
+    if (compiled is None):
+        compiled = Shape(shape)
+    _shapes[shape] = compiled
+    if (len(_shapes) > CACHE_SIZE):
+        _shapes.popitem(last=False)
+    return compiled
+
+# Returns the variable key referred to by the given text (eg "#5" -> 5)
+def variable_key(text):
+    tree = _Parser(text).parse()
+    if (tree[0] != "var" or not isinstance(tree[1], (int, str))):
+        raise ExpressionError("not a variable: %s" % repr(text))
+    return tree[1]
+
+# Evaluates an expression (text, compiled or constant) using the given variables
+def evaluate(exp, variables):
+    if (exp.__class__ is float):
+        return exp
+    if (not isinstance(exp, Expression)):
+        exp = compile_expression(exp)
+        if (exp.__class__ is float):
+            return exp
+    return exp.evaluate(variables)
+
+###########
+# Classes #
+###########
+
+class ExpressionError(ValueError):
+    pass
+
+# A compiled, non-constant expression: the function of its shape (see Shape) and
+# its own numbers. There can be one of these for nearly every line of a program,
+# so it's kept to a single small object.
+class Expression(object):
+    __slots__ = ("text", "function", "constants")
+
+    def __init__(this, text, function, constants):
+        this.text = text
+        this.function = function
+        this.constants = constants
+
+    # Returns the value of the expression for the given variables dictionary
+    def evaluate(this, variables):
+        return this.function(this.constants, variables)
+
+    def __repr__(this):
+        return "%s(%r)" % (this.__class__.__name__, this.text)
+
+# The shape of an expression: its text with the numbers replaced by SLOT, parsed
+# and compiled into a function that takes the numbers (as a tuple) and the
+# variables, and returns the value
+class Shape(object):
+    def __init__(this, text):
+        tree = _Parser(text).parse()
+        this.constant = not _uses_variables(tree)
+        this.function = eval("lambda c, v: %s" % _generate(tree), _NAMESPACE)
+
+    # Returns the expression with the given text and numbers (see compile_expression)
+    def bind(this, text, constants):
+        constants = tuple(constants)
+        if (this.constant):
+            try:
+                return float(this.function(constants, None))
+            except (ValueError, ZeroDivisionError, OverflowError):
+                # Leave it to fail at run time, like the uncompiled expression would
+                pass
+        return Expression(text, this.function, constants)
+
+# A recursive descent parser that turns expression text into a tree of tuples:
+#   ("const", value), ("slot", n), ("var", key), ("neg", node), ("func", name, node),
+#   ("atan2", y, x), ("op", op, left, right)
+# Constant sub-trees are folded as they are built. Slots are numbered in order.
+class _Parser(object):
+    def __init__(this, text):
+        this.text = text
+        this.tokens = this.tokenize(text)
+        this.pos = 0
+        this.slots = 0
+
+    def tokenize(this, text):
+        tokens = []
+        pos = 0
+        text = text.rstrip()
+        while pos < len(text):
+            m = TOKEN_PATTERN.match(text, pos)
+            if (not m):
+                raise ExpressionError("bad expression: %s" % repr(text))
+            pos = m.end()
+            kind = m.lastgroup
+            value = m.group(kind)
+            if (kind == "name"):
+                value = value.upper()
+            tokens.append((kind, value))
+        return tokens
+
+    def peek(this):
+        if (this.pos < len(this.tokens)):
+            return this.tokens[this.pos]
+        return (None, None)
+
+    def next(this):
+        token = this.peek()
+        if (token[0] is None):
+            raise ExpressionError("unexpected end of expression: %s" % repr(this.text))
+        this.pos += 1
+        return token
+
+    def expect(this, value):
+        token = this.next()
+        if (token[1] != value):
+            raise ExpressionError("expected '%s' in expression: %s" % (value, repr(this.text)))
+
+    def parse(this):
+        if (not this.tokens):
+            # An empty value is treated as zero
+            return ("const", 0.0)
+        tree = this.parse_binary(0)
+        if (this.pos != len(this.tokens)):
+            raise ExpressionError("bad expression: %s" % repr(this.text))
+        return tree
+
+    # Parses a chain of binary operators with at least the given precedence level
+    def parse_binary(this, level):
+        if (level >= len(PRECEDENCE)):
+            return this.parse_unary()
+        ops = PRECEDENCE[level]
+        left = this.parse_binary(level+1)
+        while 1:
+            (kind, value) = this.peek()
+            if (kind not in ("op", "name") or value not in ops):
+                break
+            this.pos += 1
+            right = this.parse_binary(level+1)
+            left = _fold(("op", value, left, right))
+        return left
+
+    def parse_unary(this):
+        (kind, value) = this.peek()
+        if (value == "-"):
+            this.pos += 1
+            return _fold(("neg", this.parse_unary()))
+        if (value == "+"):
+            this.pos += 1
+            return this.parse_unary()
+        return this.parse_atom()
+
+    def parse_atom(this):
+        (kind, value) = this.next()
+        if (kind == "number"):
+            return ("const", float(value))
+
+        if (kind == "slot"):
+            this.slots += 1
+            return ("slot", this.slots-1)
+
+        if (kind == "var"):
+            (kind, value) = this.peek()
+            if (kind == "number" and "." not in value):
+                # Numbered parameter (eg "#5")
+                this.pos += 1
+                return ("var", int(value))
+            if (kind == "named"):
+                # Named parameter (eg "#<scale>"). Like LinuxCNC these are
+                # case insensitive and ignore spaces.
+                this.pos += 1
+                return ("var", value[1:-1].replace(" ", "").lower())
+            # Indirect reference (eg "##5" or "#[#5+1]")
+            return ("var", this.parse_atom())
+
+        if (value == "["):
+            tree = this.parse_binary(0)
+            this.expect("]")
+            return tree
+
+        if (kind == "name" and value in FUNCTIONS):
+            this.expect("[")
+            arg = this.parse_binary(0)
+            this.expect("]")
+            if (value == "ATAN" and this.peek()[1] == "/"):
+                # Two argument form: ATAN[y]/[x]
+                this.pos += 1
+                this.expect("[")
+                x = this.parse_binary(0)
+                this.expect("]")
+                return _fold(("atan2", arg, x))
+            return _fold(("func", value, arg))
+
+        raise ExpressionError("bad expression: %s" % repr(this.text))
+
+# Evaluates the given node if all of its children are constant
+def _fold(tree):
+    kind = tree[0]
+    try:
+        if (kind == "neg" and tree[1][0] == "const"):
+            return ("const", -tree[1][1])
+        if (kind == "func" and tree[2][0] == "const"):
+            return ("const", float(FUNCTIONS[tree[1]](tree[2][1])))
+        if (kind == "atan2" and tree[1][0] == "const" and tree[2][0] == "const"):
+            return ("const", _atan2(tree[1][1], tree[2][1]))
+        if (kind == "op" and tree[2][0] == "const" and tree[3][0] == "const"):
+            return ("const", float(OPERATIONS[tree[1]](tree[2][1], tree[3][1])))
+    except (ValueError, ZeroDivisionError, OverflowError):
+        # Leave it to fail at run time, like the uncompiled expression would
+        pass
+    return tree
+
+# Returns whether the given expression tree reads any variables
+def _uses_variables(tree):
+    kind = tree[0]
+    if (kind == "var"):
+        return True
+    if (kind in ("const", "slot")):
+        return False
+    return any(_uses_variables(node) for node in tree[1:] if isinstance(node, tuple))
+
+# Generates Python source code for the given expression tree
+def _generate(tree):
+    kind = tree[0]
+    if (kind == "const"):
+        return repr(tree[1])
+    if (kind == "slot"):
+        return "c[%d]" % tree[1]
+    if (kind == "var"):
+        key = tree[1]
+        if (isinstance(key, tuple)):
+            # Indirect reference, the key is computed at run time
+            return "v[int(%s)]" % _generate(key)
+        return "v[%r]" % (key,)
+    if (kind == "neg"):
+        return "(-%s)" % _generate(tree[1])
+    if (kind == "func"):
+        return "FUNCTIONS[%r](%s)" % (tree[1], _generate(tree[2]))
+    if (kind == "atan2"):
+        return "ATAN2(%s, %s)" % (_generate(tree[1]), _generate(tree[2]))
+    op = tree[1]
+    left = _generate(tree[2])
+    right = _generate(tree[3])
+    if (op in TEMPLATES):
+        return TEMPLATES[op] % (left, right)
+    return "OPERATIONS[%r](%s, %s)" % (op, left, right)
@@ -19,94 +19,243 @@
 
 from __future__ import absolute_import, division, print_function
 
+import os
 import sys
 import math
+import mmap
+import bisect
 try:
     import numpy
 except ImportError:
     print("ERROR - Cannot import NumPy module. Please visit http://www.numpy.org/\n")
     raise
 
+from gsim import expression
+from gsim import motion
+from gsim import simplify
+from gsim import tessellate
+from gsim import spatial
+from gsim import lod
+from gsim.tessellate import arc_sweep
+
+try:
+    from sys import intern
+except ImportError:
+    # Python 2 has intern() as a builtin
+    pass
+
 ###########
 # Globals #
 ###########
 
-OPERATIONS = {
-    "*" : lambda a, b : a*b,
-    "/" : lambda a, b : a/float(b),
-    "+" : lambda a, b : a+b,
-    "-" : lambda a, b : a-b,
-}
-
 # The rapid speed rate in mm/s
 RAPID_SPEED_MM = 25.0
 
+# The number of mm in each of the supported units
+UNIT_SCALE = {"in" : 25.4, "mm" : 1.0}
+
+# The types of path stored in a PathTable
+PATH_LINE = 0
+PATH_ARC = 1
+PATH_TOOL_CHANGE = 2
+PATH_DWELL = 3
+
+# The record layout of a PathTable. Points are stored as (x, y) pairs, 'statement'
+# is the line number of the generating statement (or -1) and 'tool' is the tool
+# loaded at the time.
+PATH_DTYPE = numpy.dtype([
+    ("kind", numpy.int8),
+    ("start", numpy.float64, (2,)),
+    ("end", numpy.float64, (2,)),
+    ("center", numpy.float64, (2,)),
+    ("radius", numpy.float64),
+    ("angle1", numpy.float64),
+    ("angle2", numpy.float64),
+    ("length", numpy.float64),
+    ("feedRate", numpy.float64),
+    ("startTime", numpy.float64),
+    ("duration", numpy.float64),
+    ("spindleOn", numpy.bool_),
+    ("rapid", numpy.bool_),
+    ("clockwise", numpy.bool_),
+    ("statement", numpy.int64),
+    ("tool", numpy.int32),
+])
+
+# How often a State records a keyframe (see Program.state_at): after this many
+# statements, or this many seconds of job time, whichever comes first. The time is
+# only checked every KEYFRAME_CHECK statements.
+KEYFRAME_LINES = 10000
+KEYFRAME_TIME = 60.0
+KEYFRAME_CHECK = 1000
+
+# The number of statements ensure_time() runs between checking the job time
+LAZY_CHUNK = 2000
+
+# Files smaller than this are always parsed in a single process, since starting
+# up the worker processes would take longer than the parsing itself
+PARALLEL_MIN_SIZE = 1 << 20
+
+# How often parse_program reports its progress, in statements
+PROGRESS_LINES = 10000
+
 #############
 # Functions #
 #############
 
-def parse_program(path):
-    fd = open(path, "r")
-
-    prog = Program()
-    while 1:
-        line = fd.readline()
-        if (not line): 
-            break
-        line = line.strip()
-
-        try:
-            i = line.index("(")
-        except ValueError:
-            comment = ""
-        else:
-            comment = line[i:]
-            line = line[:i].strip()
-
-        args = line.split()
-
-        statement = Statement()
-        statement.command = line.strip() + " " + comment
-        statement.lineNumber = len(prog.statements)
-        if (line.startswith("#")):
-            # Assignment statement
-            if (len(args) != 3):
-                print("bad line: %s" % repr(line))
-                prog.invalidLines.append(line)
-                continue
-
-            name = args[0]
-            op = args[1]
-            exp = args[2]
+# Parse the G-code file at the given path and return the resulting Program. If more
+# than one worker is requested, large files are split up and parsed in parallel by
+# a pool of processes (see _parse_program_parallel).
+#
+# If a cache is given (a cache.ProgramCache, or True for the default one) files
+# that have been seen before are loaded from it instead of being parsed, as is
+# the simulation result when the program is started.
+#
+# When parsing in a single process, 'progress' (if given) is called every
+# PROGRESS_LINES statements with the fraction of the file read so far. If it
+# returns true the parsing is given up and None is returned.
+def parse_program(path, workers=1, cache=None, profiler=None, progress=None):
+    if (profiler):
+        # Time the whole thing (see gsim.profiler)
+        with profiler.phase("parse"):
+            return parse_program(path, workers, cache, progress=progress)
+
+    if (cache):
+        from gsim.cache import get_default_cache
+        if (cache is True):
+            cache = get_default_cache()
+        key = cache.get_key(path)
+        prog = cache.load_program(key, path)
+        if (prog):
+            return prog
+
+    if (workers > 1 and os.path.getsize(path) >= PARALLEL_MIN_SIZE):
+        prog = _parse_program_parallel(path, workers)
+    else:
+        prog = Program()
+        size = max(os.path.getsize(path), 1)
+        for statement in iter_statements(path, prog.invalidLines):
+            prog.statements.append(statement)
+            if (progress and len(prog.statements) % PROGRESS_LINES == 0):
+                if (progress(statement.offset/size)):
+                    return None
+
+    if (cache):
+        cache.store_program(key, prog)
+    return prog
 
-            if (op != "="):
-                print("bad line: %s" % repr(line))
+# Generates the statements of a G-code program one at a time, so arbitrarily large
+# files can be processed without holding the whole program in memory. The source
+# can either be a path or an open file object. Lines that cannot be parsed are
+# appended to 'invalidLines' (if given) and skipped.
+#
+# When reading from a path the statements don't keep a copy of their source text,
+# only its offset in the file (see Statement.command).
+def iter_statements(source, invalidLines=None):
+    if (hasattr(source, "readline")):
+        fd = source
+        ownFile = False
+        sourceFile = None
+    else:
+        fd = open(source, "rb")
+        ownFile = True
+        sourceFile = SourceFile(source)
+
+    if (invalidLines is None):
+        invalidLines = []
+
+    try:
+        lineNumber = 0
+        offset = 0
+        for line in fd:
+            lineOffset = offset
+            offset += len(line)
+            if (isinstance(line, bytes)):
+                line = line.decode("utf-8", "replace")
+            statement = parse_line(line, invalidLines)
+            if (statement is None):
                 continue
+            if (sourceFile):
+                statement.source = sourceFile
+                statement.offset = lineOffset
+            statement.lineNumber = lineNumber
+            lineNumber += 1
+            yield statement
+    finally:
+        if (ownFile):
+            fd.close()
+
+# Splits a line of G-code into the code part and the comment part
+def split_comment(line):
+    line = line.strip()
+    i = line.find("(")
+    if (i < 0):
+        return (line, "")
+    return (line[:i].strip(), line[i:])
+
+# Parse a single line of G-code into a Statement. Returns None if the line is not
+# valid G-code (and appends it to 'invalidLines' where appropriate)
+def parse_line(line, invalidLines):
+    statement = Statement()
+    statement.source = line
+
+    (line, comment) = split_comment(line)
+    args = line.split()
+
+    if (line.startswith("#")):
+        # Assignment statement
+        if (len(args) != 3):
+            print("bad line: %s" % repr(line))
+            invalidLines.append(line)
+            return None
+
+        name = args[0]
+        op = args[1]
+        exp = args[2]
+
+        if (op != "="):
+            print("bad line: %s" % repr(line))
+            return None
+
+        # Compile the assignment up front, so it's cheap to execute
+        try:
+            name = expression.variable_key(name)
+            exp = expression.compile_expression(exp)
+        except expression.ExpressionError:
+            print("bad line: %s" % repr(line))
+            invalidLines.append(line)
+            return None
+
+        statement.code = op
+        statement.args = (name, exp)
+
+    elif (not line):
+        pass
+
+    else:
+        code = args[0]
+        args = args[1:]
+        if (code.startswith("G") or code.startswith("M")):
+            # Format as a two digit number to make things standard (M2 -> M02)
+            letter = code[0]
+            try:
+                num = int(code[1:])
+            except ValueError:
+                invalidLines.append(line)
+                return None
+            code = "%s%02d" % (letter, num)
 
-            statement.code = op
-            statement.args = (name, exp)
+        # There are only a handful of distinct codes in a program, so share them
+        statement.code = intern(code)
 
-        elif (not line):
-            pass
+        # Parse the arguments for this statement. Each parameter has a letter associated
+        # with it, and there may or may not be a space between it and the value.
+        # The values are compiled here so they can be evaluated quickly later.
+        try:
+            if (code.startswith("F") or code.startswith("T")):
+                # Standalone feed rate definition (eg "F300") or tool selection
+                statement.params[code[0]] = expression.compile_expression(code[1:])
 
-        else:
-            code = args[0]
-            args = args[1:]
-            if (code.startswith("G") or code.startswith("M")):
-                # Format as a two digit number to make things standard (M2 -> M02)
-                letter = code[0]
-                try:
-                    num = int(code[1:])
-                except ValueError:
-                    prog.invalidLines.append(line)
-                    continue
-                code = "%s%02d" % (letter, num)
-
-            statement.code = code
-            statement.args = args
-
-            # Parse the arguments for this statement. Each parameter has a letter associated
-            # with it, and there may or may not be a space between it and the value.
             n = 0
             while n < len(args):
                 # Grab the next parameter
@@ -124,43 +273,213 @@ def parse_program(path):
                     # The parameter and value come as a single token (eg "X123.4")
                     key = arg[0]
                     value = arg[1:]
-                statement.params[key] = value
+                statement.params[key] = expression.compile_expression(value)
+        except expression.ExpressionError:
+            invalidLines.append(line)
+            return None
+
+    return statement
+
+# Parses the given file by splitting it into chunks at line boundaries and handing
+# them out to a pool of worker processes. The chunks come back as compact arrays
+# (see _parse_chunk) which are stitched back together here, in file order.
+def _parse_program_parallel(path, workers):
+    from concurrent.futures import ProcessPoolExecutor
+
+    fd = open(path, "rb")
+    try:
+        data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            # Use a few chunks per worker so a slow chunk doesn't hold up the others
+            chunks = _split_chunks(data, workers*4)
+        finally:
+            data.close()
+    finally:
+        fd.close()
 
-        statement.comment = comment
+    prog = Program()
+    sourceFile = SourceFile(path)
+    pool = ProcessPoolExecutor(workers)
+    try:
+        futures = [pool.submit(_parse_chunk, path, start, end) for (start, end) in chunks]
+        for future in futures:
+            _add_chunk(prog, sourceFile, future.result())
+    finally:
+        pool.shutdown()
+    return prog
+
+# Returns a list of (start, end) byte ranges which divide the data into roughly
+# 'count' pieces, each ending on a line boundary
+def _split_chunks(data, count):
+    size = len(data)
+    bounds = [0]
+    for n in range(1, count):
+        pos = data.find(b"\n", max(size*n//count, bounds[-1]))
+        if (pos < 0):
+            break
+        bounds.append(pos+1)
+    bounds.append(size)
+    return [(start, end) for (start, end) in zip(bounds, bounds[1:]) if end > start]
+
+# Parses the lines in the given byte range of a file (run in a worker process). The
+# statements are returned in columnar form (see _StatementColumns) rather than as
+# Statement objects, which keeps them cheap to send back to the parent process.
+# The expressions are also split up here (see expression.split_expression), so
+# the parent only has to bind their numbers. Returns (columns, invalidLines,
+# shapes) where 'shapes' is a tuple of the distinct expression shapes, the shape
+# of each expression and all of their numbers in order.
+def _parse_chunk(path, start, end):
+    fd = open(path, "rb")
+    try:
+        data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            text = data[start:end]
+        finally:
+            data.close()
+    finally:
+        fd.close()
+
+    columns = _StatementColumns()
+    invalidLines = []
+
+    pos = 0
+    while pos < len(text):
+        nl = text.find(b"\n", pos)
+        if (nl < 0):
+            nl = len(text)
+        line = text[pos:nl].decode("utf-8", "replace")
+        offset = start+pos
+        pos = nl+1
+
+        statement = parse_line(line, invalidLines)
+        if (statement is not None):
+            columns.add(statement, offset)
+
+    shapes = {}
+    shapeIds = []
+    constants = []
+    for text in columns.exprText:
+        (shape, numbers) = expression.split_expression(text)
+        shapeIds.append(shapes.setdefault(shape, len(shapes)))
+        constants.extend(numbers)
+    shapeTexts = [None]*len(shapes)
+    for (shape, n) in shapes.items():
+        shapeTexts[n] = shape
+
+    return (columns.get_columns(), invalidLines,
+            (shapeTexts, numpy.array(shapeIds, dtype=numpy.int32), numpy.array(constants, dtype=numpy.float64)))
+
+# Appends the statements parsed from a chunk (see _parse_chunk) to the program
+def _add_chunk(prog, sourceFile, chunk):
+    (columns, invalidLines, (shapeTexts, shapeIds, constants)) = chunk
+    (codes, codeIds, offsets, paramCounts, paramKeys, paramValues, exprIndex, exprText, names) = columns
+    prog.invalidLines.extend(invalidLines)
+
+    codes = [intern(code) for code in codes]
+    paramValues = paramValues.tolist()
+    # Bind each expression's numbers to its (already compiled) shape
+    shapes = [expression.get_shape(shape) for shape in shapeTexts]
+    counts = [shape.count(expression.SLOT) for shape in shapeTexts]
+    constants = constants.tolist()
+    exprs = {}
+    c = 0
+    for (n, text, shapeId) in zip(exprIndex.tolist(), exprText, shapeIds.tolist()):
+        count = counts[shapeId]
+        exprs[n] = shapes[shapeId].bind(text, constants[c:c+count])
+        c += count
+
+    names = iter(names)
+    p = 0
+    for (codeId, offset, count) in zip(codeIds.tolist(), offsets.tolist(), paramCounts.tolist()):
+        statement = Statement()
+        statement.code = codes[codeId]
+        statement.source = sourceFile
+        statement.offset = offset
+        statement.lineNumber = len(prog.statements)
+
+        for n in range(p, p+count):
+            value = exprs.get(n)
+            if (value is None):
+                value = paramValues[n]
+            statement.params[paramKeys[n]] = value
+        p += count
+
+        if (statement.code == "="):
+            statement.args = (next(names), statement.params.pop("="))
         prog.statements.append(statement)
 
-    fd.close()
-    return prog
+# Returns the bounding box of each path in the given rows (see PATH_DTYPE) as an
+# (N, 4) array of (xmin, ymin, xmax, ymax). For arcs this includes the points at
+# 0, 90, 180 and 270 degrees that fall within the arc, not just the end points.
+def path_extents(rows):
+    start = rows["start"]
+    end = rows["end"]
+    lo = numpy.minimum(start, end)
+    hi = numpy.maximum(start, end)
+
+    arcs = numpy.flatnonzero(rows["kind"] == PATH_ARC)
+    if (len(arcs)):
+        arc = rows[arcs]
+        sweep = arc_sweep(arc)
+        angle1 = arc["angle1"]
+        clockwise = arc["clockwise"]
+        center = arc["center"]
+        radius = arc["radius"]
+        arcLo = lo[arcs]
+        arcHi = hi[arcs]
+        for quadrant in range(4):
+            theta = quadrant*math.pi/2
+            # How far along the arc (in the direction of travel) this angle is
+            offset = numpy.where(clockwise, angle1-theta, theta-angle1) % (2*math.pi)
+            crosses = (offset <= sweep)[:,None]
+            point = center + radius[:,None]*numpy.array([round(math.cos(theta)), round(math.sin(theta))])
+            arcLo = numpy.where(crosses, numpy.minimum(arcLo, point), arcLo)
+            arcHi = numpy.where(crosses, numpy.maximum(arcHi, point), arcHi)
+        lo[arcs] = arcLo
+        hi[arcs] = arcHi
+
+    return numpy.hstack((lo, hi))
 
 def distance_from_point_to_line(pt, p1, p2):
     return abs( (p2[0]-p1[0])*(p1[1]-pt[1]) - (p1[0]-pt[0])*(p2[1]-p1[1]) ) / numpy.linalg.norm(p2-p1)
 
-# Attempt to reduce the given path geometry to something more simple
+# Attempt to reduce the given path geometry (a list of Path objects) to something
+# more simple, merging runs of lines which stay within the given tolerance of the
+# original path (see gsim.simplify). Paths that aren't merged are returned as is.
 def reduce_paths(paths, tolerance):
-    lst = []
-    running = []
-    for path in paths:
+    paths = list(paths)
+    rows = numpy.zeros(len(paths), dtype=PATH_DTYPE)
+    for (n, path) in enumerate(paths):
+        row = rows[n]
         if (isinstance(path, Line)):
-            if (running):
-                # Check if this line segment can extend our running approximation
-                start = running[0].start
-                end = path.end
-                # Make sure each segment falls within tolerance
-                for p in running:
-                    dist = distance_from_point_to_line(p.end, start, end)
-                    if (dist > tolerance):
-                        line = Line(start, running[-1].end, running[0].feedRate)
-                        lst.append(line)
-                        running = [path]
-                        break
-            else:
-                running.append(path)
+            row["kind"] = PATH_LINE
+            row["start"] = path.start
+            row["end"] = path.end
+            row["rapid"] = path.rapid
         else:
-            if (running):
-                line = Line(running[0].start, running[-1].end, running[0].feedRate)
-                lst.append(line)
-                running = []
-            lst.append(path)
+            row["kind"] = PATH_ARC if isinstance(path, Arc) else PATH_DWELL
+        row["spindleOn"] = path.spindleOn
+        row["feedRate"] = path.feedRate
+        row["tool"] = path.tool
+        row["length"] = path.length
+        row["duration"] = path.duration
+
+    (result, first) = simplify.simplify_rows(rows, tolerance)
+    last = numpy.r_[first[1:], len(paths)] - 1
+    lst = []
+    for (n, (i, j)) in enumerate(zip(first.tolist(), last.tolist())):
+        if (i == j):
+            lst.append(paths[i])
+            continue
+        # Replace the run of lines with a single line, taking the attributes of
+        # the first one
+        start = paths[i]
+        line = Line(start.start, paths[j].end, start.feedRate)
+        for attr in ("index", "tool", "spindleOn", "statement", "command", "startTime", "rapid"):
+            setattr(line, attr, getattr(start, attr))
+        line.length = float(result["length"][n])
+        line.duration = float(result["duration"][n])
+        lst.append(line)
     return lst
 
 
@@ -171,28 +490,357 @@ def reduce_paths(paths, tolerance):
 class Program(object):
     statements = None
     invalidLines = None
+    # The cache this program was loaded from or stored in (see parse_program)
+    cache = None
+    cacheKey = None
+
+    # Snapshots of the machine state recorded while running the program
+    keyframes = None
+    # The machine limits used when simulating the program (a
+    # gsim.motion.MachineProfile), or None to run each move at its feed rate
+    profile = None
 
     def __init__(this):
         this.statements = []
         this.invalidLines = []
+        this.keyframes = KeyframeList()
 
     def start(this):
+        if (this.cache):
+            # Use the cached simulation if there is one
+            state = this.cache.load_state(this)
+            if (state):
+                return state
         return State(this)
 
+    # Returns the command (see Statement.command) of the statement at index 'n'. For
+    # programs loaded from the cache the line is read straight from the file,
+    # rather than creating the statement (and compiling its expressions) first.
+    def get_command(this, n):
+        statements = this.statements
+        if (isinstance(statements, StatementTable)):
+            (line, comment) = split_comment(statements.sourceFile.read_line(int(statements.offsets[n])))
+            return line + " " + comment
+        return statements[n].command
+
+    # Returns a State for a point part way through the program: either just before
+    # the statement 'lineno' is executed, or just after executing the statement
+    # that is running at the given time. The state is restored from the closest
+    # keyframe recorded by an earlier run and stepped forward from there, so this
+    # is cheap once the program has been run through.
+    #
+    # Note the paths table of the returned state only holds the paths generated
+    # after that keyframe, plus the few before it whose timing was still being
+    # planned (earlier rows are counted as discarded, so indices and timing carry
+    # on from where the keyframe left off).
+    def state_at(this, lineno=None, time=None):
+        if ((lineno is None) == (time is None)):
+            raise ValueError("state_at() needs either a line number or a time")
+
+        frame = this.keyframes.find(lineno=lineno, time=time)
+        if (time is not None):
+            # Checking the time means planning the paths generated so far, which is
+            # too slow to do after every statement. Instead run ahead in blocks
+            # until that time is reached, then look up the statement responsible.
+            probe = this._start_at(frame)
+            if (probe.ensure_time(time)):
+                n = probe.paths.find_time(time)
+                lineno = probe.paths.get_statement_index(n) + 1
+            else:
+                lineno = len(this.statements)
+
+        state = this._start_at(frame)
+        state.ensure_line(lineno)
+        return state
+
+    # Returns a new State, restored from the given keyframe (if any)
+    def _start_at(this, frame):
+        state = State(this)
+        if (frame):
+            state.restore(frame)
+        return state
+
+# A snapshot of the machine state at some point in a program (see State.restore)
+class Keyframe(object):
+    # The number of statements executed so far
+    lineno = 0
+    # The job time, and the totals of the paths generated so far
+    time = 0
+    pathCount = 0
+    cutLength = 0
+    rapidLength = 0
+    pos = None
+    feedRate = 1
+    spindleOn = True
+    units = "in"
+    rapidSpeed = 1
+    tool = 0
+    nextTool = 0
+    variables = None
+    unknownCodes = None
+    finished = False
+    # The paths still being planned (see PathTable.get_tail)
+    tail = None
+
+# The keyframes recorded for a program, in order
+class KeyframeList(object):
+    def __init__(this):
+        this.frames = []
+        # The line numbers and times of the frames, for searching
+        this._lines = []
+        this._times = []
+
+    def __len__(this):
+        return len(this.frames)
+
+    # Adds a keyframe, unless it's not past the last one. Several states may run
+    # through the same program, but since they produce identical keyframes only
+    # the first one to get to a given point needs to record it.
+    def add(this, frame):
+        if (this.frames and frame.lineno <= this._lines[-1]):
+            return False
+        this.frames.append(frame)
+        this._lines.append(frame.lineno)
+        this._times.append(frame.time)
+        return True
+
+    # Returns the last keyframe at or before the given line number (or time)
+    def find(this, lineno=None, time=None):
+        if (lineno is not None):
+            n = bisect.bisect_right(this._lines, lineno)
+        else:
+            n = bisect.bisect_right(this._times, time)
+        if (n == 0):
+            return None
+        return this.frames[n-1]
+
+    # Updates the keyframe times from the given (complete) paths table, once the
+    # timing of the rows they were recorded at has settled (see PathTable.flush)
+    def update_times(this, paths):
+        data = paths.array
+        ends = data["startTime"] + data["duration"]
+        for frame in this.frames:
+            if (frame.pathCount > 0):
+                frame.time = float(ends[frame.pathCount-1])
+        this._times = [frame.time for frame in this.frames]
+
+    # Returns the keyframe recorded last (or None)
+    def get_last(this):
+        if (this.frames):
+            return this.frames[-1]
+        return None
+
+# A single line of a program. There can be millions of these, so they are kept
+# small: the source text is not stored but read back on demand (see 'command'),
+# parameter values are floats or compiled expressions, and 'args' is only used
+# by assignments (as a (variable, expression) pair).
 class Statement(object):
-    code = None
-    args = None
-    comment = None
-    command = None
-    params = None
-    lineNumber = 0
+    __slots__ = ("code", "args", "params", "lineNumber", "source", "offset")
 
     def __init__(this):
         this.code = ""
+        this.args = None
         this.params = {}
+        this.lineNumber = 0
+        # Either a SourceFile, with 'offset' giving the start of the line within
+        # it, or the text of the line itself
+        this.source = None
+        this.offset = 0
+
+    # Returns the source line this statement was parsed from
+    def get_line(this):
+        if (isinstance(this.source, SourceFile)):
+            return this.source.read_line(this.offset)
+        return this.source or ""
+
+    # The statement code and arguments, followed by the comment (if any)
+    @property
+    def command(this):
+        (line, comment) = split_comment(this.get_line())
+        return line + " " + comment
+
+    @property
+    def comment(this):
+        return split_comment(this.get_line())[1]
+
+# Collects statements in columnar form, as a tuple of:
+#   codes       - the distinct statement codes
+#   codeIds     - for each statement, its index into 'codes'
+#   offsets     - for each statement, the file offset of its line
+#   paramCounts - for each statement, how many parameters it has
+#   paramKeys   - the parameter letters of all statements, as one string
+#   paramValues - the parameter values (NaN where it is an expression)
+#   exprIndex   - the (sorted) positions of the non-constant parameter values
+#   exprText    - the text of those values
+#   names       - the variable set by each assignment statement (whose value is
+#                 stored as a parameter called "=")
+class _StatementColumns(object):
+    def __init__(this):
+        this.codes = {}
+        this.codeIds = []
+        this.offsets = []
+        this.paramCounts = []
+        this.paramKeys = []
+        this.paramValues = []
+        this.exprIndex = []
+        this.exprText = []
+        this.names = []
+
+    def add(this, statement, offset):
+        this.codeIds.append(this.codes.setdefault(statement.code, len(this.codes)))
+        this.offsets.append(offset)
+        if (statement.code == "="):
+            (name, exp) = statement.args
+            this.names.append(name)
+            params = (("=", exp),)
+        else:
+            params = statement.params.items()
+        this.paramCounts.append(len(params))
+        for (key, value) in params:
+            if (value.__class__ is not float):
+                this.exprIndex.append(len(this.paramValues))
+                this.exprText.append(value.text)
+                value = numpy.nan
+            this.paramKeys.append(key)
+            this.paramValues.append(value)
+
+    def get_columns(this):
+        codes = [None]*len(this.codes)
+        for (code, n) in this.codes.items():
+            codes[n] = code
+
+        return (codes,
+                numpy.array(this.codeIds, dtype=numpy.int32),
+                numpy.array(this.offsets, dtype=numpy.int64),
+                numpy.array(this.paramCounts, dtype=numpy.uint8),
+                "".join(this.paramKeys),
+                numpy.array(this.paramValues, dtype=numpy.float64),
+                numpy.array(this.exprIndex, dtype=numpy.int64),
+                this.exprText,
+                this.names)
+
+# The statements of a program stored in columnar form (see _StatementColumns),
+# with Statement objects created on demand. Programs loaded from the cache use
+# this in place of a list of statements. The statements are created a block at a
+# time, converting the columns of the whole block in one go, and kept for reuse.
+class StatementTable(object):
+    # The number of statements created at once
+    BLOCK_SIZE = 4096
+
+    def __init__(this, sourceFile, columns):
+        (codes, codeIds, offsets, paramCounts, paramKeys, paramValues, exprIndex, exprText, names) = columns
+        this.sourceFile = sourceFile
+        this.codes = [intern(str(code)) for code in codes]
+        this.codeIds = codeIds
+        this.offsets = offsets
+        this.paramCounts = paramCounts
+        this.paramStarts = numpy.zeros(len(paramCounts)+1, dtype=numpy.int64)
+        numpy.cumsum(paramCounts, out=this.paramStarts[1:])
+        if (not isinstance(paramKeys, str)):
+            # An array of single characters (see cache.ProgramCache)
+            paramKeys = "".join(paramKeys.tolist())
+        this.paramKeys = paramKeys
+        this.paramValues = paramValues
+        this.exprIndex = exprIndex
+        this.exprText = exprText
+        this.names = names
+        # For each statement, the number of assignments before it (see _get_name)
+        this._nameIndex = None
+        # The statements created so far, by block number
+        this._blocks = {}
+
+    def __len__(this):
+        return len(this.codeIds)
+
+    def __getitem__(this, n):
+        if (isinstance(n, slice)):
+            return [this[i] for i in range(*n.indices(len(this)))]
+        if (n < 0):
+            n += len(this)
+        if (n < 0 or n >= len(this)):
+            raise IndexError("statement index out of range")
+        (block, i) = divmod(n, this.BLOCK_SIZE)
+        try:
+            return this._blocks[block][i]
+        except KeyError:
+            return this._make_block(block)[i]
+
+    def __iter__(this):
+        for n in range(len(this)):
+            yield this[n]
+
+    # Creates the statements in the given block
+    def _make_block(this, block):
+        first = block*this.BLOCK_SIZE
+        last = min(first+this.BLOCK_SIZE, len(this))
+        start = int(this.paramStarts[first])
+        stop = int(this.paramStarts[last])
+        keys = this.paramKeys[start:stop]
+        values = this.paramValues[start:stop].tolist()
+        (lo, hi) = numpy.searchsorted(this.exprIndex, (start, stop))
+        for (i, text) in zip(this.exprIndex[lo:hi].tolist(), this.exprText[lo:hi].tolist()):
+            values[i-start] = expression.compile_expression(str(text))
+
+        codes = this.codes
+        sourceFile = this.sourceFile
+        statements = []
+        i = 0
+        for (n, codeId, offset, count) in zip(range(first, last), this.codeIds[first:last].tolist(),
+                                              this.offsets[first:last].tolist(),
+                                              this.paramCounts[first:last].tolist()):
+            statement = Statement()
+            statement.code = codes[codeId]
+            statement.source = sourceFile
+            statement.offset = offset
+            statement.lineNumber = n
+            statement.params = dict(zip(keys[i:i+count], values[i:i+count]))
+            i += count
+            if (statement.code == "="):
+                statement.args = (this._get_name(n), statement.params.pop("="))
+            statements.append(statement)
+        this._blocks[block] = statements
+        return statements
+
+    def _get_name(this, n):
+        if (this._nameIndex is None):
+            assign = (this.codeIds == this.codes.index("="))
+            this._nameIndex = numpy.cumsum(assign) - 1
+        return this.names[this._nameIndex[n]]
+
+# A G-code file that statement text is read back from. The file is memory mapped
+# the first time a line is requested.
+class SourceFile(object):
+    path = None
+
+    def __init__(this, path):
+        this.path = path
+        this._data = None
+
+    # Returns the line of text starting at the given file offset
+    def read_line(this, offset):
+        if (this._data is None):
+            fd = open(this.path, "rb")
+            try:
+                this._data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                fd.close()
+        end = this._data.find(b"\n", offset)
+        if (end < 0):
+            end = len(this._data)
+        return this._data[offset:end].decode("utf-8", "replace")
+
+    def close(this):
+        if (this._data is not None):
+            this._data.close()
+            this._data = None
 
 # A path plotting out by the cutting head
 class Path(object):
+    # The position of this path in the job, counting any rows its PathTable has
+    # discarded (or -1 if not part of a table)
+    index = -1
+    # The tool loaded when tracing this path
+    tool = 0
     # Whether the spindle is on/off when tracing this path
     spindleOn = False
     # The statement that generated this path
@@ -252,10 +900,14 @@ class Arc(Path):
         if (this.angle1 < 0): this.angle1 += 2*math.pi
         if (this.angle2 < 0): this.angle2 += 2*math.pi
 
-        diff = abs(this.angle1-this.angle2)
-        if (diff > math.pi): 
-            diff = 2*math.pi - diff
-        this.length = this.radius * diff
+        # The angle swept in the direction of travel (see tessellate.arc_sweep)
+        if (clockwise):
+            sweep = (this.angle1-this.angle2) % (2*math.pi)
+        else:
+            sweep = (this.angle2-this.angle1) % (2*math.pi)
+        if (sweep == 0):
+            sweep = 2*math.pi
+        this.length = this.radius * sweep
         this.duration = this.length/float(this.feedRate)
 
     def __repr__(this):
@@ -274,65 +926,633 @@ class Dwell(Path):
     def __repr__(this):
         return this.__class__.__name__ + '()'
 
+# Columnar storage for the paths generated by a State. New rows are queued up as
+# plain tuples and moved into a structured NumPy array (see PATH_DTYPE) a chunk at
+# a time, which is when their lengths, durations and start times are calculated
+# in bulk. Indexing or iterating over the table returns Path objects created on
+# demand, so code written against Line/Arc/etc keeps working.
+class PathTable(object):
+    # How many rows are queued up before being moved into the array
+    CHUNK_SIZE = 4096
+    # How many rows at a time extend_array checks for changes in the lookup index
+    INDEX_CHECK = 256
+    # The program statements referenced by the rows (optional)
+    statements = None
+    # Whether rows are kept after being flushed. If not, the table only tracks
+    # the job totals (see State.run_stream).
+    keepRows = True
+    # Called with a Path object for each row as it is flushed (optional)
+    callback = None
+    # The total distance travelled with the spindle on, and by rapid moves
+    cutLength = 0
+    rapidLength = 0
+    # The machine limits used to work out how long each move takes (see
+    # gsim.motion). If not set, moves simply run at their programmed feed rate.
+    profile = None
+    # The number of mm per machine unit, used when planning the moves
+    unitScale = UNIT_SCALE["in"]
+    # For a simplified table, the index of the first row of the original table
+    # merged into each row (see simplified)
+    sourceRows = None
+
+    def __init__(this, statements=None):
+        this.statements = statements
+        # The arcs turned into polylines (see get_arcs)
+        this._arcCache = tessellate.ArcCache()
+        # The spatial index over the rows (see get_spatial_index)
+        this._spatialIndex = None
+        # The levels of detail used when zoomed out (see get_detail_level)
+        this._detail = lod.Pyramid()
+        this._data = numpy.zeros(0, dtype=PATH_DTYPE)
+        this._size = 0
+        this._pending = []
+        this._endTime = 0.0
+        # The number of rows that were flushed but not kept
+        this._discarded = 0
+        # The last rows planned (see flush), whose timing may still change once
+        # the rows after them are known, along with the speed going into them and
+        # the time they start
+        this._tail = numpy.zeros(0, dtype=PATH_DTYPE)
+        this._tailSpeed = 0.0
+        this._tailTime = 0.0
+        # Contiguous copies of the end time and statement columns, used for
+        # lookups (see _update_index)
+        this._endTimes = numpy.zeros(0)
+        this._lines = numpy.zeros(0, dtype=numpy.int64)
+        this._indexSize = 0
+        # The bounds of the paths grouped by (tool, spindleOn), as a dict of
+        # [xmin, ymin, xmax, ymax] arrays. They cover the first _boundsSize rows
+        # (plus any discarded rows).
+        this._bounds = {}
+        this._boundsSize = 0
+
+    def __len__(this):
+        this.flush()
+        return this._size
+
+    def __getitem__(this, n):
+        if (isinstance(n, slice)):
+            return list(this.iter_paths(*n.indices(len(this))[:2]))
+        size = len(this)
+        if (n < 0):
+            n += size
+        if (n < 0 or n >= size):
+            raise IndexError("path index out of range")
+        return this._make_path(this._data[n], n+this._discarded)
+
+    def __iter__(this):
+        return this.iter_paths()
+
+    # Returns the (flushed) rows as a structured array
+    @property
+    def array(this):
+        this.flush()
+        return this._data[:this._size]
+
+    # Replaces the contents of the table with the given rows, which must already
+    # have their geometry and timing filled in (eg a table loaded from the cache)
+    def set_array(this, data):
+        this._data = data
+        this._size = len(data)
+        this._pending = []
+        this._discarded = 0
+        this._indexSize = 0
+        this._bounds = {}
+        this._boundsSize = 0
+        this._arcCache.clear()
+        this._spatialIndex = None
+        this._detail.clear()
+        if (len(data)):
+            this._endTime = float(data["startTime"][-1] + data["duration"][-1])
+        else:
+            this._endTime = 0.0
+        this._reset_tail()
+
+    # Like set_array, but for rows that start with the ones already in the table (eg
+    # the rows of another table that has grown since they were last copied). The
+    # arcs, spatial index and levels of detail are kept, since they only need
+    # extending to cover the new rows.
+    def extend_array(this, data):
+        this._indexSize = this._get_unchanged_index(data)
+        this._data = data
+        this._size = len(data)
+        this._pending = []
+        if (len(data)):
+            this._endTime = float(data["startTime"][-1] + data["duration"][-1])
+        else:
+            this._endTime = 0.0
+        this._reset_tail()
+
+    # Works out the timing of all the rows again, eg for a table simulated with a
+    # different machine profile (or none)
+    def replan(this):
+        this.flush()
+        if (not this._size):
+            return
+        data = this._data[:this._size]
+        if (this.profile):
+            (duration, settled, speed) = motion.plan_batch(data, this.profile, this.unitScale)
+        else:
+            duration = numpy.array(data["duration"])
+            moves = (data["kind"] == PATH_LINE) | (data["kind"] == PATH_ARC)
+            duration[moves] = data["length"][moves] / data["feedRate"][moves]
+            (settled, speed) = (len(data), 0.0)
+        ends = numpy.cumsum(duration) + float(data["startTime"][0])
+        data["duration"] = duration
+        data["startTime"] = ends - duration
+        this._endTime = float(ends[-1])
+        this._indexSize = 0
+        this._tail = data[settled:].copy()
+        this._tailSpeed = speed
+        this._tailTime = float(data["startTime"][settled]) if (settled < len(data)) else this._endTime
+
+    # Forgets the rows waiting to be planned along with the next batch, so the
+    # next row added starts from rest
+    def _reset_tail(this):
+        this._tail = numpy.zeros(0, dtype=PATH_DTYPE)
+        this._tailSpeed = 0.0
+        this._tailTime = this._endTime
+
+    # Returns the arcs in the table as polylines that stay within the given tolerance
+    # of the true arcs (a gsim.tessellate.Tessellation). These are cached for the
+    # last few tolerances used.
+    def get_arcs(this, tolerance):
+        return this._arcCache.get(this.array, tolerance)
+
+    # Returns the points of the arc at the given index as a polyline (see get_arcs)
+    def get_arc_points(this, n, tolerance):
+        return this.get_arcs(tolerance).get_points(n)
+
+    # Returns a spatial index over the rows (a gsim.spatial.GridIndex). As the table
+    # grows the index is only rebuilt once the rows added since make up a good
+    # fraction of the table, so it may not cover the last few rows.
+    def get_spatial_index(this):
+        size = len(this)
+        index = this._spatialIndex
+        if (index is None or size-index.size > max(this.CHUNK_SIZE, index.size//8)):
+            index = this._spatialIndex = spatial.GridIndex(path_extents(this.array))
+        return index
+
+    # Returns a level of detail for drawing the table with cells of (at most) the
+    # given size, eg a pixel (a gsim.lod.Level), or None if the cells are too small
+    # for that to help. Like the spatial index, the level may not cover the last
+    # few rows.
+    def get_detail_level(this, cellSize):
+        return this._detail.get_level(this.array, cellSize)
+
+    # Returns the (sorted) indices of the paths whose bounding boxes overlap the
+    # given rectangle. If a range of rows is given only those are searched, and a
+    # short range is checked directly rather than through the spatial index.
+    def find_in_rect(this, xmin, ymin, xmax, ymax, start=0, stop=None):
+        size = len(this)
+        if (stop is None or stop > size):
+            stop = size
+        if (start > 0 or stop < size):
+            if (stop-start < this.CHUNK_SIZE):
+                extents = path_extents(this._data[start:stop])
+                return numpy.flatnonzero(spatial.overlaps(extents, xmin, ymin, xmax, ymax)) + start
+            found = this.find_in_rect(xmin, ymin, xmax, ymax)
+            return found[(found >= start) & (found < stop)]
+
+        index = this.get_spatial_index()
+        found = index.query(xmin, ymin, xmax, ymax)
+        if (index.size < this._size):
+            # Check the rows added since the index was built one by one
+            extents = path_extents(this._data[index.size:this._size])
+            rest = numpy.flatnonzero(spatial.overlaps(extents, xmin, ymin, xmax, ymax))
+            found = numpy.concatenate((found, rest + index.size))
+        return found
+
+    # Returns the index of the path closest to the given point, or -1 if there are
+    # none within 'radius' of it
+    def find_nearest(this, pos, radius):
+        (x, y) = pos
+        found = this.find_in_rect(x-radius, y-radius, x+radius, y+radius)
+        if (not len(found)):
+            return -1
+        dist = spatial.distance_to_paths(this._data[found], (x, y))
+        n = numpy.argmin(dist)
+        if (dist[n] > radius):
+            return -1
+        return int(found[n])
+
+    # Returns a simplified copy of the table, where runs of lines are merged into
+    # fewer lines within the given tolerance of the original path (see
+    # gsim.simplify). Timing and statements are kept, and 'sourceRows' in the new
+    # table gives the index of the first original row behind each of its rows.
+    def simplified(this, tolerance):
+        (rows, first) = simplify.simplify_rows(this.array, tolerance)
+        table = PathTable(this.statements)
+        table.set_array(rows)
+        table.sourceRows = first + this._discarded
+        table.cutLength = this.cutLength
+        table.rapidLength = this.rapidLength
+        table.profile = this.profile
+        table.unitScale = this.unitScale
+        return table
+
+    # Starts an empty table part way through a job, as if 'count' rows (which end at
+    # 'endTime') had already been added and discarded. If given, 'tail' (see
+    # get_tail) holds the last of those rows, whose timing could still change.
+    # They are put back in the table so they're planned along with the rows that
+    # follow, just as they would have been without stopping there.
+    def set_offset(this, count, endTime, cutLength, rapidLength, tail=None):
+        if (tail is None):
+            tail = (numpy.zeros(0, dtype=PATH_DTYPE), 0.0, endTime)
+        (rows, speed, tailTime) = tail
+        this.set_array(rows.copy())
+        this._discarded = count - len(rows)
+        if (not len(rows)):
+            this._endTime = endTime
+        this._tail = rows.copy()
+        this._tailSpeed = speed
+        this._tailTime = tailTime
+        this.cutLength = cutLength
+        this.rapidLength = rapidLength
+
+    # Returns the rows whose timing could still change (see flush), along with the
+    # speed going into them and the time they start, so that planning can carry on
+    # from this point later (see set_offset)
+    def get_tail(this):
+        this.flush()
+        return (this._tail.copy(), this._tailSpeed, this._tailTime)
+
+    # Returns the time at which the last path finishes
+    def get_end_time(this):
+        this.flush()
+        return this._endTime
+
+    # Returns the (minPos, maxPos) bounds of the paths as a pair of arrays, or None if
+    # there are no paths. The paths can be limited to those cut with a particular
+    # tool and/or with the spindle on or off.
+    def get_bounds(this, spindleOn=None, tool=None):
+        this._update_bounds()
+        box = None
+        for ((groupTool, groupSpindle), groupBox) in this._bounds.items():
+            if (tool is not None and groupTool != tool):
+                continue
+            if (spindleOn is not None and groupSpindle != spindleOn):
+                continue
+            if (box is None):
+                box = groupBox.copy()
+            else:
+                box[:2] = numpy.minimum(box[:2], groupBox[:2])
+                box[2:] = numpy.maximum(box[2:], groupBox[2:])
+        if (box is None):
+            return None
+        return (box[:2], box[2:])
+
+    # Returns the tools used by the paths in the table
+    def get_tools(this):
+        this._update_bounds()
+        return sorted(set(tool for (tool, spindleOn) in this._bounds))
+
+    # Extends the bounds to cover any rows added since the last call
+    def _update_bounds(this):
+        this.flush()
+        if (this._boundsSize < this._size):
+            this._add_bounds(this._data[this._boundsSize:this._size])
+            this._boundsSize = this._size
+
+    # Merges the extents of the given rows into the bounds, in one vectorized pass
+    # per (tool, spindleOn) group
+    def _add_bounds(this, rows):
+        if (not len(rows)):
+            return
+        extents = path_extents(rows)
+        # Combine tool and spindle state into a single group number
+        groups = rows["tool"].astype(numpy.int64)*2 + rows["spindleOn"]
+        for group in numpy.unique(groups):
+            match = extents[groups == group]
+            box = numpy.concatenate((match[:,:2].min(axis=0), match[:,2:].max(axis=0)))
+            key = (int(group >> 1), bool(group & 1))
+            old = this._bounds.get(key)
+            if (old is not None):
+                box[:2] = numpy.minimum(box[:2], old[:2])
+                box[2:] = numpy.maximum(box[2:], old[2:])
+            this._bounds[key] = box
+
+    # Returns the index of the path being traced at the given time (the first path
+    # which hasn't finished by then), or the last path if the job is over. Returns
+    # -1 if the table is empty.
+    def find_time(this, tm):
+        this._update_index()
+        if (not this._size):
+            return -1
+        n = int(numpy.searchsorted(this._endTimes[:this._size], tm, side="right"))
+        return min(n, this._size-1)
+
+    # Returns the index of the first path generated by the given statement, or by
+    # a later one if that statement didn't generate any paths. Returns the number
+    # of rows if there are no such paths.
+    def find_statement(this, lineno):
+        this._update_index()
+        return int(numpy.searchsorted(this._lines[:this._size], lineno, side="left"))
+
+    # Returns the line number of the statement that generated the given path
+    def get_statement_index(this, n):
+        return int(this.array["statement"][n])
+
+    # Brings the lookup arrays up to date with the table. Rows are only ever added
+    # at the end, so only the new rows need to be indexed.
+    def _update_index(this):
+        this.flush()
+        first = this._indexSize
+        size = this._size
+        if (first == size):
+            return
+        if (len(this._endTimes) < size):
+            capacity = max(size, 2*len(this._endTimes))
+            endTimes = numpy.zeros(capacity)
+            endTimes[:first] = this._endTimes[:first]
+            lines = numpy.zeros(capacity, dtype=numpy.int64)
+            lines[:first] = this._lines[:first]
+            this._endTimes = endTimes
+            this._lines = lines
+        rows = this._data[first:size]
+        this._endTimes[first:size] = rows["startTime"] + rows["duration"]
+        this._lines[first:size] = rows["statement"]
+        this._indexSize = size
+
+    # Returns how many rows at the start of the lookup index still hold for the given
+    # rows, which start with the ones indexed. Only the last rows of a table are
+    # planned again as it grows (see flush), so the index is checked a block at
+    # a time working back from its end, until a block is found that hasn't changed.
+    def _get_unchanged_index(this, data):
+        end = min(this._indexSize, len(data))
+        while (end > 0):
+            start = max(end-this.INDEX_CHECK, 0)
+            rows = data[start:end]
+            if ((rows["startTime"] + rows["duration"] == this._endTimes[start:end]).all()):
+                break
+            end = start
+        return end
+
+    # Generates path objects for the rows in the given range
+    def iter_paths(this, start=0, stop=None):
+        data = this.array
+        if (stop is None):
+            stop = len(data)
+        for n in range(start, stop):
+            yield this._make_path(data[n], n+this._discarded)
+
+    def add_line(this, start, end, feedRate, spindleOn, rapid, statement=-1, tool=0):
+        this._pending.append((PATH_LINE, start, end, (0, 0), 0, 0, 0, 0, feedRate,
+                              0, 0, spindleOn, rapid, False, statement, tool))
+        if (len(this._pending) >= this.CHUNK_SIZE):
+            this.flush()
+
+    def add_arc(this, start, end, center, feedRate, clockwise, spindleOn, statement=-1, tool=0):
+        this._pending.append((PATH_ARC, start, end, center, 0, 0, 0, 0, feedRate,
+                              0, 0, spindleOn, False, clockwise, statement, tool))
+        if (len(this._pending) >= this.CHUNK_SIZE):
+            this.flush()
+
+    # Adds a path that doesn't move the head but takes time (tool change, dwell)
+    def add_pause(this, kind, pos, duration, statement=-1, tool=0):
+        this._pending.append((kind, pos, pos, (0, 0), 0, 0, 0, 0, 1,
+                              0, duration, False, False, False, statement, tool))
+        if (len(this._pending) >= this.CHUNK_SIZE):
+            this.flush()
+
+    # Moves the queued rows into the table, computing their geometry and timing
+    def flush(this):
+        if (not this._pending):
+            return
+        rows = numpy.array(this._pending, dtype=PATH_DTYPE)
+        this._pending = []
+
+        kind = rows["kind"]
+        start = rows["start"]
+        end = rows["end"]
+        length = rows["length"]
+
+        lines = (kind == PATH_LINE)
+        delta = end[lines] - start[lines]
+        length[lines] = numpy.hypot(delta[:,0], delta[:,1])
+
+        arcs = (kind == PATH_ARC)
+        if (arcs.any()):
+            center = rows["center"][arcs]
+            u = start[arcs] - center
+            v = end[arcs] - center
+            radius = numpy.hypot(u[:,0], u[:,1])
+            angle1 = numpy.arctan2(u[:,1], u[:,0]) % (2*math.pi)
+            angle2 = numpy.arctan2(v[:,1], v[:,0]) % (2*math.pi)
+            rows["radius"][arcs] = radius
+            rows["angle1"][arcs] = angle1
+            rows["angle2"][arcs] = angle2
+            length[arcs] = radius*arc_sweep(rows[arcs])
+
+        moves = lines | arcs
+        tail = this._tail
+        if (this.profile):
+            # The last rows of the previous batch were planned as if the job ended
+            # there, so they're planned again along with the new rows. Only the
+            # rows far enough from the end are final (see motion.plan_batch), the
+            # rest are kept back for the next batch.
+            planned = numpy.concatenate((tail, rows))
+            (duration, settled, speed) = motion.plan_batch(
+                planned, this.profile, this.unitScale, this._tailSpeed)
+            ends = numpy.cumsum(duration) + this._tailTime
+            planned["duration"] = duration
+            planned["startTime"] = ends - duration
+            rows = planned[len(tail):]
+            if (settled):
+                this._tailTime = float(ends[settled-1])
+            this._tail = planned[settled:].copy()
+            this._tailSpeed = speed
+        else:
+            # Lay the new paths out end to end on the job timeline
+            duration = rows["duration"]
+            duration[moves] = length[moves] / rows["feedRate"][moves]
+            ends = numpy.cumsum(duration) + this._endTime
+            rows["startTime"] = ends - duration
+            this._tailTime = float(ends[-1])
+            (planned, settled) = (rows, len(rows))
+        this._endTime = float(ends[-1])
+
+        this.cutLength += float(length[rows["spindleOn"]].sum())
+        this.rapidLength += float(length[lines & rows["rapid"]].sum())
+
+        first = this._size + this._discarded
+        if (this.keepRows):
+            if (len(tail)):
+                # Update the timing of the rows planned again
+                tailStart = this._size - len(tail)
+                old = this._data[tailStart:this._size]
+                old["duration"] = planned["duration"][:len(tail)]
+                old["startTime"] = planned["startTime"][:len(tail)]
+                this._indexSize = min(this._indexSize, tailStart)
+            if (this._boundsSize == this._size):
+                # Account for the rows now while they're at hand
+                this._add_bounds(rows)
+                this._boundsSize += len(rows)
+            size = this._size + len(rows)
+            if (size > len(this._data)):
+                # Grow the array geometrically so appending stays cheap
+                data = numpy.zeros(max(size, 2*len(this._data), this.CHUNK_SIZE), dtype=PATH_DTYPE)
+                data[:this._size] = this._data[:this._size]
+                this._data = data
+            this._data[this._size:size] = rows
+            this._size = size
+        else:
+            this._add_bounds(rows)
+            this._discarded += len(rows)
+
+        if (this.callback):
+            # Only pass on the rows whose timing is final, the rest follow with the
+            # next batch (or from settle)
+            first -= len(tail)
+            for n in range(settled):
+                this.callback(this._make_path(planned[n], first+n))
+
+    # Passes the rows kept back for planning with the next batch (see flush) on to
+    # the callback, once there are no more rows to come
+    def settle(this):
+        this.flush()
+        tail = this._tail
+        if (this.callback):
+            first = this._size + this._discarded - len(tail)
+            for n in range(len(tail)):
+                this.callback(this._make_path(tail[n], first+n))
+        this._reset_tail()
+
+    # Creates a path object from a row of the table
+    def _make_path(this, row, index):
+        kind = row["kind"]
+        if (kind == PATH_LINE):
+            path = Line.__new__(Line)
+            path.start = numpy.array(row["start"])
+            path.end = numpy.array(row["end"])
+            path.rapid = bool(row["rapid"])
+        elif (kind == PATH_ARC):
+            path = Arc.__new__(Arc)
+            path.start = numpy.array(row["start"])
+            path.end = numpy.array(row["end"])
+            path.center = numpy.array(row["center"])
+            path.radius = float(row["radius"])
+            path.angle1 = float(row["angle1"])
+            path.angle2 = float(row["angle2"])
+            path.clockwise = bool(row["clockwise"])
+        elif (kind == PATH_TOOL_CHANGE):
+            path = ToolChange()
+        else:
+            path = Dwell()
+        path.index = index
+        path.tool = int(row["tool"])
+        path.spindleOn = bool(row["spindleOn"])
+        path.length = float(row["length"])
+        path.feedRate = float(row["feedRate"])
+        path.startTime = float(row["startTime"])
+        path.duration = float(row["duration"])
+        lineno = row["statement"]
+        if (this.statements is not None and lineno >= 0):
+            path.statement = this.statements[lineno]
+        return path
+
 class State(object):
+    # The program parameters, keyed by number (eg 5 for "#5") or by lower case
+    # name for named parameters
     variables = None
     lineno = 0
     finished = False
     program = None
     # In units per second
     feedRate = 1
-    time = 0
-    minPos = None
-    maxPos = None
     pos = None
+    # The tool currently loaded, and the one selected for the next tool change
+    tool = 0
+    nextTool = 0
     spindleOn = True
-    # The paths cut by the laser
+    # The paths cut by the laser (a PathTable)
     paths = None
     # The units are inches by default
     units = "in"
     rapidSpeed = RAPID_SPEED_MM/25.4
     # The list of not-implemented codes in this program
     unknownCodes = None
-
-    def __init__(this, program):
+    # Maps codes to their handlers (see handle_statement)
+    handlers = None
+    # How often keyframes are recorded (see Program.state_at), set to None to
+    # turn them off
+    keyframeLines = KEYFRAME_LINES
+    keyframeTime = KEYFRAME_TIME
+    # Whether this state was restored from a keyframe or loaded from the cache,
+    # rather than having run from the start of the program
+    resumed = False
+    # Records where the time goes, if set (see gsim.profiler.Profiler.attach)
+    profiler = None
+
+    def __init__(this, program=None, profile=None):
         this.variables = {}
         this.program = program
-        this.paths = []
+        if (program):
+            this.paths = PathTable(program.statements)
+            if (profile is None):
+                profile = program.profile
+        else:
+            this.paths = PathTable()
+        this.paths.profile = profile
         # Note it is important to pass floats to make this a float array (otherwise it uses ints)
         this.pos = numpy.array([0.0, 0.0])
         this.unknownCodes = []
 
-    # Returns the length of the job
+    # The (minPos, maxPos) bounds of the job, including arc extents, or None if
+    # nothing has been cut yet. The bounds only cover the paths in the table, so
+    # arcs made with the spindle off (which aren't drawn, see handle_arc) are left
+    # out, apart from their end point where another move starts from it.
+    @property
+    def bounds(this):
+        return this.paths.get_bounds()
+
+    @property
+    def minPos(this):
+        bounds = this.paths.get_bounds()
+        if (bounds is None):
+            return None
+        return bounds[0]
+
+    @property
+    def maxPos(this):
+        bounds = this.paths.get_bounds()
+        if (bounds is None):
+            return None
+        return bounds[1]
+
+    # Returns the bounds of the paths cut with the given tool (see PathTable.get_bounds)
+    def get_tool_bounds(this, tool):
+        return this.paths.get_bounds(tool=tool)
+
+    # Returns the bounds of the paths traced with the spindle on (or off)
+    def get_spindle_bounds(this, spindleOn=True):
+        return this.paths.get_bounds(spindleOn=spindleOn)
+
+    # Returns the length of the job (or of the part simulated so far, if the program
+    # hasn't finished running)
     def get_run_length(this):
-        total = 0
-        for path in this.paths:
-            total += path.duration
-        return total
-
+        return this.paths.get_end_time()
+
+    # The current time in the job timeline
+    @property
+    def time(this):
+        return this.paths.get_end_time()
+
+    # The total distance travelled with the spindle on
+    @property
+    def cutLength(this):
+        this.paths.flush()
+        return this.paths.cutLength
+
+    # The total distance travelled by rapid moves
+    @property
+    def rapidLength(this):
+        this.paths.flush()
+        return this.paths.rapidLength
+
+    # Evaluates an expression, given as text or as compiled by the parser
     def eval_expression(this, exp):
-        if (exp.startswith("[")):
-            # Calculated value
-            exp = exp[1:-1]
-
-        if (not exp): 
-            return 0
-
-        for op in ("*", "/", "+", "-"):
-            try:
-                i = exp.index(op)
-            except ValueError:
-                pass
-            else:
-                (left, right) = (exp[:i], exp[i+1:])
-                left = this.eval_expression(left)
-                right = this.eval_expression(right)
-                func = OPERATIONS[op]
-                return func(left, right)
-
-        if (exp.startswith("#")):
-            return this.variables[exp]
-
-        return float(exp)
+        return expression.evaluate(exp, this.variables)
 
     def eval_coords(this, args):
         lst = {}
@@ -342,153 +1562,136 @@ class State(object):
 
     def eval_params(this, params):
         lst = {}
-        for key in params:
-            lst[key] = this.eval_expression(params[key])
+        variables = this.variables
+        for key, exp in params.items():
+            if (exp.__class__ is float):
+                lst[key] = exp
+            else:
+                lst[key] = exp.evaluate(variables)
         return lst
 
+    # Executes a statement by looking up its handler in 'handlers'. Codes that take
+    # a number (like "F300" or "T2") are looked up by their letter if there is no
+    # handler for the whole code.
     def handle_statement(this, st):
-        if (st.code == ""):
-            # Noop
+        handler = this.handlers.get(st.code)
+        if (handler is None):
+            handler = this.handlers.get(st.code[:1], State.handle_unknown)
+        handler(this, st)
+
+    # Adds (or replaces) the handler for a code, for this state only. The handler
+    # is called with the state and the statement to execute.
+    def register_handler(this, code, handler):
+        if (this.handlers is HANDLERS):
+            this.handlers = dict(HANDLERS)
+        this.handlers[code] = handler
+
+    def handle_noop(this, st):
+        pass
+
+    # Variable assignment
+    def handle_assignment(this, st):
+        (name, exp) = st.args
+        this.variables[name] = this.eval_expression(exp)
+
+    # Linear interpolation / rapid positioning
+    def handle_linear(this, st):
+        params = this.eval_params(st.params)
+        try:
+            # The feed rate is supplied per minute
+            this.feedRate = params["F"]/60.0
+        except KeyError:
             pass
 
-        elif (st.code == "%"):
-            pass
+        if (this.pos is None):
+            # Use this move to define the starting position
+            this.pos = numpy.array([params["X"], params["Y"]])
+            return
 
-        elif (st.code == "="):
-            # Variable assignment
-            (name, exp) = st.args
-            this.variables[name] = this.eval_expression(exp)
+        if ("X" in params or "Y" in params):
+            newpos = numpy.array([params.get("X", this.pos[0]), params.get("Y", this.pos[1])])
 
-        elif (st.code == "G01" or st.code == "G00"):
-            # Linear interpolation / rapid positioning
-            params = this.eval_params(st.params)
-            try:
-                # The feed rate is supplied per minute
-                this.feedRate = params["F"]/60.0
-            except KeyError:
-                pass
-
-            if (this.pos is None):
-                # Use this move to define the starting position
-                this.pos = numpy.array([params["X"], params["Y"]])
-                return
-
-            if ("X" in params or "Y" in params):
-                newpos = this.pos.copy()
-                try:
-                    newpos[0] = params["X"]
-                except KeyError:
-                    pass
-                try:
-                    newpos[1] = params["Y"]
-                except KeyError:
-                    pass
-
-                if (this.spindleOn):
-                    # The spindle is on, move at the feed rate
-                    feedRate = this.feedRate
-                else:
-                    # Otherwise move at the jog rate
-                    feedRate = this.rapidSpeed
-
-                # Create a line connecting our position to the target position
-                line = Line(this.pos, newpos, feedRate)
-                line.startTime = this.time
-                line.spindleOn = this.spindleOn
-                line.rapid = (st.code == "G00")
-                line.cmd = (params["X"], params["Y"])
-                line.statement = st
-                this.paths.append(line)
-                # Advance the timeline
-                this.time += line.duration
-                # Jump to the end position
-                this.pos = newpos.copy()
-
-        elif (st.code == "G02" or st.code == "G03"):
-            # Circle interpolation, clockwise or couter-clockwise
-            params = this.eval_params(st.params)
+            if (this.spindleOn):
+                # The spindle is on, move at the feed rate
+                feedRate = this.feedRate
+            else:
+                # Otherwise move at the jog rate
+                feedRate = this.rapidSpeed
 
-            try:
-                # The feed rate is supplied per minute
-                this.feedRate = params["F"]/60.0
-            except KeyError:
-                pass
+            # Create a line connecting our position to the target position
+            this.paths.add_line(
+                (this.pos[0], this.pos[1]), (newpos[0], newpos[1]), feedRate,
+                this.spindleOn, (st.code == "G00"), st.lineNumber, this.tool)
+            # Jump to the end position
+            this.pos = newpos
 
-            end = numpy.array([params["X"], params["Y"]])
+    # Circle interpolation, clockwise or couter-clockwise
+    def handle_arc(this, st):
+        params = this.eval_params(st.params)
 
-            if (this.spindleOn):
-                center = this.pos + numpy.array([params["I"], params["J"]])
+        try:
+            # The feed rate is supplied per minute
+            this.feedRate = params["F"]/60.0
+        except KeyError:
+            pass
 
-                arc = Arc(this.pos, end, center, this.feedRate, clockwise=(st.code=="G02"))
-                arc.startTime = this.time
-                arc.spindleOn = this.spindleOn
-                arc.statement = st
-                this.paths.append(arc)
-                # Advance the timeline
-                this.time += arc.duration
+        end = numpy.array([params["X"], params["Y"]])
 
-            this.pos = end.copy()
+        # With the spindle off the arc isn't recorded, only the move to its end
+        if (this.spindleOn):
+            center = (this.pos[0] + params["I"], this.pos[1] + params["J"])
 
-        elif (st.code == "M02"):
-            # End of program
-            this.finished = True
+            this.paths.add_arc(
+                (this.pos[0], this.pos[1]), (end[0], end[1]), center,
+                this.feedRate, (st.code == "G02"), this.spindleOn, st.lineNumber, this.tool)
 
-        elif (st.code == "M03"):
-            this.spindleOn = True
+        this.pos = end
 
-        elif (st.code == "M05"):
-            this.spindleOn = False
+    # End of program
+    def handle_end(this, st):
+        this.finished = True
 
-        elif (st.code == "G96"):
-            # Constant surface speed
-            pass
+    def handle_spindle_on(this, st):
+        this.spindleOn = True
 
-        elif (st.code == "G21"):
-            # Programming in mm
-            this.units = "mm"
-            this.rapidSpeed = RAPID_SPEED_MM
+    def handle_spindle_off(this, st):
+        this.spindleOn = False
 
-        elif (st.code == "G90"):
-            print("G90: absolute distance mode")
+    # Programming in mm
+    def handle_units_mm(this, st):
+        this.units = "mm"
+        this.paths.unitScale = UNIT_SCALE["mm"]
+        this.rapidSpeed = RAPID_SPEED_MM
 
-        elif (st.code == "G17"):
-            # Define the XY plane
-            pass
+    def handle_absolute(this, st):
+        print("G90: absolute distance mode")
 
-        elif (st.code.startswith("F")):
-            # Feed rate definition
-            rate = this.eval_expression(st.code[1:])
-            this.feedRate = float(rate)
-
-        elif (st.code == "M06"):
-            # Tool change operation
-            change = ToolChange()
-            change.duration = 3
-            change.startTime = this.time
-            change.statement = st
-            this.paths.append(change)
-            this.time += change.duration
-
-        elif (st.code.startswith("T")):
-            # Tool selection operation
-            pass
+    # Feed rate definition
+    def handle_feed_rate(this, st):
+        this.feedRate = this.eval_params(st.params)["F"]
 
-        elif (st.code == "G04"):
-            # Dwell operation
-            params = this.eval_params(st.params)
-            dwell = Dwell()
-            dwell.startTime = this.time
-            dwell.statement = st
-            dwell.duration = params.get("P", 0)
-            this.paths.append(dwell)
-            this.time += dwell.duration
+    # Tool selection, the tool is loaded by the next tool change
+    def handle_tool_select(this, st):
+        this.nextTool = int(this.eval_params(st.params)["T"])
 
-        else:
+    # Tool change operation
+    def handle_tool_change(this, st):
+        this.tool = this.nextTool
+        this.paths.add_pause(PATH_TOOL_CHANGE, (this.pos[0], this.pos[1]), 3, st.lineNumber, this.tool)
+
+    # Dwell operation
+    def handle_dwell(this, st):
+        params = this.eval_params(st.params)
+        this.paths.add_pause(PATH_DWELL, (this.pos[0], this.pos[1]), params.get("P", 0), st.lineNumber, this.tool)
+
+    def handle_unknown(this, st):
+        if (not st.code in this.unknownCodes):
             print("Unknown code: %s" % st.code)
-            if (not st.code in this.unknownCodes):
-                this.unknownCodes.append(st.code)
+            this.unknownCodes.append(st.code)
 
     def step(this):
+        if (this.finished):
+            return
         # Execute the current statement
         st = this.program.statements[this.lineno]
         this.handle_statement(st)
@@ -499,45 +1702,238 @@ class State(object):
         if (this.lineno >= len(this.program.statements)):
             this.finished = True
 
-        if (this.pos is None):
+        if (this.finished):
+            this.on_finished()
+        elif (this.lineno % KEYFRAME_CHECK == 0):
+            this.check_keyframe()
+
+    # Runs the rest of the program in one go (or at most 'limit' statements of it).
+    # This is much faster than calling step() in a loop, since the statements are
+    # dispatched from a tight loop.
+    def run(this, limit=None):
+        if (this.finished):
+            # Nothing after the end of the program is executed
             return
-
-        # Update the minimum pos
-        if (this.minPos is None):
-            this.minPos = this.pos.copy()
+        statements = this.program.statements
+        count = len(statements)
+        if (limit is not None):
+            count = min(count, this.lineno+limit)
+        handlers = this.handlers
+        unknown = State.handle_unknown
+
+        n = this.lineno
+        nextCheck = n - n%KEYFRAME_CHECK + KEYFRAME_CHECK
+        try:
+            while (n < count):
+                st = statements[n]
+                n += 1
+                handler = handlers.get(st.code)
+                if (handler is None):
+                    handler = handlers.get(st.code[:1], unknown)
+                handler(this, st)
+                if (this.finished):
+                    break
+                if (n >= nextCheck):
+                    this.lineno = n
+                    this.check_keyframe()
+                    nextCheck += KEYFRAME_CHECK
+        finally:
+            this.lineno = n
+
+        if (n >= len(statements)):
+            this.finished = True
+        if (this.finished):
+            this.on_finished()
+
+    # Simulates the program (if it hasn't been already) up to the statement 'lineno'.
+    # Together with ensure_time() this lets the program be run lazily, only as far
+    # as it's needed. Returns true if the statement has been reached.
+    def ensure_line(this, lineno):
+        if (this.lineno < lineno and not this.finished):
+            this.run(lineno-this.lineno)
+        return (this.lineno >= lineno)
+
+    # Simulates the program up to the given job time, ie until the path running at
+    # that time has been generated. Returns true if the program got that far.
+    def ensure_time(this, tm):
+        while (this.time <= tm and not this.finished):
+            this.run(LAZY_CHUNK)
+        return (this.time > tm)
+
+    # Called once the program has finished running
+    def on_finished(this):
+        this.paths.settle()
+        if (this.paths.profile and this.program and not this.resumed and not this.paths._discarded):
+            # The keyframes were recorded while the moves leading up to them could
+            # still change speed, so take their times from the finished plan
+            this.program.keyframes.update_times(this.paths)
+        if (this.program and this.program.cache and not this.resumed):
+            this.program.cache.store_state(this)
+
+    # Records a keyframe for the program if enough statements (or job time) have
+    # gone by since the last one
+    def check_keyframe(this):
+        if (this.keyframeLines is None or not this.program):
+            return
+        last = this.program.keyframes.get_last()
+        if (last is None):
+            (lastLine, lastTime) = (0, 0)
         else:
-            this.minPos[0] = min(this.pos[0], this.minPos[0])
-            this.minPos[1] = min(this.pos[1], this.minPos[1])
-        # Update the max position too
-        if (this.maxPos is None):
-            this.maxPos = this.pos.copy()
+            (lastLine, lastTime) = (last.lineno, last.time)
+        if (this.lineno <= lastLine):
+            # Somebody else has already been here
+            return
+        if (this.lineno-lastLine >= this.keyframeLines or this.time-lastTime >= this.keyframeTime):
+            this.program.keyframes.add(this.get_keyframe())
+
+    # Returns a snapshot of the current machine state
+    def get_keyframe(this):
+        frame = Keyframe()
+        frame.lineno = this.lineno
+        frame.time = this.time
+        frame.pathCount = len(this.paths) + this.paths._discarded
+        frame.cutLength = this.cutLength
+        frame.rapidLength = this.rapidLength
+        frame.pos = (float(this.pos[0]), float(this.pos[1]))
+        frame.feedRate = this.feedRate
+        frame.spindleOn = this.spindleOn
+        frame.units = this.units
+        frame.rapidSpeed = this.rapidSpeed
+        frame.tool = this.tool
+        frame.nextTool = this.nextTool
+        last = this.program.keyframes.get_last() if (this.program) else None
+        if (last is not None and last.variables == this.variables):
+            # Most programs only set their variables near the start, so share the
+            # last snapshot rather than copying them all again
+            frame.variables = last.variables
         else:
-            this.maxPos[0] = max(this.pos[0], this.maxPos[0])
-            this.maxPos[1] = max(this.pos[1], this.maxPos[1])
+            frame.variables = dict(this.variables)
+        frame.unknownCodes = list(this.unknownCodes)
+        frame.finished = this.finished
+        frame.tail = this.paths.get_tail()
+        return frame
+
+    # Puts this state back to the point where the given keyframe was recorded. Paths
+    # generated before then are not restored (see Program.state_at).
+    def restore(this, frame):
+        this.lineno = frame.lineno
+        this.pos = numpy.array(frame.pos)
+        this.feedRate = frame.feedRate
+        this.spindleOn = frame.spindleOn
+        this.units = frame.units
+        this.paths.unitScale = UNIT_SCALE[frame.units]
+        this.rapidSpeed = frame.rapidSpeed
+        this.tool = frame.tool
+        this.nextTool = frame.nextTool
+        this.variables = dict(frame.variables)
+        this.unknownCodes = list(frame.unknownCodes)
+        this.finished = frame.finished
+        this.paths.set_offset(frame.pathCount, frame.time, frame.cutLength, frame.rapidLength, frame.tail)
+        this.resumed = True
+
+    # Parse and simulate the given G-code file (a path or file object) in a single
+    # pass. Statements are discarded as soon as they are executed, and if keepPaths
+    # is false the generated paths are only passed to 'paths.callback' and counted
+    # in the job totals, so memory use stays bounded regardless of the input size.
+    def run_stream(this, source, keepPaths=True, invalidLines=None):
+        this.paths.keepRows = keepPaths
+        statements = iter_statements(source, invalidLines)
+        if (this.profiler):
+            statements = this.profiler.wrap_iter(statements, "parse")
+        for st in statements:
+            this.handle_statement(st)
+            this.lineno += 1
+            if (this.finished):
+                break
+        this.paths.settle()
+        this.finished = True
+
+# Maps each code to the State method that executes it (see State.handle_statement).
+# Use register_handler() to add support for other codes, eg custom M-codes.
+HANDLERS = {
+    "" : State.handle_noop,
+    "%" : State.handle_noop,
+    "=" : State.handle_assignment,
+    "G00" : State.handle_linear,
+    "G01" : State.handle_linear,
+    "G02" : State.handle_arc,
+    "G03" : State.handle_arc,
+    "G04" : State.handle_dwell,
+    # Define the XY plane
+    "G17" : State.handle_noop,
+    "G21" : State.handle_units_mm,
+    "G90" : State.handle_absolute,
+    # Constant surface speed
+    "G96" : State.handle_noop,
+    "M02" : State.handle_end,
+    "M03" : State.handle_spindle_on,
+    "M05" : State.handle_spindle_off,
+    "M06" : State.handle_tool_change,
+    "F" : State.handle_feed_rate,
+    "T" : State.handle_tool_select,
+}
+State.handlers = HANDLERS
+
+# Adds (or replaces) the handler for a code, for all states. The handler is called
+# with the state and the statement to execute.
+def register_handler(code, handler):
+    HANDLERS[code] = handler
 
 
 def dump_parse():
     """Command line function to print G-code from a file."""
-    import re
     import os
     import sys
+    import argparse
     from pprint import pprint
 
-    if len(sys.argv) != 2:
-        print('Please give path to G-code file.')
-        sys.exit(1)
-    path = sys.argv[1]
-    if not os.path.isfile(path):
+    parser = argparse.ArgumentParser(description="Print the paths traced by a G-code file.")
+    parser.add_argument("path", help="path to G-code file")
+    parser.add_argument("--stats", action="store_true",
+                        help="only print a summary of the job (run length, bounds, etc)")
+    parser.add_argument("--machine", metavar="PROFILE",
+                        help="estimate the run length using the machine limits in the "
+                        "given JSON file (see gsim.motion.MachineProfile)")
+    parser.add_argument("--profile", action="store_true",
+                        help="print a report of where the time was spent (as JSON, "
+                        "to stderr)")
+    args = parser.parse_args()
+    if not os.path.isfile(args.path):
         print('File does not exist.')
         sys.exit(1)
 
-    prog = parse_program(path)
-    state = prog.start()
-
-    while not state.finished:
-        state.step()
-
-    pprint(state.paths)
+    # The file is parsed and simulated in one pass, so neither the statements nor
+    # the paths are kept around.
+    profile = None
+    if args.machine:
+        profile = motion.MachineProfile.load(args.machine)
+    state = State(profile=profile)
+    if not args.stats:
+        state.paths.callback = pprint
+    profiler = None
+    if args.profile:
+        from gsim.profiler import Profiler
+        profiler = Profiler()
+        profiler.attach(state)
+    invalidLines = []
+    state.run_stream(args.path, keepPaths=False, invalidLines=invalidLines)
+
+    if args.stats:
+        print("statements:    %d" % state.lineno)
+        print("invalid lines: %d" % len(invalidLines))
+        print("units:         %s" % state.units)
+        print("run length:    %.2f s" % state.time)
+        print("cut length:    %.2f" % state.cutLength)
+        print("rapid length:  %.2f" % state.rapidLength)
+        if state.bounds is not None:
+            (minPos, maxPos) = state.bounds
+            print("bounds:        (%.2f, %.2f) - (%.2f, %.2f)" % (
+                minPos[0], minPos[1], maxPos[0], maxPos[1]))
+        if state.unknownCodes:
+            print("unknown codes: %s" % " ".join(state.unknownCodes))
+
+    if profiler:
+        profiler.dump(sys.stderr)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,224 @@
+# Python G-Code simulator
+#
+# Copyright (C) 2011 Peter Rogers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+# Levels of detail for drawing a big job zoomed out. When each pixel covers many
+# paths there's no point stroking them one at a time, so a level lays a grid of
+# cells (about a pixel in size) over the job and records which cells the paths
+# pass through. Drawing the level just means filling in those cells, so the cost
+# depends on the number of pixels covered rather than on the number of paths.
+#
+# For each cell the level keeps the index of the earliest cutting move and the
+# earliest rapid move passing through it, so the job can be drawn part way
+# through: a cell is filled once the first path through it has been cut.
+#
+# The cells are found by sampling points along every path at half a cell apart,
+# done in chunks with NumPy, and only the cells that are used are stored.
+
+from __future__ import absolute_import, division, print_function
+
+import math
+import collections
+import numpy
+
+from gsim.tessellate import arc_sweep
+
+###########
+# Globals #
+###########
+
+# Path kinds (these match the ones in gcode.py)
+PATH_LINE = 0
+PATH_ARC = 1
+
+# The most sample points used to build a level. Past this the cells are too
+# small for a level to be worth having (the job can't be very zoomed out).
+MAX_SAMPLES = 1 << 23
+
+# The number of sample points handled at once
+CHUNK_SAMPLES = 1 << 20
+
+#############
+# Functions #
+#############
+
+# Returns the length of each path in the given rows (zero for dwells and tool changes)
+def path_lengths(rows):
+    delta = rows["end"] - rows["start"]
+    length = numpy.hypot(delta[:,0], delta[:,1])
+    arcs = (rows["kind"] == PATH_ARC)
+    length[arcs] = rows["radius"][arcs]*arc_sweep(rows[arcs])
+    length[(rows["kind"] != PATH_LINE) & ~arcs] = 0
+    return length
+
+# Returns the (lower, upper) corners of a box around all the given rows. Arcs are
+# taken to be full circles, which is good enough here.
+def _bounds(rows):
+    points = [rows["start"], rows["end"]]
+    arcs = (rows["kind"] == PATH_ARC)
+    if (arcs.any()):
+        radius = rows["radius"][arcs][:,None]
+        points += [rows["center"][arcs]-radius, rows["center"][arcs]+radius]
+    points = numpy.concatenate(points)
+    return (points.min(axis=0), points.max(axis=0))
+
+# Returns points sampled along the given rows, 'counts' of them for each row
+# (spread evenly from the start to the end), along with the row of each point
+def sample_paths(rows, counts):
+    row = numpy.repeat(numpy.arange(len(rows)), counts)
+    offsets = numpy.cumsum(counts)-counts
+    param = (numpy.arange(len(row)) - offsets[row]) / numpy.maximum(counts-1, 1)[row]
+
+    start = rows["start"][row]
+    points = start + (rows["end"][row]-start)*param[:,None]
+    arcs = numpy.flatnonzero(rows["kind"][row] == PATH_ARC)
+    if (len(arcs)):
+        # Work out each arc's sweep once, then look it up for each of its points
+        arcRows = numpy.flatnonzero(rows["kind"] == PATH_ARC)
+        arc = rows[arcRows]
+        n = numpy.searchsorted(arcRows, row[arcs])
+        turn = numpy.where(arc["clockwise"], -1.0, 1.0)*arc_sweep(arc)
+        angle = arc["angle1"][n] + turn[n]*param[arcs]
+        points[arcs,0] = arc["center"][n,0] + arc["radius"][n]*numpy.cos(angle)
+        points[arcs,1] = arc["center"][n,1] + arc["radius"][n]*numpy.sin(angle)
+    return (points, row)
+
+# Builds a level of detail with the given cell size from the path table rows, or
+# returns None if the cells are too small for the job (see MAX_SAMPLES)
+def build_level(rows, cellSize):
+    # Points half a cell apart along each path, so that the cells they fall in
+    # form an unbroken line
+    counts = numpy.ceil(path_lengths(rows)/(cellSize/2)).astype(numpy.int64)+1
+    counts[(rows["kind"] != PATH_LINE) & (rows["kind"] != PATH_ARC)] = 0
+    total = numpy.cumsum(counts)
+    level = Level(cellSize, len(rows))
+    if (not len(rows) or not total[-1]):
+        return level
+    if (total[-1] > MAX_SAMPLES):
+        return None
+
+    # Each cell is known by a single number (see Level.get_cells)
+    (lo, hi) = _bounds(rows)
+    level.origin = numpy.floor(lo/cellSize).astype(numpy.int64)
+    level.height = int(math.floor(hi[1]/cellSize)) - int(level.origin[1]) + 1
+
+    # The cells touched by each chunk of rows, keeping the earliest row for each
+    # cell. The rows are in order, so that's the first time each cell turns up.
+    found = {True : [], False : []}
+    start = 0
+    while (start < len(rows)):
+        used = total[start-1] if start else 0
+        end = max(int(numpy.searchsorted(total, used+CHUNK_SAMPLES, side="right")), start+1)
+        (points, row) = sample_paths(rows[start:end], counts[start:end])
+        cells = numpy.floor(points/cellSize).astype(numpy.int64) - level.origin
+        keys = cells[:,0]*level.height + cells[:,1]
+        rapid = rows["rapid"][start:end][row]
+        for kind in (True, False):
+            chosen = (rapid == kind)
+            (unique, first) = numpy.unique(keys[chosen], return_index=True)
+            found[kind].append((unique, row[chosen][first]+start))
+        start = end
+
+    for kind in (True, False):
+        keys = numpy.concatenate([unique for (unique, first) in found[kind]])
+        index = numpy.concatenate([first for (unique, first) in found[kind]])
+        (keys, first) = numpy.unique(keys, return_index=True)
+        level.keys[kind] = keys
+        level.first[kind] = index[first]
+    return level
+
+###########
+# Classes #
+###########
+
+# One level of detail: the grid cells covered by the first 'size' paths of a
+# table, with cells 'cellSize' across
+class Level(object):
+    # The grid cells are numbered column by column from 'origin' (in cells), with
+    # 'height' cells in each column
+    origin = (0, 0)
+    height = 1
+
+    def __init__(this, cellSize, size):
+        this.cellSize = cellSize
+        this.size = size
+        # The cells covered by rapids and by cuts (keyed by 'rapid'), along with
+        # the earliest path through each
+        this.keys = {}
+        this.first = {}
+        for rapid in (True, False):
+            this.keys[rapid] = numpy.zeros(0, dtype=numpy.int64)
+            this.first[rapid] = numpy.zeros(0, dtype=numpy.int64)
+
+    def __len__(this):
+        return len(this.keys[True]) + len(this.keys[False])
+
+    # Returns the centres of the cells to fill in for the paths before 'stop' that
+    # fall within the given rectangle, along with whether each is only covered by
+    # rapid moves. Cells covered by both cuts and rapids are drawn as cuts.
+    def get_cells(this, stop, xmin, ymin, xmax, ymax):
+        (x0, y0) = (math.floor(xmin/this.cellSize), math.floor(ymin/this.cellSize))
+        (x1, y1) = (math.floor(xmax/this.cellSize), math.floor(ymax/this.cellSize))
+        # The columns are stored in order, so the visible ones can be found by searching
+        lo = (x0-this.origin[0])*this.height
+        hi = (x1-this.origin[0]+1)*this.height
+        chosen = {}
+        for rapid in (True, False):
+            keys = this.keys[rapid]
+            (a, b) = numpy.searchsorted(keys, (lo, hi))
+            y = keys[a:b] % this.height + this.origin[1]
+            mask = (this.first[rapid][a:b] < stop) & (y >= y0) & (y <= y1)
+            chosen[rapid] = keys[a:b][mask]
+        cuts = chosen[False]
+        rapids = chosen[True]
+        if (len(cuts) and len(rapids)):
+            rapids = rapids[~numpy.isin(rapids, cuts, assume_unique=True)]
+        keys = numpy.concatenate((cuts, rapids))
+        points = numpy.empty((len(keys), 2))
+        points[:,0] = keys // this.height + this.origin[0] + 0.5
+        points[:,1] = keys % this.height + this.origin[1] + 0.5
+        isRapid = numpy.zeros(len(keys), dtype=bool)
+        isRapid[len(cuts):] = True
+        return (points*this.cellSize, isRapid)
+
+# The levels of detail for a path table. Cell sizes are rounded down to a power
+# of two and the most recently used levels are kept. As with the spatial index,
+# a level is only rebuilt once a good fraction of the table has been added since.
+class Pyramid(object):
+    # The number of levels kept
+    maxLevels = 4
+
+    def __init__(this):
+        # Maps the cell size (as a power of two) to (level, table size)
+        this._levels = collections.OrderedDict()
+
+    # Returns a level of detail for the given rows with cells no bigger than
+    # 'cellSize', or None if that's too small to be worth it (see build_level)
+    def get_level(this, data, cellSize):
+        bucket = int(math.floor(math.log(cellSize, 2)))
+        (level, size) = this._levels.pop(bucket, (None, -1))
+        if (size < 0 or len(data)-size > max(4096, size//8)):
+            level = build_level(data, 2.0**bucket)
+            size = len(data)
+        this._levels[bucket] = (level, size)
+        while (len(this._levels) > this.maxLevels):
+            this._levels.popitem(last=False)
+        return level
+
+    def clear(this):
+        this._levels.clear()
@@ -23,24 +23,39 @@ from __future__ import absolute_import, division, print_function
 # Imports #
 ###########
 
-import sys
+import threading
 try:
     from gi.repository import Gtk
     from gi.repository import Gdk
     from gi.repository import GObject
+    from gi.repository import GLib
     from gi.repository import Pango
 except ImportError:
     print("ERROR - Cannot import GObject Introspection module. Please visit https://live.gnome.org/PyGObject\n")
     raise
 
+import gsim
 from gsim import gcode
+from gsim import motion
 from gsim.render import GCodeRenderWidget
 
 #############
 # Constants #
 #############
 
-VERSION = "0.21"
+VERSION = gsim.__version__
+
+# How far (in pixels) the mouse can move between pressing and releasing the button
+# and still count as a click
+CLICK_DISTANCE = 3
+
+# The number of statements simulated up front when loading a program, and then
+# in each step of the background pass that simulates the rest of it
+SIMULATE_CHUNK = 20000
+
+# The number of lines of the program source added to the source view in each
+# idle step
+TEXT_CHUNK = 5000
 
 #############
 # Functions #
@@ -57,6 +72,61 @@ def show_message(win, msg):
 # Classes #
 ###########
 
+# Loads a program on a separate thread so the window stays responsive: parses it
+# and simulates the start of it. Progress is passed back to the main loop as
+# 'progress_cb(loader, message, fraction)', and the results as 'done_cb(loader,
+# prog, state)'. If loading fails 'error_cb(loader, message)' is called instead.
+# Nothing is passed back once cancelled.
+class ProgramLoader(object):
+    cancelled = False
+
+    def __init__(this, path, profile, progress_cb, done_cb, error_cb):
+        this.path = path
+        this.profile = profile
+        this.progress_cb = progress_cb
+        this.done_cb = done_cb
+        this.error_cb = error_cb
+        this.thread = None
+
+    def start(this):
+        this.thread = threading.Thread(target=this.run)
+        this.thread.daemon = True
+        this.thread.start()
+
+    def cancel(this):
+        this.cancelled = True
+
+    # Reports progress to the main loop, returning true if the load was cancelled
+    def report(this, message, fraction):
+        if (not this.cancelled):
+            GLib.idle_add(this.progress_cb, this, message, fraction)
+        return this.cancelled
+
+    def run(this):
+        try:
+            this.load()
+        except Exception as e:
+            if (not this.cancelled):
+                GLib.idle_add(this.error_cb, this, str(e) or e.__class__.__name__)
+
+    def load(this):
+        # Files we've seen before come from the cache
+        prog = gcode.parse_program(this.path, cache=True,
+                                   progress=lambda fraction: this.report("Reading program", fraction))
+        if (prog is None or this.cancelled):
+            return
+        prog.profile = this.profile
+
+        # Only simulate the start of the program for now, so the first toolpaths can
+        # be shown right away. The rest is simulated in the main loop (see
+        # MainWindow.simulate_cb), which shares the state with the canvas.
+        state = None
+        if (prog.statements):
+            state = prog.start()
+            state.run(SIMULATE_CHUNK)
+        if (not this.cancelled):
+            GLib.idle_add(this.done_cb, this, prog, state)
+
 class MainWindow(object):
     sliderChangedID = -1
     timeSlider = None
@@ -74,6 +144,26 @@ class MainWindow(object):
     zoomFitButton = None
     # The gcode machine state
     state = None
+    # The line currently highlighted in the program source (or None)
+    highlightLine = None
+    # The line selected by clicking on the canvas (or None)
+    selectedLine = None
+    # The program being loaded in the background (see load_program)
+    loader = None
+    # The idle callback simulating the rest of the program (see simulate_cb)
+    simulateID = None
+    # The idle callback adding the program source to the source view, the program
+    # it comes from and the next line to add (see add_text_cb)
+    textID = None
+    textProgram = None
+    textLine = 0
+    # The time shown on the canvas as the program is simulated. While the user
+    # leaves it there, it moves along to show the paths as they're produced.
+    followTime = None
+    # The zoom level set when the program was loaded
+    loadZoom = None
+    # The machine limits used to time the job (see gsim.motion), or None
+    profile = None
 
     def __init__(this):
         this.window = Gtk.Window()
@@ -123,6 +213,7 @@ class MainWindow(object):
         text.show()
         text.set_editable(False)
         text.set_property("can-focus", False)
+        text.connect("button-release-event", this.source_clicked_cb)
         this.programText = text
         scroll = Gtk.ScrolledWindow()
         scroll.set_shadow_type(Gtk.ShadowType.ETCHED_IN)
@@ -139,6 +230,10 @@ class MainWindow(object):
         tag = buf.create_tag("highlight")
         tag.set_property("background", "#f03030")
 
+        # And for the line selected by clicking on the canvas
+        tag = buf.create_tag("selected")
+        tag.set_property("background", "#80b0ff")
+
         (w, h) = this.window.get_size()
         scroll.set_size_request(w//3, -1)
 
@@ -154,6 +249,15 @@ class MainWindow(object):
         this.statusLabel.show()
         hbox.pack_start(this.statusLabel, True, True, padding=0)
 
+        # The progress of loading a program, and a button to cancel it
+        this.progressBar = Gtk.ProgressBar()
+        this.progressBar.set_show_text(True)
+        hbox.pack_start(this.progressBar, False, False, padding=4)
+        this.cancelButton = Gtk.Button(stock=Gtk.STOCK_CANCEL)
+        this.cancelButton.set_relief(Gtk.ReliefStyle.NONE)
+        this.cancelButton.connect("clicked", this.cancel_load_cb)
+        hbox.pack_start(this.cancelButton, False, False, padding=0)
+
         # Now create the label
         this.coordsLabel = Gtk.Label()
         this.coordsLabel.show()
@@ -163,12 +267,55 @@ class MainWindow(object):
         this.update_status()
         this.window.show()
 
+    # Starts loading the program at the given path. The file is read on another
+    # thread (see ProgramLoader), and once the start of the program has been
+    # simulated the rest follows in the background while the job is shown.
     def load_program(this, path):
-        # Run the gcode program
-        prog = gcode.parse_program(path)
+        this.stop_loading()
+        this.loader = ProgramLoader(path, this.profile, this.load_progress_cb,
+                                    this.load_done_cb, this.load_error_cb)
+        this.loader.start()
+        this.set_progress("Reading program", 0)
+
+    # Stops loading and simulating the current program (the rest of it is then
+    # simulated on demand, as the user moves around the timeline)
+    def stop_loading(this):
+        if (this.loader):
+            this.loader.cancel()
+            this.loader = None
+        if (this.simulateID is not None):
+            GObject.source_remove(this.simulateID)
+            this.simulateID = None
+        this.set_progress(None)
+
+    # Shows the given progress message and fraction done, or hides the progress
+    # bar if 'message' is None
+    def set_progress(this, message, fraction=0):
+        if (message is None):
+            this.progressBar.hide()
+            this.cancelButton.hide()
+            return
+        this.progressBar.set_text(message)
+        this.progressBar.set_fraction(min(max(fraction, 0), 1))
+        this.progressBar.show()
+        this.cancelButton.show()
+
+    # Called with the progress of the program loader
+    def load_progress_cb(this, loader, message, fraction):
+        if (loader is this.loader):
+            this.set_progress(message, fraction)
+        return False
+
+    # Called once the program loader has finished
+    def load_done_cb(this, loader, prog, state):
+        if (loader is not this.loader):
+            # Cancelled (or overtaken by another file)
+            return False
+        this.loader = None
         if (not prog.statements):
+            this.set_progress(None)
             show_message(this.window, "The file does not appear to be a gcode script")
-            return
+            return False
 
         if (prog.invalidLines):
             # Warn the user about the invalid lines (only show the first few)
@@ -179,15 +326,79 @@ class MainWindow(object):
                 txt += "\n\n(and %d more)" % extra
             show_message(this.window, "The gcode file contains invalid lines:\n\n%s" % txt)
 
-        # Display the program source code
+        # Display the program source code, a block at a time
+        if (this.textID is not None):
+            GObject.source_remove(this.textID)
+        this.programText.get_buffer().set_text("")
+        this.textProgram = prog
+        this.textLine = 0
+        this.textID = GObject.idle_add(this.add_text_cb)
+
+        this.timeAdjust.set_upper(state.get_run_length()+1)
+        this.state = state
+        this.highlightLine = None
+        this.selectedLine = None
+        this.renderArea.set_machine_state(state)
+        this.set_status("Program loaded (%d instructions)" % len(prog.statements))
+        this.update_status()
+        # Set the default zoom
+        this.zoom_default_cb()
+        this.loadZoom = this.renderArea.get_zoom()
+        # Show the paths simulated so far
+        this.followTime = None
+        this.follow_simulation()
+
+        if (state.finished):
+            this.simulation_finished()
+        else:
+            this.set_progress("Simulating", state.lineno/len(prog.statements))
+            this.simulateID = GObject.idle_add(this.simulate_cb)
+        return False
+
+    # Called if the program loader fails
+    def load_error_cb(this, loader, message):
+        if (loader is not this.loader):
+            return False
+        this.loader = None
+        this.stop_loading()
+        this.set_status("Loading failed")
+        show_message(this.window, "The file could not be loaded:\n\n%s" % GLib.markup_escape_text(message))
+        return False
+
+    # Adds the next block of the program source to the source view. The lines are
+    # only read from the program as they're needed, rather than all up front.
+    def add_text_cb(this):
+        prog = this.textProgram
         buf = this.programText.get_buffer()
-        for statement in prog.statements:
-            buf.insert_with_tags_by_name(buf.get_end_iter(), "%04d:" % (statement.lineNumber+1), "numbers")
-            buf.insert(buf.get_end_iter(), "  %s\n" % statement.command)
+        first = this.textLine
+        this.textLine = min(first+TEXT_CHUNK, len(prog.statements))
+        for n in range(first, this.textLine):
+            buf.insert_with_tags_by_name(buf.get_end_iter(), "%04d:" % (n+1), "numbers")
+            buf.insert(buf.get_end_iter(), "  %s\n" % prog.get_command(n))
+        if (this.textLine < len(prog.statements)):
+            return True
+        this.textID = None
+        this.textProgram = None
+        return False
+
+    # Moves the canvas on to the end of the paths simulated so far, unless the user
+    # has moved it elsewhere since
+    def follow_simulation(this):
+        tm = this.renderArea.get_time()
+        if (this.followTime is not None and tm != this.followTime):
+            return
+        if (this.renderArea.get_playing()):
+            return
+        this.followTime = this.state.get_run_length()
+        this.renderArea.set_time(this.followTime)
 
-        state = prog.start()
-        while not state.finished:
-            state.step()
+    # Called once the whole program has been simulated
+    def simulation_finished(this):
+        state = this.state
+        this.set_progress(None)
+        this.timeAdjust.set_upper(state.get_run_length()+1)
+        this.follow_simulation()
+        this.followTime = None
 
         if (state.unknownCodes):
             # Warn the user about the unrecognized gcode commands (only show the first few)
@@ -202,28 +413,48 @@ class MainWindow(object):
         if (state.get_run_length() == 0):
             show_message(this.window, "The file does not appear to be a valid gcode script.")
 
-        rapidLength = 0
-        for path in state.paths:
-            if (isinstance(path, gcode.Line) and path.rapid):
-                rapidLength += path.length
-
-        this.timeAdjust.set_upper(state.get_run_length()+1)
-        this.state = state
-        this.renderArea.set_machine_state(state)
-        this.set_status("Program loaded (%d instructions)" % len(prog.statements))
-        this.update_status()
-        # Set the default zoom
-        this.zoom_default_cb()
+        if (this.renderArea.get_zoom() == this.loadZoom):
+            # The user hasn't zoomed in yet, so fit the whole job on the screen
+            this.zoom_default_cb()
 
     def set_status(this, msg):
         this.statusLabel.set_markup("<small>%s</small>" % msg)
+        if (not this.state):
+            return
         buf = this.programText.get_buffer()
-        buf.remove_tag_by_name("highlight", buf.get_start_iter(), buf.get_end_iter())
 
-        lineno = this.renderArea.get_current_path().statement.lineNumber
+        # Find the statement being executed at the current time
+        paths = this.state.paths
+        n = paths.find_time(this.renderArea.get_time())
+        if (n < 0):
+            return
+        lineno = paths.get_statement_index(n)
+        if (lineno == this.highlightLine):
+            return
+
+        # Move the highlight over to the new line (only the old line needs updating,
+        # which keeps this cheap for large programs)
+        if (this.highlightLine is not None):
+            buf.remove_tag_by_name("highlight",
+                buf.get_iter_at_line(this.highlightLine), buf.get_iter_at_line(this.highlightLine+1))
         start = buf.get_iter_at_line(lineno)
         buf.apply_tag_by_name("highlight", start, buf.get_iter_at_line(lineno+1))
         this.programText.scroll_to_iter(start, 0.2, False, 0.5, 0.5)
+        this.highlightLine = lineno
+
+    # Marks the given line of the program source as selected (or clears the
+    # selection if None) and scrolls it into view
+    def select_line(this, lineno):
+        buf = this.programText.get_buffer()
+        if (this.selectedLine is not None):
+            buf.remove_tag_by_name("selected",
+                buf.get_iter_at_line(this.selectedLine), buf.get_iter_at_line(this.selectedLine+1))
+        this.selectedLine = lineno
+        if (lineno is None):
+            return
+        start = buf.get_iter_at_line(lineno)
+        buf.apply_tag_by_name("selected", start, buf.get_iter_at_line(lineno+1))
+        this.programText.scroll_to_iter(start, 0.2, False, 0.5, 0.5)
 
     def build_menu(this):
         # Build the menu bar
@@ -347,12 +578,37 @@ class MainWindow(object):
 
     def forward_cb(this, *args):
         this.renderArea.set_playing(False)
+        # Finish simulating the program first, to find where it ends
+        if (not this.state.finished):
+            this.state.run()
         this.renderArea.set_time(this.state.get_run_length())
 
+    # Called when the user cancels loading a program
+    def cancel_load_cb(this, *args):
+        loading = (this.loader is not None)
+        this.stop_loading()
+        this.followTime = None
+        if (loading):
+            this.set_status("Loading cancelled")
+
     # Called when the user clicks stop
     def stop_cb(this, *args):
         this.renderArea.set_playing(False)
 
+    # Simulates the next part of the program while the application is idle
+    def simulate_cb(this):
+        if (not this.state.finished):
+            this.state.run(SIMULATE_CHUNK)
+        # Extend the timeline as the run length becomes known
+        this.timeAdjust.set_upper(this.state.get_run_length()+1)
+        if (not this.state.finished):
+            this.follow_simulation()
+            this.set_progress("Simulating", this.state.lineno/len(this.state.program.statements))
+            return True
+        this.simulateID = None
+        this.simulation_finished()
+        return False
+
     # Called when the user moves around the time slider
     def time_slider_changed_cb(this, *args):
         tm = this.timeAdjust.get_value()
@@ -375,6 +631,33 @@ class MainWindow(object):
         if (pos is not None):
             this.coordsLabel.set_text("(%0.1f, %0.1f) (mm)" % (pos[0], pos[1]))
 
+    # Called when the user clicks on a line of the program source. Jumps to the
+    # point in the job where that line is executed.
+    def source_clicked_cb(this, w, event):
+        if (not this.state or event.button != 1):
+            return False
+        (x, y) = w.window_to_buffer_coords(Gtk.TextWindowType.TEXT, int(event.x), int(event.y))
+        it = w.get_iter_at_location(x, y)
+        if (isinstance(it, tuple)):
+            # Newer versions of GTK return a (found, iter) pair
+            it = it[-1]
+
+        # The program is only simulated as far as it's been played, so run it up to
+        # the clicked statement first (and on to the next path, if that statement
+        # didn't generate one)
+        line = it.get_line()
+        state = this.state
+        state.ensure_line(line+1)
+        paths = state.paths
+        n = paths.find_statement(line)
+        while (n >= len(paths) and not state.finished):
+            state.run(gcode.LAZY_CHUNK)
+            n = paths.find_statement(line)
+        if (n < len(paths)):
+            this.renderArea.set_playing(False)
+            this.renderArea.set_time(float(paths.array["startTime"][n]))
+        return False
+
     # Called when the user clicks on the open icon
     def open_cb(this, *args):
         # Stop playback
@@ -410,7 +693,10 @@ class MainWindow(object):
 
     def zoom_default_cb(this, *args):
         # Calculate the zoom level so that everything fits on the screen
-        (dx, dy) = this.renderArea.get_render_size()
+        size = this.renderArea.get_render_size()
+        if (not size):
+            return
+        (dx, dy) = size
 
         w = this.renderArea.get_allocated_width()
         h = this.renderArea.get_allocated_height()
@@ -433,6 +719,24 @@ class MainWindow(object):
             else:
                 # Stop dragging
                 this.dragging = False
+                if (this.dragMouseStart and
+                    abs(event.x-this.dragMouseStart[0]) < CLICK_DISTANCE and
+                    abs(event.y-this.dragMouseStart[1]) < CLICK_DISTANCE):
+                    # The mouse didn't move, so it was a click
+                    this.canvas_clicked(event.x, event.y)
+
+    # Called when the user clicks on the canvas. Selects the line of the program
+    # which generated the path under the mouse.
+    def canvas_clicked(this, x, y):
+        if (not this.state):
+            return
+        n = this.renderArea.find_path_at(x, y)
+        if (n < 0):
+            this.select_line(None)
+            return
+        lineno = this.state.paths.get_statement_index(n)
+        if (lineno >= 0):
+            this.select_line(lineno)
 
     def mouse_motion_cb(this, w, event):
         if (this.dragging and this.dragMouseStart):
@@ -460,13 +764,20 @@ See http://www.gnu.org/licenses/gpl-2.0.html""" % VERSION)
 ########
 
 def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Simulate a G-code file.")
+    parser.add_argument("path", nargs="?", help="path to G-code file")
+    parser.add_argument("--machine", metavar="PROFILE",
+                        help="time the job using the machine limits in the given "
+                        "JSON file (see gsim.motion.MachineProfile)")
+    args = parser.parse_args()
+
     w = MainWindow()
-    try:
-        path = sys.argv[1]
-    except IndexError:
-        pass
-    else:
-        w.load_program(path)
+    if (args.machine):
+        w.profile = motion.MachineProfile.load(args.machine)
+    if (args.path):
+        w.load_program(args.path)
 
     Gtk.main()
 
@@ -0,0 +1,280 @@
+# Python G-Code simulator
+#
+# Copyright (C) 2011 Peter Rogers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+# Estimates how long a machine really takes to follow a set of paths. Programmed
+# feed rates are only an upper bound: the machine has to slow down for corners
+# and can only speed up and slow down so quickly, which matters a lot for jobs
+# made of many short segments. This works like the look-ahead planner in a
+# motion controller (eg Grbl), but over a whole path table at once using NumPy.
+#
+# Each move is given a trapezoidal speed profile (with the ramps stretched out
+# to account for the jerk limit, if there is one), and the speed through each
+# corner is limited using the "junction deviation" model: the machine is allowed
+# to cut the corner by at most 'cornerTolerance' mm.
+
+from __future__ import absolute_import, division, print_function
+
+import json
+import numpy
+
+###########
+# Globals #
+###########
+
+# Path kinds (these match the ones in gcode.py)
+PATH_LINE = 0
+PATH_ARC = 1
+
+# Moves shorter than this (in mm) are ignored when planning
+MIN_LENGTH = 1e-9
+
+#############
+# Functions #
+#############
+
+# Returns the achievable duration (in seconds) of each row of the given path table
+# rows. Lengths and feed rates are multiplied by 'scale' to convert them to mm.
+# The machine starts and ends at rest, and also stops for dwells and tool changes,
+# whose durations are left as they are.
+def plan_durations(rows, profile, scale=1.0):
+    return plan(rows, profile, scale)[2]
+
+# Plans the given path table rows (see plan_durations). Returns the speeds at the
+# start and end of each row (in mm/s) and the row durations. The machine can be
+# going at up to 'startSpeed' (in mm/s) at the start, when carrying on from rows
+# planned earlier (see plan_batch).
+def plan(rows, profile, scale=1.0, startSpeed=0.0):
+    count = len(rows)
+    kind = rows["kind"]
+    length = rows["length"]*scale
+    durations = numpy.array(rows["duration"], dtype=float)
+    entrySpeed = numpy.zeros(count)
+    exitSpeed = numpy.zeros(count)
+    if (count == 0):
+        return (entrySpeed, exitSpeed, durations)
+
+    moves = (kind == PATH_LINE) | (kind == PATH_ARC)
+    # Zero length moves take no time and are skipped over, so they don't count
+    # as corners. Everything else (dwells, tool changes) brings the machine to
+    # a stop.
+    durations[moves] = 0
+    used = numpy.nonzero(~moves | (length > MIN_LENGTH))[0]
+    rows = rows[used]
+    kind = kind[used]
+    length = length[used]
+    moves = moves[used]
+    lines = moves & (kind == PATH_LINE)
+    arcs = moves & (kind == PATH_ARC)
+
+    # The direction of travel at the start and end of each move
+    startDir = numpy.zeros((len(rows), 2))
+    endDir = numpy.zeros((len(rows), 2))
+    delta = rows["end"][lines] - rows["start"][lines]
+    delta /= numpy.hypot(delta[:,0], delta[:,1])[:,None]
+    startDir[lines] = delta
+    endDir[lines] = delta
+    # For arcs this is the tangent, which turns one way or the other depending
+    # on the direction of the arc
+    sign = numpy.where(rows["clockwise"][arcs], -1.0, 1.0)
+    for (dirs, angle) in ((startDir, rows["angle1"][arcs]), (endDir, rows["angle2"][arcs])):
+        dirs[arcs,0] = -numpy.sin(angle)*sign
+        dirs[arcs,1] = numpy.cos(angle)*sign
+
+    # The speed and acceleration limits along each move, from the per-axis limits
+    maxSpeed = numpy.zeros(len(rows))
+    accel = numpy.ones(len(rows))
+    jerk = numpy.ones(len(rows))*numpy.inf
+    maxSpeed[lines] = profile.axis_limit(profile.maxVelocity, startDir[lines])
+    accel[lines] = profile.axis_limit(profile.maxAccel, startDir[lines])
+    if (profile.maxJerk is not None):
+        jerk[lines] = profile.axis_limit(profile.maxJerk, startDir[lines])
+    # The direction changes all the way around an arc, so use the worst case
+    maxSpeed[arcs] = min(profile.maxVelocity)
+    accel[arcs] = min(profile.maxAccel)
+    if (profile.maxJerk is not None):
+        jerk[arcs] = min(profile.maxJerk)
+    # Keep the centripetal acceleration within limits too
+    radius = rows["radius"][arcs]*scale
+    maxSpeed[arcs] = numpy.minimum(maxSpeed[arcs], numpy.sqrt(accel[arcs]*radius))
+
+    # Cutting moves are also limited by the programmed feed rate. Rapids go as
+    # fast as the machine allows, unless the profile says otherwise.
+    feeds = moves & ~rows["rapid"]
+    maxSpeed[feeds] = numpy.minimum(maxSpeed[feeds], rows["feedRate"][feeds]*scale)
+    rapids = moves & rows["rapid"]
+    if (profile.rapidVelocity is not None):
+        maxSpeed[rapids] = numpy.minimum(maxSpeed[rapids], profile.rapidVelocity)
+    # Non-moves have no length and a speed limit of zero, which stops the machine
+    # on either side of them
+    length[~moves] = 0
+    maxSpeed[~moves] = 0
+
+    # The highest speed through each junction between one row and the next. With
+    # u and v the directions going into and out of the corner and a the
+    # acceleration limit, the maximum speed is:
+    #   speed**2 = a*tolerance*sin(theta/2)/(1-sin(theta/2))
+    # where theta is the angle between -u and v (so theta = pi when going straight).
+    cosTheta = -(endDir[:-1]*startDir[1:]).sum(axis=1)
+    sinHalf = numpy.sqrt(numpy.clip(0.5*(1-cosTheta), 0, 1))
+    junctionAccel = numpy.minimum(accel[:-1], accel[1:])
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        corner = junctionAccel*profile.cornerTolerance*sinHalf/(1-sinHalf)
+    corner[sinHalf >= 1] = numpy.inf
+    # Speeds are handled as squares from here on
+    limit = numpy.zeros(len(rows)+1)
+    limit[0] = startSpeed**2
+    limit[1:-1] = numpy.minimum(corner, numpy.minimum(maxSpeed[:-1], maxSpeed[1:])**2)
+
+    # Each move can change the speed (squared) by at most 2*accel*length. The
+    # backward pass finds how fast we can be going at each junction and still
+    # slow down in time for what comes after, and the forward pass how fast we
+    # can get going. Written in terms of the running total of 2*accel*length,
+    # both passes become a cumulative minimum.
+    total = numpy.zeros(len(rows)+1)
+    numpy.cumsum(2*accel*length, out=total[1:])
+    backward = numpy.minimum.accumulate((limit+total)[::-1])[::-1] - total
+    speed2 = numpy.minimum.accumulate(backward-total) + total
+    speed = numpy.sqrt(numpy.clip(speed2, 0, None))
+
+    # Now work out the time taken by each move. The machine speeds up from the
+    # entry speed towards a peak speed, cruises, then slows down to the exit speed.
+    v0 = speed[:-1][moves]
+    v1 = speed[1:][moves]
+    a = accel[moves]
+    j = jerk[moves]
+    dist = length[moves]
+    peak = numpy.sqrt(a*dist + (v0**2+v1**2)/2)
+    peak = numpy.minimum(peak, maxSpeed[moves])
+    peak = numpy.maximum(peak, numpy.maximum(v0, v1))
+    t1 = _ramp_time(peak-v0, a, j)
+    t2 = _ramp_time(peak-v1, a, j)
+    cruise = numpy.clip(dist - (v0+peak)/2*t1 - (v1+peak)/2*t2, 0, None)
+    times = durations[used]
+    times[moves] = t1 + t2 + cruise/peak
+    durations[used] = times
+
+    entrySpeed[used] = speed[:-1]
+    exitSpeed[used] = speed[1:]
+    return (entrySpeed, exitSpeed, durations)
+
+# Plans rows that follow on from rows planned earlier, going into the first of them
+# at 'startSpeed' (mm/s). This lets a job be planned a batch at a time with the
+# same result as planning it all at once: only the last few rows of a batch can
+# still change when more rows are added after them, and those are planned again
+# along with the next batch. Returns (durations, settled, speed) where 'settled'
+# is the number of rows at the start whose plan is final, and 'speed' is the
+# speed going into the rows after those.
+def plan_batch(rows, profile, scale=1.0, startSpeed=0.0):
+    (entry, exit, durations) = plan(rows, profile, scale, startSpeed)
+    if (len(rows) == 0):
+        return (durations, 0, startSpeed)
+
+    # A junction is final once the machine could stop from full speed in the rows
+    # after it, so whatever comes next can't make it slow down any sooner. A dwell
+    # or tool change stops the machine anyway.
+    kind = rows["kind"]
+    length = rows["length"]*scale
+    moves = (kind == PATH_LINE) | (kind == PATH_ARC)
+    fullSpeed = numpy.hypot(*profile.maxVelocity)
+    stopping = fullSpeed**2/(2*min(profile.maxAccel))
+    remaining = numpy.cumsum(length[::-1])[::-1]
+    far = numpy.flatnonzero(remaining >= stopping)
+    stops = numpy.flatnonzero(~moves)
+    settled = max(far[-1] if len(far) else 0, stops[-1]+1 if len(stops) else 0)
+
+    # The speed at that junction, which is where the last planned row before it
+    # finishes (zero length moves aren't planned)
+    planned = numpy.flatnonzero((~moves | (length > MIN_LENGTH))[:settled])
+    if (len(planned)):
+        speed = float(exit[planned[-1]])
+    else:
+        speed = startSpeed
+    return (durations, settled, speed)
+
+# Returns the time taken to change speed by 'dv' with the given acceleration and
+# jerk limits. With a jerk limit the acceleration has to ramp up and back down
+# again, which takes an extra a/jerk seconds (or if the change is small enough
+# that the full acceleration is never reached, 2*sqrt(dv/jerk) seconds in total).
+def _ramp_time(dv, accel, jerk):
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        full = dv/accel + accel/jerk
+        short = 2*numpy.sqrt(dv/jerk)
+    return numpy.where(dv >= accel**2/jerk, full, short)
+
+###########
+# Classes #
+###########
+
+# The kinematic limits of a machine. Speeds are in mm/s, accelerations in mm/s^2
+# and jerk in mm/s^3, each given per axis as an (x, y) pair.
+class MachineProfile(object):
+    maxVelocity = (25.0, 25.0)
+    maxAccel = (500.0, 500.0)
+    # No jerk limit by default
+    maxJerk = None
+    # How far (in mm) the machine may deviate from the path when going around a
+    # corner. Larger values allow faster cornering.
+    cornerTolerance = 0.01
+    # The speed of rapid moves, or None to rapid at the axis limits
+    rapidVelocity = None
+
+    def __init__(this, maxVelocity=None, maxAccel=None, maxJerk=None,
+                 cornerTolerance=None, rapidVelocity=None):
+        if (maxVelocity is not None):
+            this.maxVelocity = tuple(maxVelocity)
+        if (maxAccel is not None):
+            this.maxAccel = tuple(maxAccel)
+        if (maxJerk is not None):
+            this.maxJerk = tuple(maxJerk)
+        if (cornerTolerance is not None):
+            this.cornerTolerance = cornerTolerance
+        if (rapidVelocity is not None):
+            this.rapidVelocity = rapidVelocity
+
+    # Loads a profile from a JSON file, eg:
+    #   {"maxVelocity": [80, 80], "maxAccel": [800, 600], "cornerTolerance": 0.02}
+    @classmethod
+    def load(cls, path):
+        fd = open(path, "r")
+        try:
+            data = json.load(fd)
+        finally:
+            fd.close()
+        return cls(**data)
+
+    def to_dict(this):
+        return {
+            "maxVelocity" : list(this.maxVelocity),
+            "maxAccel" : list(this.maxAccel),
+            "maxJerk" : None if this.maxJerk is None else list(this.maxJerk),
+            "cornerTolerance" : this.cornerTolerance,
+            "rapidVelocity" : this.rapidVelocity,
+        }
+
+    # Returns the limit along each of the given unit directions, for the given
+    # per-axis limits. This is the largest value whose x and y components both
+    # stay within their axis limits.
+    def axis_limit(this, limits, directions):
+        with numpy.errstate(divide="ignore"):
+            ratio = numpy.maximum(numpy.abs(directions[:,0])/limits[0],
+                                  numpy.abs(directions[:,1])/limits[1])
+            return 1/ratio
+
+    def __repr__(this):
+        return "%s(%r)" % (this.__class__.__name__, this.to_dict())
@@ -0,0 +1,120 @@
+# Python G-Code simulator
+#
+# Copyright (C) 2011 Peter Rogers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+# Writes PNG images a band of rows at a time, so that very large images never
+# have to be held in memory all at once. The bands can also be compressed
+# separately (eg by different processes) with encode_band: each one is a piece
+# of a single deflate stream, and the checksums of the pieces are combined at
+# the end, so the bands only have to be written out in order.
+
+from __future__ import absolute_import, division, print_function
+
+import zlib
+import struct
+import numpy
+
+###########
+# Globals #
+###########
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# The largest prime below 2**16, used by the Adler-32 checksum
+ADLER_BASE = 65521
+
+# The zlib header written before the first band (deflate, 32K window, default
+# compression)
+ZLIB_HEADER = b"\x78\x9c"
+
+# PNG colour type for 8 bit RGB
+COLOUR_RGB = 2
+
+#############
+# Functions #
+#############
+
+# Compresses a band of rows of an RGB image (an array of shape (height, width, 3)
+# and type uint8). Returns (data, checksum, length) to be passed to
+# PNGWriter.write_band. 'last' should be true for the last band of the image.
+def encode_band(pixels, last, level=6):
+    (height, width) = pixels.shape[:2]
+    # Each row starts with its filter type, which is zero (none)
+    rows = numpy.zeros((height, width*3+1), dtype=numpy.uint8)
+    rows[:,1:] = pixels.reshape(height, width*3)
+    raw = rows.tobytes()
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    data = compressor.compress(raw)
+    if (last):
+        data += compressor.flush(zlib.Z_FINISH)
+    else:
+        # Finish on a byte boundary without ending the stream, so the next band
+        # can carry straight on
+        data += compressor.flush(zlib.Z_SYNC_FLUSH)
+    return (data, zlib.adler32(raw) & 0xffffffff, len(raw))
+
+# Returns the Adler-32 checksum of two pieces of data joined together, given the
+# checksums of the pieces and the length of the second
+def adler32_combine(adler1, adler2, length2):
+    rem = length2 % ADLER_BASE
+    sum1 = adler1 & 0xffff
+    sum2 = (rem*sum1) % ADLER_BASE
+    sum1 += (adler2 & 0xffff) + ADLER_BASE - 1
+    sum2 += ((adler1 >> 16) & 0xffff) + ((adler2 >> 16) & 0xffff) + ADLER_BASE - rem
+    sum1 %= ADLER_BASE
+    sum2 %= ADLER_BASE
+    return sum1 | (sum2 << 16)
+
+# Returns a PNG chunk of the given type
+def _chunk(kind, data):
+    return (struct.pack(">I", len(data)) + kind + data +
+            struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff))
+
+###########
+# Classes #
+###########
+
+# Writes an RGB image to the given file, one band of rows at a time (see
+# encode_band). The bands must be written in order, finishing with the last.
+class PNGWriter(object):
+    def __init__(this, fd, width, height):
+        this.fd = fd
+        this.width = width
+        this.height = height
+        this.checksum = 1
+        this.started = False
+        this.finished = False
+        fd.write(PNG_SIGNATURE)
+        fd.write(_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, COLOUR_RGB, 0, 0, 0)))
+
+    # Adds a band of rows of the image, as returned by encode_band
+    def write_band(this, data, checksum, length, last=False):
+        if (not this.started):
+            data = ZLIB_HEADER + data
+            this.started = True
+        this.checksum = adler32_combine(this.checksum, checksum, length)
+        if (last):
+            data += struct.pack(">I", this.checksum)
+            this.finished = True
+        this.fd.write(_chunk(b"IDAT", data))
+
+    # Finishes off the image
+    def close(this):
+        if (not this.finished):
+            raise ValueError("the last band of the image hasn't been written")
+        this.fd.write(_chunk(b"IEND", b""))
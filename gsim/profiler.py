@@ -0,0 +1,203 @@
+# Python G-Code simulator
+#
+# Copyright (C) 2011 Peter Rogers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+# Records where the time goes when loading and simulating a program: the call
+# count and total time of each opcode handler, and of each phase (parsing,
+# simulating, evaluating expressions, building the path table, etc), along with
+# the peak memory use of the process. For example:
+#
+#   profiler = Profiler()
+#   prog = gcode.parse_program(path, profiler=profiler)
+#   state = prog.start()
+#   profiler.attach(state)
+#   state.run()
+#   profiler.print_report()
+#
+# Nothing is instrumented until a profiler is attached: attach() swaps wrapped
+# versions of the handlers and methods into that one State instance, so states
+# without a profiler run exactly the same code as before.
+#
+# Times are cumulative, so phases that run inside other phases (eg "eval" inside
+# the handlers, or "parse" inside "simulate" when streaming) are counted in both.
+
+from __future__ import absolute_import, division, print_function
+
+import sys
+import time
+import json
+import contextlib
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+#############
+# Functions #
+#############
+
+# Returns the peak memory use (resident set size) of this process in bytes, or
+# None if it's not available
+def get_peak_rss():
+    if (resource is None):
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if (sys.platform != "darwin"):
+        # Linux reports this in kilobytes
+        peak *= 1024
+    return peak
+
+###########
+# Classes #
+###########
+
+# The call count and total time of one handler or phase
+class Counter(object):
+    calls = 0
+    time = 0
+    # The peak memory use of the process when the phase last finished
+    peakRSS = None
+
+    def to_dict(this):
+        data = {"calls" : this.calls, "time" : this.time}
+        if (this.peakRSS is not None):
+            data["peakRSS"] = this.peakRSS
+        return data
+
+class Profiler(object):
+    def __init__(this):
+        # Maps handler codes and phase names to Counters
+        this.handlers = {}
+        this.phases = {}
+
+    def _get_counter(this, table, name):
+        counter = table.get(name)
+        if (counter is None):
+            counter = table[name] = Counter()
+        return counter
+
+    # Times the code run inside the 'with' block as the given phase
+    @contextlib.contextmanager
+    def phase(this, name):
+        counter = this._get_counter(this.phases, name)
+        start = time.time()
+        try:
+            yield counter
+        finally:
+            counter.calls += 1
+            counter.time += time.time()-start
+            counter.peakRSS = get_peak_rss()
+
+    # Returns a version of the function that counts each call as the given phase.
+    # This is cheaper than phase() for functions called many times over, unless
+    # 'memory' is set to also check the memory use after each call.
+    def wrap(this, func, name, memory=False):
+        counter = this._get_counter(this.phases, name)
+        clock = time.time
+        def wrapper(*args, **kwargs):
+            start = clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                counter.calls += 1
+                counter.time += clock()-start
+                if (memory):
+                    counter.peakRSS = get_peak_rss()
+        return wrapper
+
+    # Returns an iterator over the given one that counts the time spent producing
+    # each item as the given phase
+    def wrap_iter(this, iterator, name):
+        counter = this._get_counter(this.phases, name)
+        clock = time.time
+        iterator = iter(iterator)
+        while 1:
+            start = clock()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            counter.calls += 1
+            counter.time += clock()-start
+            yield item
+        counter.peakRSS = get_peak_rss()
+
+    # Returns a version of the handler (see gcode.State.handle_statement) that
+    # counts its calls under the given code
+    def wrap_handler(this, handler, code):
+        counter = this._get_counter(this.handlers, code)
+        clock = time.time
+        def wrapper(state, st):
+            start = clock()
+            try:
+                handler(state, st)
+            finally:
+                counter.calls += 1
+                counter.time += clock()-start
+        return wrapper
+
+    # Instruments the given State (see the top of this file)
+    def attach(this, state):
+        state.profiler = this
+        state.handlers = dict((code, this.wrap_handler(handler, code))
+                              for (code, handler) in state.handlers.items())
+        # The methods are replaced on the instance, so other states aren't affected
+        for (method, name) in (("run", "simulate"), ("run_stream", "simulate")):
+            setattr(state, method, this.wrap(getattr(state, method), name, memory=True))
+        for (method, name) in (("step", "step"), ("eval_params", "eval"),
+                               ("eval_expression", "eval")):
+            setattr(state, method, this.wrap(getattr(state, method), name))
+        state.paths.flush = this.wrap(state.paths.flush, "paths")
+        state.paths.replan = this.wrap(state.paths.replan, "plan")
+
+    # Returns the results as a dictionary, ready to be saved as JSON
+    # (leaving out anything that was never called)
+    def report(this):
+        def convert(table):
+            return dict((name, counter.to_dict()) for (name, counter) in table.items() if counter.calls)
+        return {
+            "phases" : convert(this.phases),
+            "handlers" : convert(this.handlers),
+            "peakRSS" : get_peak_rss(),
+        }
+
+    # Prints the results as JSON
+    def dump(this, fd=None):
+        if (fd is None):
+            fd = sys.stdout
+        json.dump(this.report(), fd, indent=2, sort_keys=True)
+        fd.write("\n")
+
+    # Prints the results as a table, slowest first
+    def print_report(this, fd=None):
+        if (fd is None):
+            fd = sys.stdout
+        for (title, table) in (("Phase", this.phases), ("Handler", this.handlers)):
+            fd.write("%-12s %12s %12s %12s\n" % (title, "calls", "time (s)", "per call (us)"))
+            items = sorted(table.items(), key=lambda item: -item[1].time)
+            for (name, counter) in items:
+                if (not counter.calls):
+                    continue
+                perCall = 1e6*counter.time/counter.calls
+                fd.write("%-12s %12d %12.3f %12.2f\n" % (name or "(blank)", counter.calls, counter.time, perCall))
+            fd.write("\n")
+        peak = get_peak_rss()
+        if (peak is not None):
+            fd.write("Peak memory: %.1f MB\n" % (peak/(1024.0*1024)))
@@ -23,22 +23,75 @@ from __future__ import absolute_import, division, print_function
 # Imports #
 ###########
 
-import math
-import numpy
+import collections
+import threading
 from gsim import gcode
+from gsim import draw
 import time
+import cairo
 try:
     from gi.repository import Gtk
     from gi.repository import Gdk
     from gi.repository import GObject
+    from gi.repository import GLib
 except ImportError:
     print("ERROR - Cannot import GObject Introspection module. Please visit https://live.gnome.org/PyGObject\n")
     raise
 
+#############
+# Constants #
+#############
+
+# The number of snapshots of the finished paths kept for seeking (see
+# GCodeRenderWidget.update_pixmap), and how far apart they're taken when the
+# simulation has no keyframes
+MAX_SNAPSHOTS = 8
+SNAPSHOT_PATHS = 10000
+
+#############
+# Functions #
+#############
+
+# Returns a copy of the given cairo image surface
+def copy_surface(surface):
+    copy = cairo.ImageSurface(surface.get_format(), surface.get_width(), surface.get_height())
+    cr = cairo.Context(copy)
+    cr.set_source_surface(surface, 0, 0)
+    cr.set_operator(cairo.OPERATOR_SOURCE)
+    cr.paint()
+    return copy
+
 ###########
 # Classes #
 ###########
 
+# A picture of the job drawn by the render thread (see GCodeRenderWidget), along
+# with the renderer used and where the cutting head ended up
+class Frame(object):
+    def __init__(this, surface, renderer, headPos):
+        this.surface = surface
+        this.renderer = renderer
+        this.headPos = headPos
+
+# Everything the render thread needs to draw a frame, gathered on the main thread
+class RenderRequest(object):
+    def __init__(this, renderer, data, generation, path, pathParam, mark):
+        # The renderer for the current view (the render thread points it at its own
+        # copy of the paths), the table rows and which machine state they belong to
+        this.renderer = renderer
+        this.data = data
+        this.generation = generation
+        # The path being cut, how far through it the head is and where the next
+        # snapshot would be taken (see GCodeRenderWidget.get_snapshot_index)
+        this.path = path
+        this.pathParam = pathParam
+        this.mark = mark
+
+    # Anything that changes where the paths end up on screen
+    @property
+    def view(this):
+        return this.renderer.view
+
 class GCodeRenderWidget(Gtk.DrawingArea):
     # The gcode state
     _state = None
@@ -48,8 +101,36 @@ class GCodeRenderWidget(Gtk.DrawingArea):
     _playing = False
     _eventID = None
     _paths = None
+    # The frames are drawn on a separate thread (see render_thread_cb) so the main
+    # loop only has to paint the latest one. The main thread hands over the most
+    # recent request, replacing any that haven't been started yet.
+    _renderLock = None
+    _renderThread = None
+    _request = None
+    # The request being drawn, and whether it's been overtaken by a newer one
+    # that can't make use of it (see request_frame)
+    _rendering = None
+    _cancelRender = False
+    # What the last request was for, so it isn't asked for twice
+    _requestKey = None
+    # The latest frame drawn (see frame_ready_cb)
+    _frame = None
+    # Counts the machine states shown, so the render thread knows when to start over
+    _generation = 0
+
+    # The rest is only used by the render thread. It keeps its own copy of the path
+    # table (sharing the rows), since the spatial index, arcs and levels of detail
+    # built while drawing aren't safe to use from two threads at once.
+    _renderPaths = None
+    _renderGeneration = -1
+    # The finished paths drawn so far (an offscreen surface), how many of them
+    # there are, and the view they were drawn for (see update_pixmap)
     _pixmap = None
-    # Whether a repaint is needed
+    _pixmapCount = 0
+    _pixmapView = None
+    # Copies of the pixmap at keyframes, keyed by path count (see update_pixmap)
+    _snapshots = None
+    # Whether the pixmap needs to be drawn again from scratch
     _repaint = True
     _zoomLevel = 1
     _border = 10
@@ -62,11 +143,14 @@ class GCodeRenderWidget(Gtk.DrawingArea):
     def __init__(this):
         GObject.GObject.__init__(this)
         this.connect("draw", this.expose_cb)
+        this.connect("size-allocate", this.resize_cb)
         this._startTime = time.time()
         this._lastTime = 0
         this._currentTime = 0
         this._resolution = Gdk.Screen.height() / float(Gdk.Screen.height_mm())
         this._offset = (0, 0)
+        this._snapshots = collections.OrderedDict()
+        this._renderLock = threading.Condition()
 
     def get_view_pos(this):
         return this._offset
@@ -75,13 +159,34 @@ class GCodeRenderWidget(Gtk.DrawingArea):
         this._offset = pos
         this.queue_draw()
 
+    # Returns a renderer for drawing the job on this canvas as it's currently viewed
+    def get_renderer(this):
+        renderer = draw.JobRenderer(this._paths, this._state.minPos, this._state.units,
+                                    this.get_allocated_width(), this.get_allocated_height(),
+                                    this._resolution, this._zoomLevel, this._offset)
+        renderer.border = this._border
+        return renderer
+
+    # Converts a position on the canvas (in pixels) to machine coordinates
+    def device_to_model(this, x, y):
+        return this.get_renderer().device_to_model(x, y)
+
+    # Returns the index of the path closest to the given canvas position (in pixels),
+    # or -1 if there isn't one within 'radius' pixels
+    def find_path_at(this, x, y, radius=5):
+        if (not this._paths or this._state.bounds is None):
+            return -1
+        pos = this.device_to_model(x, y)
+        return this._paths.find_nearest(pos, radius/(this._resolution*this._zoomLevel))
+
     # Returns the size of the rendered geometry, taking into account the screen resolution
     # but ignoring the zoom factor.
     def get_render_size(this):
-        if (not this._state):
+        if (not this._state or this._state.bounds is None):
             return None
-        w = (this._state.maxPos[0]-this._state.minPos[0]+2*this._border)*this._resolution
-        h = (this._state.maxPos[1]-this._state.minPos[1]+2*this._border)*this._resolution
+        (minPos, maxPos) = this._state.bounds
+        w = (maxPos[0]-minPos[0]+2*this._border)*this._resolution
+        h = (maxPos[1]-minPos[1]+2*this._border)*this._resolution
         return (w, h)
 
     # Start / stop playing the job animation
@@ -101,9 +206,11 @@ class GCodeRenderWidget(Gtk.DrawingArea):
 
     def set_time(this, tm):
         this._currentTime = tm
+        if (this._state):
+            # The program may not have been simulated this far yet
+            this._state.ensure_time(tm)
         this._startTime = time.time()
         this._lastTime = this._startTime
-        this._repaint = True
         this.queue_draw()
         this.emit("time-changed", this._currentTime)
 
@@ -122,207 +229,201 @@ class GCodeRenderWidget(Gtk.DrawingArea):
         this._paths = state.paths
         this._playing = False
         this._headPos = None
+        this._frame = None
+        this._generation += 1
         this.set_time(0)
-        this.update_size()
         this.queue_draw()
 
     def set_zoom(this, zoom):
         this._zoomLevel = zoom
-        this._repaint = True
-        this.update_size()
         this.queue_draw()
 
     def get_zoom(this):
         return this._zoomLevel
 
-    def update_size(this):
-        w = this._zoomLevel * (this._state.maxPos[0]-this._state.minPos[0])+2*this._border
-        h = this._zoomLevel * (this._state.maxPos[1]-this._state.minPos[1])+2*this._border
-
     # Returns the path object currently being rendered
     def get_current_path(this):
         if (not this._paths):
             return None
-        for path in this._paths:
-            if (this._currentTime < path.startTime+path.duration):
-                return path
-        return this._paths[-1]
-
-    def repaint_buffer(this):
-        canvasWidth = this.get_allocated_width()
-        canvasHeight = this.get_allocated_height()
+        return this._paths[this._paths.find_time(this._currentTime)]
+
+    # Returns the index of the path at which a snapshot of the pixmap would be taken
+    # on the way to drawing the paths before 'stop'. Snapshots are taken at the
+    # simulation's keyframes (see Program.state_at), or every SNAPSHOT_PATHS paths
+    # if there aren't any (eg the program was loaded from the cache).
+    def get_snapshot_index(this, stop):
+        program = this._state.program
+        if (program and len(program.keyframes)):
+            frame = program.keyframes.find(time=float(this._paths.array["startTime"][stop]))
+            if (frame is None):
+                return 0
+            return min(frame.pathCount, stop)
+        return stop - stop % SNAPSHOT_PATHS
+
+    # Brings the pixmap up to date, so it shows the paths before 'stop'. When playing
+    # forward only the paths finished since the last frame are added to it. After
+    # seeking backwards (or a long way forwards) it starts again from the nearest
+    # snapshot taken earlier, and snapshots are kept of the last few keyframes
+    # passed ('mark' is the one before 'stop', see get_snapshot_index). They're all
+    # thrown away after zooming or panning. Returns False if the drawing was
+    # cancelled (see JobRenderer.cancelled).
+    def update_pixmap(this, renderer, stop, mark):
+        view = renderer.view
+        if (this._pixmap is None or view != this._pixmapView):
+            this._repaint = True
+        if (this._repaint):
+            this._snapshots.clear()
+            this._pixmapView = view
+
+        if (this._repaint or stop < this._pixmapCount or stop - this._pixmapCount > draw.LOD_MIN_PATHS):
+            # Start from the latest snapshot before this point, unless there are a
+            # lot of paths to draw after it (then starting over with a level of
+            # detail is quicker, see JobRenderer.draw_paths)
+            earlier = [n for n in this._snapshots if n <= stop]
+            start = max(earlier) if earlier else 0
+            if (start == 0 or mark - start > draw.LOD_MIN_PATHS):
+                this._pixmap = cairo.ImageSurface(cairo.FORMAT_RGB24, renderer.width, renderer.height)
+                renderer.draw_background(cairo.Context(this._pixmap))
+                this._pixmapCount = 0
+            else:
+                # Most recently used goes last
+                snapshot = this._snapshots.pop(start)
+                this._snapshots[start] = snapshot
+                this._pixmap = copy_surface(snapshot)
+                this._pixmapCount = start
+            this._repaint = False
+
+        if (this._pixmapCount < mark and mark not in this._snapshots):
+            # Passing a keyframe: draw up to it and keep a copy
+            if (not renderer.draw_paths(cairo.Context(this._pixmap), this._pixmapCount, mark)):
+                # Some of the paths may have been drawn, so it can't be added to
+                this._pixmap = None
+                return False
+            this._pixmapCount = mark
+            this._snapshots[mark] = copy_surface(this._pixmap)
+            while (len(this._snapshots) > MAX_SNAPSHOTS):
+                this._snapshots.popitem(last=False)
+
+        if (this._pixmapCount < stop):
+            if (not renderer.draw_paths(cairo.Context(this._pixmap), this._pixmapCount, stop)):
+                this._pixmap = None
+                return False
+            this._pixmapCount = stop
+        return True
 
+    # Asks the render thread for a frame showing the job as it currently stands,
+    # unless one has already been asked for
+    def request_frame(this):
+        if (not this._paths or this._state.bounds is None):
+            return
+        renderer = this.get_renderer()
         # Calculate which path object is being rendered at this time
-        currentPath = this.get_current_path()
-        if (not currentPath):
+        (currentPath, pathParam) = renderer.get_current_path(this._currentTime)
+        if (currentPath is None):
             return
+        renderer.minPos = tuple(renderer.minPos)
+        data = this._paths.array
+        request = RenderRequest(renderer, data, this._generation, currentPath, pathParam,
+                                this.get_snapshot_index(currentPath.index))
+        key = (request.view, request.generation, len(data), currentPath.index, pathParam)
+        if (key == this._requestKey):
+            return
+        this._requestKey = key
+
+        with this._renderLock:
+            this._request = request
+            current = this._rendering
+            if (current is not None and (current.view != request.view or
+                                         current.generation != request.generation or
+                                         current.path.index > currentPath.index)):
+                # The frame being drawn is for a different view or a later point in
+                # the job, so the pixmap it leaves behind is no good either
+                this._cancelRender = True
+            this._renderLock.notify()
+        if (this._renderThread is None):
+            this._renderThread = threading.Thread(target=this.render_thread_cb)
+            this._renderThread.daemon = True
+            this._renderThread.start()
+
+    # Whether the frame being drawn on the render thread has been cancelled
+    def is_render_cancelled(this):
+        return this._cancelRender
+
+    # Draws a frame for the given request (on the render thread). Returns None if
+    # it was cancelled.
+    def render_frame(this, request):
+        if (request.generation != this._renderGeneration):
+            this._renderPaths = gcode.PathTable()
+            this._renderPaths.set_array(request.data)
+            this._renderGeneration = request.generation
+            this._repaint = True
+        elif (len(request.data) != len(this._renderPaths)):
+            # The same job, simulated further since
+            this._renderPaths.extend_array(request.data)
+        renderer = request.renderer
+        renderer.paths = this._renderPaths
+        renderer.cancelled = this.is_render_cancelled
+
+        # The finished paths come from the pixmap, then the current path is drawn
+        # over the top of a copy
+        if (not this.update_pixmap(renderer, request.path.index, request.mark)):
+            return None
+        surface = copy_surface(this._pixmap)
+        headPos = renderer.draw_current_path(cairo.Context(surface), request.path, request.pathParam)
+        return Frame(surface, renderer, headPos)
+
+    # The render thread: draws frames as they're asked for and passes them back to
+    # the main loop
+    def render_thread_cb(this):
+        while True:
+            with this._renderLock:
+                while (this._request is None):
+                    this._renderLock.wait()
+                request = this._request
+                this._request = None
+                this._rendering = request
+                this._cancelRender = False
+            frame = this.render_frame(request)
+            with this._renderLock:
+                this._rendering = None
+            if (frame is not None):
+                GLib.idle_add(this.frame_ready_cb, frame)
+
+    # Called in the main loop when the render thread has finished a frame
+    def frame_ready_cb(this, frame):
+        this._frame = frame
+        this._headPos = frame.headPos
+        this.queue_draw()
+        return False
 
-        if (currentPath.duration == 0):
-            pathParam = 1
-        else:
-            pathParam = (this._currentTime-currentPath.startTime)/currentPath.duration
-
-        # Create a cairo context which we will use to do the rendering
+    # Called when this widget needs to be rendered. The frame comes from the render
+    # thread, so all that's left is to paint it and the cutting head on top.
+    def expose_cb(this, dwg, event):
+        this.request_frame()
+        frame = this._frame
+        if (frame is None):
+            return
         cr = this.get_window().cairo_create()
+        cr.set_source_surface(frame.surface, 0, 0)
+        cr.paint()
+        frame.renderer.draw_head(cr, frame.headPos)
 
-        cr.set_source_rgb(1,1,1)
-        cr.rectangle(0, 0, canvasWidth, canvasHeight)
-        cr.fill()
-
-        cr.set_source_rgb(0,0,0)
-        cr.rectangle(0, 0, canvasWidth, canvasHeight)
-        cr.stroke()
-
-        cr.select_font_face("Times")
-        cr.set_font_size(12)
-
-        # Draw the geometry scale in the lower-left corner
-        if (this._state.units == "mm"):
-            units = "cm"
-            mag = 10
-        else:
-            units = this._state.units
-            mag = 1
-
-        # Draw the scale in the bottom-right corner
-        w = this._resolution*mag*this._zoomLevel
-        h = w/3
-        h = max(h, 5)
-        h = min(h, 15)
-
-        x1 = canvasWidth-w-10
-        yp = canvasHeight-10
-        x2 = x1+w
-
-        # Draw a horizontal line
-        cr.set_source_rgb(0,0,1)
-        cr.move_to(x1, yp)
-        cr.line_to(x2, yp)
-        cr.stroke()
-        # Draw the tick on the left side
-        cr.move_to(x1, yp-h/2)
-        cr.line_to(x1, yp+h/2)
-        cr.stroke()
-        # Draw the tick on the right side
-        cr.move_to(x2, yp-h/2)
-        cr.line_to(x2, yp+h/2)
-        cr.stroke()
-        # Show the units
-        cr.move_to(x1-30, yp)
-        cr.show_text("1 %s" % units)
-        cr.stroke()
-
-        cr.set_source_rgb(0,0,0)
-
-        # Make the line thickness constant across all zoom levels
-        cr.set_line_width(0.4/this._zoomLevel)
-
-        cr.translate(this._offset[0], this._offset[1])
-
-        # Change the coordinate system we are using to make things easier below. Since the
-        # screen has (0, 0) in the upper-left corner, we need to translate everything 
-        # down to start at the bottom of the screen, then reflect it back up (mathematical
-        # y-axis goes up, but rendering y-axis goes down).
-        cr.translate(0, canvasHeight)
-        cr.scale(1, -1)
-
-        # Convert mm to pixel coordinates
-        cr.scale(this._resolution, this._resolution)
-        # Now apply the user-defined zoom factor
-        cr.scale(this._zoomLevel, this._zoomLevel)
-        # Shift everything so that geometry is always visible
-        cr.translate(-this._state.minPos[0]+this._border, 
-                     -this._state.minPos[1]+this._border)
-
-        lineCount = 0
-        t = time.time()
-        lastPos = None
-        for path in this._paths:
-            if (isinstance(path, gcode.Line)):
-                # Plotting a linear path
-                if (path == currentPath):
-                    end = path.start + (path.end-path.start)*pathParam
-                else:
-                    end = path.end
-
-                if (path.rapid):
-                    # Rapid movement (spindle should be off here)
-                    cr.set_source_rgb(1,0.5,1)
-                else:
-                    # Cutting movement
-                    cr.set_source_rgb(0,0,0)
-                # Draw the line
-                cr.move_to(*path.start)
-                cr.line_to(*end)
-                cr.stroke()
-                lineCount += 1
-                lastPos = end.copy()
-
-            elif (isinstance(path, gcode.Arc)):
-                # Plotting an arc path
-                angle1 = path.angle1
-                angle2 = path.angle2
-
-                if (path == currentPath):
-                    if (abs(angle2-angle1) > math.pi):
-                        if (angle1 < math.pi):
-                            angle2 -= 2*math.pi
-                        else:
-                            angle2 += 2*math.pi
-
-                    angle2 = angle1 + (angle2-angle1)*pathParam
-
-                # Calculate the end position of the arc, so we can position the cutting head below
-                lastPos = path.center + numpy.array([path.radius*math.cos(angle2), path.radius*math.sin(angle2)])
-
-                # Normally the arc is rendered in the counter-clockwise direction
-                if (path.clockwise):
-                    (angle1, angle2) = (angle2, angle1)
-
-                # Finally render the arc
-                if (abs(angle1-angle2) > 0.06):
-                    cr.set_source_rgb(0,0,0)
-                    cr.arc(
-                        path.center[0], 
-                        path.center[1], path.radius, angle1, angle2)
-                    cr.stroke()
-                else:
-                    # Draw the line
-                    cr.set_source_rgb(0,0,0)
-                    cr.move_to(*path.start)
-                    cr.line_to(*lastPos)
-                    cr.stroke()
-
-            if (path == currentPath):
-                break
-
-        if (lastPos is not None):
-            # Render the cutting head
-            (xp, yp) = lastPos
-            size = 1.5
-            cr.set_source_rgb(1,0,0)
-            cr.arc(xp, yp, size, 0, 2*math.pi)
-            cr.stroke()
-            this._headPos = lastPos.copy()
-
-    # Called when this widget needs to be rendered
-    def expose_cb(this, dwg, event):
+    def resize_cb(this, *args):
+        this.queue_draw()
+
+    def animate_cb(this, *args):
         if (this._playing):
             # Advance the clock
             this._currentTime += time.time()-this._lastTime
             # Keep within the timeline
             this._currentTime = max(0, this._currentTime)
-            if (this._currentTime > this._state.get_run_length()):
+            this._state.ensure_time(this._currentTime)
+            if (this._state.finished and this._currentTime > this._state.get_run_length()):
                 # Stop playing
                 this._currentTime = this._state.get_run_length()
                 this._playing = False
             this._lastTime = time.time()
             this.emit("time-changed", this._currentTime)
-            this._repaint = True
-
-        this.repaint_buffer()
-
-    def animate_cb(this, *args):
         this.queue_draw()
         return True
 
@@ -0,0 +1,136 @@
+# Python G-Code simulator
+#
+# Copyright (C) 2011 Peter Rogers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+# Simplifies the polylines in a path table (see gcode.PathTable), merging runs of
+# short line segments into fewer, longer ones that stay within a tolerance of
+# the original geometry. This uses the Ramer-Douglas-Peucker algorithm, but
+# rather than recursing into one polyline at a time every polyline in the table
+# is processed together: each pass measures all the remaining points against
+# their current chords in one go with NumPy, and splits every chord that's out
+# of tolerance at its furthest point. The number of passes is the depth the
+# recursion would have reached, which is usually about log2 of the run length.
+#
+# A run of lines is only merged if the lines join up end to end and share the
+# same tool, spindle, rapid and feed rate settings, so those boundaries are kept.
+# Each merged row keeps the statement of the first line it replaces, along with
+# the total length and duration of the lines, so job totals and timing are
+# unchanged.
+
+from __future__ import absolute_import, division, print_function
+
+import numpy
+
+###########
+# Globals #
+###########
+
+# Path kinds (these match the ones in gcode.py)
+PATH_LINE = 0
+
+#############
+# Functions #
+#############
+
+# Returns the simplified rows of the given path table rows, and for each of them
+# the index of the first original row it replaces
+def simplify_rows(rows, tolerance):
+    count = len(rows)
+    if (count == 0):
+        return (rows.copy(), numpy.zeros(0, dtype=numpy.int64))
+
+    lines = (rows["kind"] == PATH_LINE)
+    # Whether each row carries on the polyline started by the previous row
+    joined = numpy.zeros(count, dtype=bool)
+    joined[1:] = (lines[1:] & lines[:-1] &
+                  (rows["spindleOn"][1:] == rows["spindleOn"][:-1]) &
+                  (rows["rapid"][1:] == rows["rapid"][:-1]) &
+                  (rows["feedRate"][1:] == rows["feedRate"][:-1]) &
+                  (rows["tool"][1:] == rows["tool"][:-1]) &
+                  (rows["start"][1:] == rows["end"][:-1]).all(axis=1))
+
+    # Lay out the vertices of every row: the start point of each row that begins
+    # a new polyline (or isn't a line), followed by the end point of each row.
+    # Row n ends at vertex n + (the number of polylines started up to row n).
+    starts = ~joined
+    vertexOfEnd = numpy.arange(count) + numpy.cumsum(starts)
+    points = numpy.zeros((count + starts.sum(), 2))
+    points[vertexOfEnd] = rows["end"]
+    points[vertexOfEnd[starts]-1] = rows["start"][starts]
+
+    # Vertices that have to be kept: the ends of the polylines, and both ends of
+    # anything that isn't a line
+    keep = numpy.ones(len(points), dtype=bool)
+    interior = numpy.zeros(count, dtype=bool)
+    interior[:-1] = joined[1:]
+    keep[vertexOfEnd[interior]] = False
+
+    _douglas_peucker(points, keep, tolerance)
+
+    # Each kept end vertex finishes a simplified row, which replaces the original
+    # rows back to the previous kept vertex
+    ends = numpy.nonzero(keep[vertexOfEnd])[0]
+    first = numpy.zeros(len(ends), dtype=numpy.int64)
+    first[1:] = ends[:-1]+1
+
+    result = rows[first].copy()
+    result["end"] = rows["end"][ends]
+    result["length"] = numpy.add.reduceat(rows["length"], first)
+    result["duration"] = numpy.add.reduceat(rows["duration"], first)
+    return (result, first)
+
+# Runs the Douglas-Peucker algorithm over all the polylines at once. On return
+# 'keep' marks the points to keep.
+def _douglas_peucker(points, keep, tolerance):
+    index = numpy.arange(len(points))
+    while 1:
+        if (keep.all()):
+            return
+        # For each point, the kept points either side of it which form its chord
+        before = numpy.maximum.accumulate(numpy.where(keep, index, 0))
+        after = numpy.minimum.accumulate(numpy.where(keep, index, len(points))[::-1])[::-1]
+        todo = numpy.nonzero(~keep)[0]
+        p1 = points[before[todo]]
+        p2 = points[after[todo]]
+        pt = points[todo]
+
+        # The distance from each point to its chord (or to the chord's start point,
+        # if it's a closed loop)
+        chord = p2 - p1
+        chordLength = numpy.hypot(chord[:,0], chord[:,1])
+        rel = pt - p1
+        cross = numpy.abs(chord[:,0]*rel[:,1] - chord[:,1]*rel[:,0])
+        closed = (chordLength == 0)
+        dist = numpy.where(closed, 0, cross/numpy.where(closed, 1, chordLength))
+        dist[closed] = numpy.hypot(rel[closed,0], rel[closed,1])
+
+        # Find the furthest point from each chord. The points under a chord are
+        # all together in 'todo', and groups are separated where 'before' changes.
+        group = before[todo]
+        groupStart = numpy.nonzero(numpy.r_[True, group[1:] != group[:-1]])[0]
+        furthest = numpy.maximum.reduceat(dist, groupStart)
+        split = furthest > tolerance
+        if (not split.any()):
+            return
+
+        # Keep the (first) furthest point of each chord that's out of tolerance
+        counts = numpy.diff(numpy.r_[groupStart, len(todo)])
+        isMax = (dist == numpy.repeat(furthest, counts)) & numpy.repeat(split, counts)
+        candidates = numpy.nonzero(isMax)[0]
+        firstOfGroup = numpy.r_[True, group[candidates[1:]] != group[candidates[:-1]]]
+        keep[todo[candidates[firstOfGroup]]] = True
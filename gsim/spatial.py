@@ -0,0 +1,164 @@
+# Python G-Code simulator
+#
+# Copyright (C) 2011 Peter Rogers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+# A spatial index over the paths in a path table, for finding the paths within a
+# rectangle (eg the part of the job on screen) or nearest to a point (eg where
+# the user clicked). The paths' bounding boxes are bucketed into a uniform grid,
+# which is built in one go with NumPy and stored as a flat array of path indices
+# sorted by grid cell. Paths spanning a lot of cells (like long rapid moves) are
+# kept in a separate list that's always checked, so they don't bloat the grid.
+
+from __future__ import absolute_import, division, print_function
+
+import math
+import numpy
+
+from gsim.tessellate import arc_sweep
+
+###########
+# Globals #
+###########
+
+# Path kinds (these match the ones in gcode.py)
+PATH_LINE = 0
+PATH_ARC = 1
+
+# The most grid cells used for an index
+MAX_CELLS = 1 << 20
+
+# Paths covering more than this many cells are not stored in the grid
+MAX_SPAN = 64
+
+#############
+# Functions #
+#############
+
+# Returns the distance from the point to each of the given path rows. Dwells and
+# tool changes are treated as points.
+def distance_to_paths(rows, pos):
+    (x, y) = pos
+    start = rows["start"]
+    end = rows["end"]
+    kind = rows["kind"]
+
+    # Lines: the distance to the closest point on the segment
+    delta = end - start
+    length2 = (delta**2).sum(axis=1)
+    rel = numpy.column_stack((x-start[:,0], y-start[:,1]))
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        param = numpy.clip((rel*delta).sum(axis=1)/length2, 0, 1)
+    param[length2 == 0] = 0
+    closest = start + delta*param[:,None]
+    dist = numpy.hypot(x-closest[:,0], y-closest[:,1])
+
+    # Arcs: the distance to the circle if the point is within the arc's sweep,
+    # otherwise the distance to the nearer end point
+    arcs = numpy.flatnonzero(kind == PATH_ARC)
+    if (len(arcs)):
+        arc = rows[arcs]
+        center = arc["center"]
+        angle = numpy.arctan2(y-center[:,1], x-center[:,0])
+        turned = numpy.where(arc["clockwise"], arc["angle1"]-angle, angle-arc["angle1"]) % (2*math.pi)
+        inside = turned <= arc_sweep(arc)
+        toCircle = numpy.abs(numpy.hypot(x-center[:,0], y-center[:,1]) - arc["radius"])
+        toEnds = numpy.minimum(numpy.hypot(x-arc["start"][:,0], y-arc["start"][:,1]),
+                               numpy.hypot(x-arc["end"][:,0], y-arc["end"][:,1]))
+        dist[arcs] = numpy.where(inside, toCircle, toEnds)
+
+    others = (kind != PATH_LINE) & (kind != PATH_ARC)
+    dist[others] = numpy.hypot(x-start[others,0], y-start[others,1])
+    return dist
+
+# Returns a mask of the extents (see gcode.path_extents) which overlap the rectangle
+def overlaps(extents, xmin, ymin, xmax, ymax):
+    return ((extents[:,0] <= xmax) & (extents[:,2] >= xmin) &
+            (extents[:,1] <= ymax) & (extents[:,3] >= ymin))
+
+###########
+# Classes #
+###########
+
+# A uniform grid over the bounding boxes of a set of paths
+class GridIndex(object):
+    # The number of paths indexed
+    size = 0
+
+    def __init__(this, extents):
+        this.extents = extents
+        this.size = count = len(extents)
+        if (count == 0):
+            this.origin = numpy.zeros(2)
+            this.cellSize = 1.0
+            (this.nx, this.ny) = (1, 1)
+            this.cellStart = numpy.zeros(2, dtype=numpy.int64)
+            this.entries = numpy.zeros(0, dtype=numpy.int64)
+            this.large = numpy.zeros(0, dtype=numpy.int64)
+            return
+
+        lo = extents[:,:2].min(axis=0)
+        hi = extents[:,2:].max(axis=0)
+        (width, height) = hi - lo
+        # Aim for a few paths per cell, within the limit on the number of cells
+        area = max(width*height, 1e-12)
+        cellSize = max(math.sqrt(area/count), math.sqrt(area/MAX_CELLS),
+                       max(width, height)/MAX_CELLS, 1e-9)
+        this.origin = lo
+        this.cellSize = cellSize
+        this.nx = int(width/cellSize)+1
+        this.ny = int(height/cellSize)+1
+
+        (cx0, cy0, cx1, cy1) = this._cell_range(extents[:,0], extents[:,1], extents[:,2], extents[:,3])
+        spanX = cx1-cx0+1
+        span = spanX*(cy1-cy0+1)
+        isLarge = (span > MAX_SPAN)
+        this.large = numpy.flatnonzero(isLarge)
+
+        # List every (cell, path) pair, then sort them by cell
+        small = numpy.flatnonzero(~isLarge)
+        counts = span[small]
+        paths = numpy.repeat(small, counts)
+        offsets = numpy.repeat(numpy.cumsum(counts)-counts, counts)
+        k = numpy.arange(len(paths)) - offsets
+        cx = cx0[paths] + k % spanX[paths]
+        cy = cy0[paths] + k // spanX[paths]
+        cells = cy*this.nx + cx
+        order = numpy.argsort(cells, kind="stable")
+        this.entries = paths[order]
+        this.cellStart = numpy.searchsorted(cells[order], numpy.arange(this.nx*this.ny+1))
+
+    # Returns the range of grid cells covering the given box(es)
+    def _cell_range(this, xmin, ymin, xmax, ymax):
+        def cell(value, origin, limit):
+            return numpy.clip(numpy.floor((value-origin)/this.cellSize), 0, limit-1).astype(numpy.int64)
+        return (cell(xmin, this.origin[0], this.nx), cell(ymin, this.origin[1], this.ny),
+                cell(xmax, this.origin[0], this.nx), cell(ymax, this.origin[1], this.ny))
+
+    # Returns the (sorted) indices of the paths whose bounding boxes overlap the
+    # rectangle
+    def query(this, xmin, ymin, xmax, ymax):
+        if (this.size == 0):
+            return numpy.zeros(0, dtype=numpy.int64)
+        (cx0, cy0, cx1, cy1) = [int(v) for v in this._cell_range(
+            numpy.array(xmin), numpy.array(ymin), numpy.array(xmax), numpy.array(ymax))]
+        cells = (numpy.arange(cy0, cy1+1)[:,None]*this.nx + numpy.arange(cx0, cx1+1)[None,:]).ravel()
+        starts = this.cellStart[cells]
+        counts = this.cellStart[cells+1] - starts
+        index = numpy.repeat(starts - (numpy.cumsum(counts)-counts), counts) + numpy.arange(counts.sum())
+        found = numpy.union1d(this.entries[index], this.large)
+        return found[overlaps(this.extents[found], xmin, ymin, xmax, ymax)]
@@ -0,0 +1,216 @@
+# Python G-Code simulator
+#
+# Copyright (C) 2011 Peter Rogers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+# Turns the arcs in a path table into polylines, so they can be drawn, measured
+# and searched like any other run of points. Every arc in the table is done at
+# once with NumPy. Each arc gets just enough segments that the chords stay within
+# a tolerance of the true arc, so the right tolerance depends on the zoom level:
+# ArcCache keeps the results for the last few zoom levels around.
+
+from __future__ import absolute_import, division, print_function
+
+import math
+import collections
+import numpy
+
+###########
+# Globals #
+###########
+
+# Path kinds (these match the ones in gcode.py)
+PATH_LINE = 0
+PATH_ARC = 1
+
+# Limits on the number of segments used for each arc
+MIN_SEGMENTS = 1
+MAX_SEGMENTS = 4096
+
+#############
+# Functions #
+#############
+
+# Returns the angle swept by each arc in the given rows, in the direction of travel.
+# A zero sweep is taken to be a full circle.
+def arc_sweep(rows):
+    angle1 = rows["angle1"]
+    angle2 = rows["angle2"]
+    sweep = numpy.where(rows["clockwise"], angle1-angle2, angle2-angle1) % (2*math.pi)
+    sweep[sweep == 0] = 2*math.pi
+    return sweep
+
+# Turns the given arc rows into polylines whose segments stay within 'tolerance'
+# of the arcs. Returns (points, offsets), where the points of arc n are
+# points[offsets[n]:offsets[n+1]] (the first and last being its end points).
+def tessellate_arcs(rows, tolerance):
+    count = len(rows)
+    if (count == 0):
+        return (numpy.zeros((0, 2)), numpy.zeros(1, dtype=numpy.int64))
+
+    radius = rows["radius"]
+    sweep = arc_sweep(rows)
+    # The largest angle a chord can cover while its midpoint stays within the
+    # tolerance of the arc
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        step = 2*numpy.arccos(numpy.clip(1 - tolerance/radius, -1, 1))
+        segments = numpy.ceil(sweep/step)
+    segments = numpy.nan_to_num(segments, nan=MIN_SEGMENTS, posinf=MAX_SEGMENTS)
+    segments = numpy.clip(segments, MIN_SEGMENTS, MAX_SEGMENTS).astype(numpy.int64)
+
+    offsets = numpy.zeros(count+1, dtype=numpy.int64)
+    numpy.cumsum(segments+1, out=offsets[1:])
+    arc = numpy.repeat(numpy.arange(count), segments+1)
+    step = numpy.arange(offsets[-1]) - offsets[arc]
+    direction = numpy.where(rows["clockwise"], -1.0, 1.0)
+    angle = rows["angle1"][arc] + (direction*sweep)[arc]*step/segments[arc]
+    center = rows["center"][arc]
+    points = numpy.empty((offsets[-1], 2))
+    points[:,0] = center[:,0] + radius[arc]*numpy.cos(angle)
+    points[:,1] = center[:,1] + radius[arc]*numpy.sin(angle)
+    # Make sure the end points match up exactly with the neighbouring paths
+    points[offsets[:-1]] = rows["start"]
+    points[offsets[1:]-1] = rows["end"]
+    return (points, offsets)
+
+# Returns the given rows of a path table as polylines: lines become two points and
+# arcs come from the given Tessellation (which must cover them). Returns (points,
+# counts), where 'counts' is the number of points for each row (zero for dwells
+# and tool changes) and the points are listed row by row.
+def trace_rows(data, rows, arcs):
+    kind = data["kind"][rows]
+    isLine = (kind == PATH_LINE)
+    isArc = (kind == PATH_ARC)
+    (arcRows, arcPoints, arcOffsets) = arcs.get_arrays()
+    n = numpy.searchsorted(arcRows, rows[isArc])
+    arcCounts = arcOffsets[n+1] - arcOffsets[n]
+
+    counts = numpy.zeros(len(rows), dtype=numpy.int64)
+    counts[isLine] = 2
+    counts[isArc] = arcCounts
+    first = numpy.cumsum(counts) - counts
+    points = numpy.empty((counts.sum(), 2))
+    points[first[isLine]] = data["start"][rows[isLine]]
+    points[first[isLine]+1] = data["end"][rows[isLine]]
+    # The points of each arc, copied over in one go
+    step = numpy.arange(arcCounts.sum()) - numpy.repeat(numpy.cumsum(arcCounts)-arcCounts, arcCounts)
+    points[numpy.repeat(first[isArc], arcCounts) + step] = arcPoints[numpy.repeat(arcOffsets[n], arcCounts) + step]
+    return (points, counts)
+
+# Joins up consecutive polylines (as returned by trace_rows) that meet end to end.
+# Returns (points, moves) where 'moves' marks the points that start a new polyline
+# and the other points carry on from the one before.
+def join_polylines(points, counts):
+    counts = counts[counts > 0]
+    first = numpy.cumsum(counts) - counts
+    last = first + counts - 1
+    joined = numpy.zeros(len(counts), dtype=bool)
+    joined[1:] = (points[first[1:]] == points[last[:-1]]).all(axis=1)
+    moves = numpy.zeros(len(points), dtype=bool)
+    moves[first[~joined]] = True
+    # The first point of a joined polyline is the last point of the one before
+    keep = numpy.ones(len(points), dtype=bool)
+    keep[first[joined]] = False
+    return (points[keep], moves[keep])
+
+# Returns the array with room for at least 'size' items, growing it geometrically
+def _reserve(array, used, size):
+    if (size <= len(array)):
+        return array
+    grown = numpy.zeros((max(size, 2*len(array)),) + array.shape[1:], dtype=array.dtype)
+    grown[:used] = array[:used]
+    return grown
+
+###########
+# Classes #
+###########
+
+# The arcs of a path table as polylines, for one tolerance. This covers the first
+# 'size' rows of the table and can be extended as the table grows.
+class Tessellation(object):
+    def __init__(this, tolerance):
+        this.tolerance = tolerance
+        # The number of table rows covered
+        this.size = 0
+        # The table row of each arc, and where its points are (see tessellate_arcs)
+        this._rows = numpy.zeros(0, dtype=numpy.int64)
+        this._offsets = numpy.zeros(1, dtype=numpy.int64)
+        this._points = numpy.zeros((0, 2))
+        this._count = 0
+
+    # Adds the arcs from any rows of the table that aren't covered yet
+    def extend(this, data):
+        if (len(data) <= this.size):
+            return
+        new = data[this.size:]
+        arcs = numpy.flatnonzero(new["kind"] == PATH_ARC)
+        (points, offsets) = tessellate_arcs(new[arcs], this.tolerance)
+
+        count = this._count + len(arcs)
+        used = this._offsets[this._count]
+        this._rows = _reserve(this._rows, this._count, count)
+        this._rows[this._count:count] = arcs + this.size
+        this._offsets = _reserve(this._offsets, this._count+1, count+1)
+        this._offsets[this._count+1:count+1] = offsets[1:] + used
+        this._points = _reserve(this._points, used, used+len(points))
+        this._points[used:used+len(points)] = points
+        this._count = count
+        this.size = len(data)
+
+    # Returns the points of the arc in the given table row (or None if that row
+    # isn't an arc)
+    def get_points(this, row):
+        rows = this._rows[:this._count]
+        n = numpy.searchsorted(rows, row)
+        if (n >= this._count or rows[n] != row):
+            return None
+        return this._points[this._offsets[n]:this._offsets[n+1]]
+
+    # Returns (rows, points, offsets) for all the arcs covered, where the points of
+    # the arc in table row rows[n] are points[offsets[n]:offsets[n+1]]
+    def get_arrays(this):
+        return (this._rows[:this._count], this._points[:this._offsets[this._count]],
+                this._offsets[:this._count+1])
+
+# Keeps the tessellations of a path table for the most recently used tolerances.
+# Tolerances are rounded down to a power of two, so zooming in and out a little
+# doesn't cause the arcs to be redone.
+class ArcCache(object):
+    # The number of tolerances kept
+    maxEntries = 4
+
+    def __init__(this, maxEntries=None):
+        if (maxEntries is not None):
+            this.maxEntries = maxEntries
+        this._entries = collections.OrderedDict()
+
+    # Returns the tessellation of the given table rows at (at least) the given
+    # tolerance
+    def get(this, data, tolerance):
+        bucket = int(math.floor(math.log(tolerance, 2)))
+        entry = this._entries.pop(bucket, None)
+        if (entry is None):
+            entry = Tessellation(2.0**bucket)
+        entry.extend(data)
+        # Most recently used goes last
+        this._entries[bucket] = entry
+        while (len(this._entries) > this.maxEntries):
+            this._entries.popitem(last=False)
+        return entry
+
+    def clear(this):
+        this._entries.clear()
@@ -12,7 +12,11 @@ setup(
     description = "G-Code simulator",
     license = "GPLv2+",
     packages=['gsim'],
-    entry_points={'gui_scripts': ['gsim = gsim.main:main']},
+    entry_points={
+        'gui_scripts': ['gsim = gsim.main:main'],
+        'console_scripts': ['gsim-batch = gsim.batch:main',
+                            'gsim-render = gsim.draw:main'],
+    },
     long_description=long_desc,
     classifiers=[
         'Development Status :: 4 - Beta',
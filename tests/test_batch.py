@@ -0,0 +1,135 @@
+# Python G-Code simulator
+#
+# Copyright (C) 2011 Peter Rogers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import absolute_import, division, print_function
+
+import io
+import os
+import sys
+import csv
+import json
+import shutil
+import pytest
+
+from gsim import batch
+from gsim import gcode
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "examples")
+
+# Returns a directory holding the examples, a file that can't be simulated and a
+# file that isn't G-code
+def make_jobs(tmpdir):
+    jobs = os.path.join(str(tmpdir), "jobs")
+    os.makedirs(os.path.join(jobs, "more"))
+    shutil.copy(os.path.join(EXAMPLES, "circle-test.ngc"), jobs)
+    shutil.copy(os.path.join(EXAMPLES, "output.ngc"), os.path.join(jobs, "more", "output.NC"))
+    fd = open(os.path.join(jobs, "bad.ngc"), "w")
+    try:
+        # Arcs need a center
+        fd.write("G21\nM3\nG02 X1 Y1\n")
+    finally:
+        fd.close()
+    open(os.path.join(jobs, "notes.txt"), "w").close()
+    return jobs
+
+def test_find_files(tmpdir):
+    jobs = make_jobs(tmpdir)
+    circle = os.path.join(jobs, "circle-test.ngc")
+    expected = [os.path.join(jobs, "bad.ngc"), circle, os.path.join(jobs, "more", "output.NC")]
+    assert batch.find_files([jobs]) == expected
+    # Without duplicates, and keeping names that don't match anything
+    missing = os.path.join(jobs, "missing.ngc")
+    assert batch.find_files([circle, os.path.join(jobs, "*.ngc"), missing]) == [
+        circle, os.path.join(jobs, "bad.ngc"), missing]
+
+def test_estimate_file():
+    path = os.path.join(EXAMPLES, "circle-test.ngc")
+    record = batch.estimate_file(path)
+    prog = gcode.parse_program(path)
+    state = prog.start()
+    state.run()
+    assert record["path"] == path
+    assert record["statements"] == state.lineno
+    assert record["units"] == "mm"
+    assert record["runLength"] == pytest.approx(state.time)
+    assert record["cutLength"] == pytest.approx(state.cutLength)
+    assert record["rapidLength"] == pytest.approx(state.rapidLength)
+    assert [record["xmin"], record["ymin"]] == pytest.approx(state.minPos.tolist())
+    assert [record["xmax"], record["ymax"]] == pytest.approx(state.maxPos.tolist())
+    assert record["invalidLines"] == len(prog.invalidLines)
+    assert record["error"] is None
+
+# Runs gsim-batch with the given arguments, returning its exit code
+def run_main(monkeypatch, args):
+    monkeypatch.setattr(sys, "argv", ["gsim-batch", "-j", "2"] + args)
+    try:
+        batch.main()
+    except SystemExit as e:
+        return e.code
+    return 0
+
+@pytest.mark.parametrize("format", ["csv", "json"])
+def test_main(tmpdir, monkeypatch, format):
+    output = os.path.join(str(tmpdir), "out." + format)
+    assert run_main(monkeypatch, ["-f", format, "-o", output, EXAMPLES]) == 0
+    fd = io.open(output, newline="")
+    try:
+        if (format == "csv"):
+            rows = list(csv.reader(fd))
+            assert rows[0] == list(batch.FIELDS)
+            records = [dict(zip(rows[0], row)) for row in rows[1:]]
+        else:
+            records = [json.loads(line) for line in fd]
+    finally:
+        fd.close()
+
+    records = dict((record["path"], record) for record in records)
+    assert sorted(records) == batch.find_files([EXAMPLES])
+    for (path, record) in records.items():
+        expected = batch.estimate_file(path)
+        if (format == "csv"):
+            assert float(record["runLength"]) == pytest.approx(expected["runLength"])
+            assert int(record["statements"]) == expected["statements"]
+            assert record["error"] == ""
+        else:
+            assert record["runLength"] == pytest.approx(expected["runLength"])
+            assert record["statements"] == expected["statements"]
+            assert record["error"] is None
+
+# A file that can't be simulated gets an error in its record, without stopping
+# the others
+def test_main_error(tmpdir, monkeypatch):
+    jobs = make_jobs(tmpdir)
+    output = os.path.join(str(tmpdir), "out.json")
+    assert run_main(monkeypatch, ["-o", output, jobs]) == 2
+    fd = open(output)
+    try:
+        records = dict((record["path"], record) for record in map(json.loads, fd))
+    finally:
+        fd.close()
+    assert sorted(records) == batch.find_files([jobs])
+    bad = records.pop(os.path.join(jobs, "bad.ngc"))
+    assert bad["error"] == "KeyError: 'I'"
+    assert bad["runLength"] is None
+    for record in records.values():
+        assert record["error"] is None
+        assert record["runLength"] > 0
+
+def test_no_files(tmpdir, monkeypatch):
+    assert run_main(monkeypatch, [str(tmpdir)]) == 1
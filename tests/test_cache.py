@@ -0,0 +1,163 @@
+# Python G-Code simulator
+#
+# Copyright (C) 2011 Peter Rogers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import numpy
+
+from gsim import cache
+from gsim import gcode
+from gsim import motion
+
+PROGRAM = """G21
+#1 = 2.5
+#<depth> = [#1*2]
+G00 X0 Y0
+M3
+G01 X[#1*4] Y#<depth> F600
+G02 X20 Y5 I5 J0
+G04 P1.5
+T2
+M06
+G01 X0 Y0 (back home)
+M5
+M02
+"""
+
+def write_program(tmpdir):
+    path = os.path.join(str(tmpdir), "test.ngc")
+    fd = open(path, "w")
+    try:
+        fd.write(PROGRAM)
+    finally:
+        fd.close()
+    return path
+
+# Returns the parameters of a statement with the expressions as text
+def describe(params):
+    return sorted((key, value if isinstance(value, float) else value.text)
+                  for (key, value) in params.items())
+
+def test_program_round_trip(tmpdir):
+    path = write_program(tmpdir)
+    programCache = cache.ProgramCache(os.path.join(str(tmpdir), "cache"))
+    prog = gcode.parse_program(path, cache=programCache)
+    assert not isinstance(prog.statements, gcode.StatementTable)
+    assert prog.invalidLines == []
+
+    cached = gcode.parse_program(path, cache=programCache)
+    assert isinstance(cached.statements, gcode.StatementTable)
+    # Spread the statements over several blocks
+    cached.statements.BLOCK_SIZE = 4
+    assert len(cached.statements) == len(prog.statements)
+    for (st, original) in zip(cached.statements, prog.statements):
+        assert (st.code, st.lineNumber, st.offset) == (original.code, original.lineNumber, original.offset)
+        assert describe(st.params) == describe(original.params)
+        assert repr(st.args) == repr(original.args)
+    # The statements are only created once
+    assert cached.statements[3] is cached.statements[3]
+    assert cached.get_command(10) == prog.statements[10].command
+    # Running the cached program gives the same paths
+    first = prog.start()
+    first.run()
+    second = gcode.parse_program(path, cache=programCache).start()
+    assert second.finished
+    assert numpy.array_equal(first.paths.array, second.paths.array)
+    assert second.time == first.time
+    assert second.variables == first.variables
+    assert second.tool == 2
+
+def test_state_depends_on_profile(tmpdir):
+    path = write_program(tmpdir)
+    programCache = cache.ProgramCache(os.path.join(str(tmpdir), "cache"))
+    prog = gcode.parse_program(path, cache=programCache)
+    plain = prog.start()
+    plain.run()
+    # A state stored without a profile is planned again with one
+    prog = gcode.parse_program(path, cache=programCache)
+    prog.profile = motion.MachineProfile()
+    planned = programCache.load_state(prog)
+    assert planned.finished and planned.resumed
+    expected = motion.plan_durations(plain.paths.array, prog.profile, 1.0)
+    assert numpy.allclose(planned.paths.array["duration"], expected)
+    assert planned.time == planned.paths.get_end_time()
+    assert planned.paths.get_end_time() > plain.paths.get_end_time()
+    # And the other way round
+    programCache = cache.ProgramCache(os.path.join(str(tmpdir), "other"))
+    prog = gcode.parse_program(path, cache=programCache)
+    prog.profile = motion.MachineProfile()
+    prog.start().run()
+    prog = gcode.parse_program(path, cache=programCache)
+    unplanned = programCache.load_state(prog)
+    assert numpy.allclose(unplanned.paths.array["duration"], plain.paths.array["duration"])
+    assert unplanned.paths.get_end_time() == plain.paths.get_end_time()
+
+def test_state_with_profile(tmpdir):
+    path = write_program(tmpdir)
+    programCache = cache.ProgramCache(os.path.join(str(tmpdir), "cache"))
+    prog = gcode.parse_program(path, cache=programCache)
+    prog.profile = motion.MachineProfile()
+    first = prog.start()
+    first.run()
+    prog = gcode.parse_program(path, cache=programCache)
+    prog.profile = motion.MachineProfile()
+    second = prog.start()
+    assert second.finished
+    assert second.units == "mm"
+    assert second.paths.unitScale == first.paths.unitScale == 1.0
+    assert second.time == first.time
+    # Planning the restored table again gives the same timing
+    durations = motion.plan_durations(second.paths.array, prog.profile, second.paths.unitScale)
+    assert numpy.allclose(durations, first.paths.array["duration"])
+
+def test_changed_file_misses(tmpdir):
+    path = write_program(tmpdir)
+    programCache = cache.ProgramCache(os.path.join(str(tmpdir), "cache"))
+    key = programCache.get_key(path)
+    fd = open(path, "a")
+    fd.write("G00 X1 Y1\n")
+    fd.close()
+    assert programCache.get_key(path) != key
+    assert programCache.load_program(key, path) is None
+
+def test_evict(tmpdir):
+    path = write_program(tmpdir)
+    programCache = cache.ProgramCache(os.path.join(str(tmpdir), "cache"), maxSize=1)
+    gcode.parse_program(path, cache=programCache)
+    assert os.listdir(programCache.directory) == []
+
+def test_cached_state_is_not_stored_again(tmpdir):
+    path = os.path.join(str(tmpdir), "early.ngc")
+    fd = open(path, "w")
+    fd.write("G21\nM3\nG01 X1 Y1 F60\nM02\nG01 X50 Y50\n")
+    fd.close()
+    programCache = cache.ProgramCache(os.path.join(str(tmpdir), "cache"))
+    gcode.parse_program(path, cache=programCache).start().run()
+    stored = os.path.join(programCache.directory, programCache.get_key(path), "paths.npy")
+    mtime = os.path.getmtime(stored)
+    os.utime(stored, (mtime-100, mtime-100))
+
+    for n in range(2):
+        state = gcode.parse_program(path, cache=programCache).start()
+        assert state.resumed
+        state.run()
+        assert len(state.paths) == 1
+        assert state.maxPos.tolist() == [1, 1]
+    assert os.path.getmtime(stored) == mtime-100
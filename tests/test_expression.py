@@ -0,0 +1,82 @@
+# Python G-Code simulator
+#
+# Copyright (C) 2011 Peter Rogers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import absolute_import, division, print_function
+
+import math
+import pytest
+
+from gsim import expression
+
+def test_constants_are_folded():
+    assert expression.compile_expression("[1+2]*3") == 9.0
+    assert expression.compile_expression("SIN[90]") == pytest.approx(1.0)
+    assert expression.compile_expression("ATAN[1]/[1]") == pytest.approx(45.0)
+
+def test_variables():
+    exp = expression.compile_expression("[2*#1+#<depth>]")
+    assert isinstance(exp, expression.Expression)
+    assert exp.evaluate({1 : 3.0, "depth" : 0.5}) == 6.5
+    # Numbers in parameter names aren't taken out as constants
+    assert expression.evaluate("#<x2>-#12", {"x2" : 5.0, 12 : 1.0}) == 4.0
+
+def test_errors():
+    with pytest.raises(expression.ExpressionError):
+        expression.compile_expression("[1+")
+    with pytest.raises(expression.ExpressionError):
+        expression.compile_expression("$1")
+    # Constant expressions that can't be worked out fail when they're evaluated
+    exp = expression.compile_expression("[1/0]")
+    with pytest.raises(ZeroDivisionError):
+        exp.evaluate({})
+
+def test_cache():
+    exp = expression.compile_expression("[#1*2.5]")
+    assert expression.compile_expression("[#1*2.5]") is exp
+
+# Expressions that only differ in their numbers share one compiled shape
+def test_shapes_are_shared():
+    (shape, constants) = expression.split_expression("[#1*2.5+.5]")
+    assert shape == "[#1*$+$]"
+    assert constants == [2.5, 0.5]
+    first = expression.compile_expression("[#1*1.25+7]")
+    count = len(expression._shapes)
+    second = expression.compile_expression("[#1*3+0.125]")
+    assert len(expression._shapes) == count
+    assert expression.get_shape(shape) is expression.get_shape("[#1*$+$]")
+    assert first.evaluate({1 : 2.0}) == 9.5
+    assert second.evaluate({1 : 2.0}) == 6.125
+
+def test_literals_skip_the_cache():
+    count = len(expression._cache)
+    assert expression.compile_expression("12.300") == 12.3
+    assert expression.compile_expression("-.5") == -0.5
+    assert len(expression._cache) == count
+    assert "12.300" not in expression._cache
+
+# The cache drops the least recently used expressions once it's full
+def test_cache_eviction(monkeypatch):
+    monkeypatch.setattr(expression, "CACHE_SIZE", 3)
+    monkeypatch.setattr(expression, "_cache", expression._cache.__class__())
+    first = expression.compile_expression("[#1+1]")
+    expression.compile_expression("[#1+2]")
+    expression.compile_expression("[#1+3]")
+    assert expression.compile_expression("[#1+1]") is first
+    expression.compile_expression("[#1+4]")
+    assert list(expression._cache) == ["[#1+3]", "[#1+1]", "[#1+4]"]
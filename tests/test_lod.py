@@ -0,0 +1,134 @@
+# Python G-Code simulator
+#
+# Copyright (C) 2011 Peter Rogers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import absolute_import, division, print_function
+
+import math
+import numpy
+import pytest
+
+from gsim import gcode
+from gsim import lod
+
+# Returns the rows of a table of random lines and arcs, some of them rapids, and
+# the odd dwell
+def make_rows(count=300):
+    rand = numpy.random.RandomState(0)
+    table = gcode.PathTable()
+    pos = numpy.zeros(2)
+    for n in range(count):
+        if (n % 50 == 49):
+            table.add_pause(gcode.PATH_DWELL, pos, 1.0)
+            continue
+        rapid = (n % 7 == 0)
+        if (n % 3 == 0 and not rapid):
+            radius = rand.uniform(0.5, 10)
+            (a, b) = rand.uniform(0, 2*math.pi, 2)
+            center = pos - radius*numpy.array([math.cos(a), math.sin(a)])
+            end = center + radius*numpy.array([math.cos(b), math.sin(b)])
+            table.add_arc(pos, end, center, 10.0, bool(n % 2), True)
+        else:
+            end = pos + rand.uniform(-20, 20, 2)
+            table.add_line(pos, end, 10.0, not rapid, rapid)
+        pos = end
+    return table.array
+
+# Returns the (column, row) of the cell containing each point
+def cell_coords(level, points):
+    return numpy.floor(points/level.cellSize).astype(numpy.int64) - level.origin
+
+# Every path should leave a trail of cells at each level, recorded as covered no
+# later than that path
+@pytest.mark.parametrize("cellSize", [0.5, 4.0, 32.0])
+def test_paths_are_covered(cellSize):
+    rows = make_rows(100)
+    level = lod.build_level(rows, cellSize)
+    assert level.size == len(rows)
+    for n in range(len(rows)):
+        if (rows["kind"][n] not in (gcode.PATH_LINE, gcode.PATH_ARC)):
+            continue
+        rapid = bool(rows["rapid"][n])
+        keys = level.keys[rapid]
+        first = level.first[rapid]
+        (points, row) = lod.sample_paths(rows[n:n+1], numpy.array([500]))
+        cells = cell_coords(level, points)
+        assert (cells >= 0).all() and (cells[:,1] < level.height).all()
+        # The cells at both ends are covered
+        ends = cells[[0, -1],0]*level.height + cells[[0, -1],1]
+        found = numpy.searchsorted(keys, ends)
+        assert (keys[numpy.minimum(found, len(keys)-1)] == ends).all()
+        assert (first[found] <= n).all()
+        # And every point along the way is in (or right next to) a covered cell
+        covered = numpy.zeros(len(cells), dtype=bool)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                (x, y) = (cells[:,0]+dx, cells[:,1]+dy)
+                inside = (y >= 0) & (y < level.height)
+                covered |= inside & numpy.isin(x*level.height + y, keys)
+        assert covered.all()
+
+def test_too_fine():
+    assert lod.build_level(make_rows(), 1e-4) is None
+    level = lod.build_level(make_rows()[:0], 1.0)
+    assert len(level) == 0
+
+# Returns the cells of the level as a set of (x, y, isRapid) tuples
+def as_set(points, isRapid):
+    return set((float(x), float(y), bool(r)) for ((x, y), r) in zip(points, isRapid))
+
+def test_get_cells():
+    rows = make_rows()
+    level = lod.build_level(rows, 2.0)
+    (allPoints, allRapid) = level.get_cells(len(rows), -1e6, -1e6, 1e6, 1e6)
+    assert len(allPoints) == len(numpy.union1d(level.keys[True], level.keys[False]))
+    # Cells covered by cuts are never drawn as rapids
+    assert len(as_set(allPoints, allRapid)) == len(set(map(tuple, allPoints.tolist())))
+
+    rand = numpy.random.RandomState(3)
+    for n in range(30):
+        (xmin, ymin) = rand.uniform(-100, 100, 2)
+        (xmax, ymax) = (xmin, ymin) + rand.uniform(0, 80, 2)
+        (points, isRapid) = level.get_cells(len(rows), xmin, ymin, xmax, ymax)
+        # Cells overlapping the viewport, and only those
+        inside = ((allPoints[:,0]+1 > xmin) & (allPoints[:,0]-1 <= xmax) &
+                  (allPoints[:,1]+1 > ymin) & (allPoints[:,1]-1 <= ymax))
+        assert as_set(points, isRapid) == as_set(allPoints[inside], allRapid[inside])
+
+    # Only the cells reached by the paths before 'stop'
+    stop = len(rows)//3
+    (points, isRapid) = level.get_cells(stop, -1e6, -1e6, 1e6, 1e6)
+    partial = lod.build_level(rows[:stop], 2.0)
+    (expected, expectedRapid) = partial.get_cells(stop, -1e6, -1e6, 1e6, 1e6)
+    assert as_set(points, isRapid) == as_set(expected, expectedRapid)
+
+def test_pyramid():
+    rows = make_rows()
+    pyramid = lod.Pyramid()
+    level = pyramid.get_level(rows, 3.0)
+    # Cell sizes are rounded down to a power of two, and the levels are kept
+    assert level.cellSize == 2.0
+    assert pyramid.get_level(rows, 2.5) is level
+    # Until the table has grown enough
+    grown = numpy.concatenate([rows]*20)
+    assert pyramid.get_level(rows[:len(rows)+100], 2.0) is level
+    assert pyramid.get_level(grown, 2.0).size == len(grown)
+    # Only the most recently used levels are kept
+    for size in (1, 4, 8, 16):
+        pyramid.get_level(rows, size)
+    assert pyramid.get_level(rows, 2.0) is not level
@@ -0,0 +1,107 @@
+# Python G-Code simulator
+#
+# Copyright (C) 2011 Peter Rogers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import absolute_import, division, print_function
+
+import math
+import numpy
+import pytest
+
+from gsim import gcode
+from gsim import motion
+
+PROFILE = motion.MachineProfile(maxVelocity=(100, 100), maxAccel=(1000, 1000))
+
+# Returns the rows of a table of lines through the given points
+def make_rows(points, feedRate=50.0):
+    table = gcode.PathTable()
+    for (start, end) in zip(points[:-1], points[1:]):
+        table.add_line(start, end, feedRate, True, False)
+    return table.array
+
+def test_single_move():
+    # A long move reaches the feed rate: 0.05 s to speed up and to slow down,
+    # covering 1.25 mm each, then 97.5 mm at 50 mm/s
+    rows = make_rows([(0, 0), (100, 0)])
+    (entry, exit, durations) = motion.plan(rows, PROFILE)
+    assert entry[0] == 0 and exit[0] == 0
+    assert durations[0] == pytest.approx(0.1 + 97.5/50.0)
+    # A short one never does (a triangular profile)
+    rows = make_rows([(0, 0), (1, 0)])
+    assert motion.plan_durations(rows, PROFILE)[0] == pytest.approx(2*math.sqrt(2*0.5/1000))
+
+def test_straight_line_keeps_speed():
+    points = [(x, 0) for x in range(101)]
+    (entry, exit, durations) = motion.plan(make_rows(points), PROFILE)
+    assert numpy.allclose(exit[:-1], entry[1:])
+    assert entry[50] == pytest.approx(50)
+    assert durations.sum() == pytest.approx(0.1 + 97.5/50.0)
+
+def test_corner_slows_down():
+    square = motion.plan(make_rows([(0, 0), (50, 0), (50, 50)]), PROFILE)
+    straight = motion.plan(make_rows([(0, 0), (50, 0), (100, 0)]), PROFILE)
+    assert square[1][0] < straight[1][0]
+    assert square[2].sum() > straight[2].sum()
+
+def test_dwell_stops_the_machine():
+    table = gcode.PathTable()
+    table.add_line((0, 0), (50, 0), 50.0, True, False)
+    table.add_pause(gcode.PATH_DWELL, (50, 0), 2.0)
+    table.add_line((50, 0), (100, 0), 50.0, True, False)
+    (entry, exit, durations) = motion.plan(table.array, PROFILE)
+    assert exit[0] == 0 and entry[2] == 0
+    assert durations[1] == 2.0
+
+def test_scale():
+    rows = make_rows([(0, 0), (4, 0)], feedRate=2.0)
+    inches = motion.plan_durations(rows, PROFILE, 25.4)
+    rows["length"] *= 25.4
+    rows["feedRate"] *= 25.4
+    assert inches == pytest.approx(motion.plan_durations(rows, PROFILE))
+
+# Planning a table a batch at a time with plan_batch gives the same result as
+# planning it in one go
+def test_plan_batch():
+    rand = numpy.random.RandomState(3)
+    points = numpy.cumsum(rand.uniform(-0.5, 2.0, (3000, 2)), axis=0)
+    table = gcode.PathTable()
+    for (n, (start, end)) in enumerate(zip(points[:-1], points[1:])):
+        if (n % 700 == 0):
+            table.add_pause(gcode.PATH_DWELL, start, 0.25)
+        table.add_line(start, end, rand.uniform(10, 80), True, False)
+    rows = table.array
+    expected = motion.plan_durations(rows, PROFILE)
+
+    durations = numpy.zeros(len(rows))
+    (start, speed) = (0, 0.0)
+    for stop in list(range(250, len(rows), 250)) + [len(rows)]:
+        (batch, settled, speed) = motion.plan_batch(rows[start:stop], PROFILE, 1.0, speed)
+        durations[start:stop] = batch
+        start += settled
+    assert numpy.allclose(durations, expected)
+
+def test_profile_load(tmpdir):
+    path = str(tmpdir.join("machine.json"))
+    fd = open(path, "w")
+    fd.write('{"maxVelocity": [80, 60], "maxAccel": [800, 600], "cornerTolerance": 0.02}')
+    fd.close()
+    profile = motion.MachineProfile.load(path)
+    assert profile.maxVelocity == (80, 60)
+    assert profile.cornerTolerance == 0.02
+    assert profile.maxJerk is None
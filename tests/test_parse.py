@@ -0,0 +1,97 @@
+# Python G-Code simulator
+#
+# Copyright (C) 2011 Peter Rogers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import absolute_import, division, print_function
+
+import os
+
+from gsim import gcode
+
+# Includes a % block, a comment running over several lines and a few bad lines
+PROGRAM = """%
+(Header
+ G01 X99 Y99
+ spread over a few lines)
+G21
+#1 = 2.5
+#<depth> = [#1*2]
+GXX 1
+G00 X0 Y0
+M3
+%
+G01 X[#1*4] Y#<depth> F600
+G02 X20 Y5 I5 J0
+G01 X[1+ Y2
+G04 P1.5
+%
+T2
+M06
+G01 X0 Y0 (back home)
+M5
+M02
+"""
+
+def write_program(tmpdir, repeat):
+    path = os.path.join(str(tmpdir), "test.ngc")
+    fd = open(path, "w")
+    try:
+        fd.write(PROGRAM*repeat)
+    finally:
+        fd.close()
+    return path
+
+# Returns a plain number as it is, and an expression as its text
+def describe(value):
+    return value if isinstance(value, float) else value.text
+
+# Returns what can be compared of a statement
+def summarize(st):
+    args = st.args
+    if (st.code == "="):
+        args = (args[0], describe(args[1]))
+    params = sorted((key, describe(value)) for (key, value) in st.params.items())
+    return (st.code, args, params, st.lineNumber, st.offset, st.command)
+
+# Parsing in worker processes should give exactly what parsing serially does, even
+# when the chunks end in the middle of a comment or % block
+def test_parallel_matches_serial(tmpdir, monkeypatch):
+    path = write_program(tmpdir, 20)
+    serial = gcode.parse_program(path)
+
+    monkeypatch.setattr(gcode, "PARALLEL_MIN_SIZE", 0)
+    split = gcode._split_chunks
+    bounds = []
+    def split_lines(data, count):
+        # Break at every line
+        chunks = split(data, len(data))
+        bounds.extend(start for (start, end) in chunks)
+        return chunks
+    monkeypatch.setattr(gcode, "_split_chunks", split_lines)
+    parallel = gcode.parse_program(path, workers=2)
+
+    # Check the chunks really did break up the comment and the % block
+    text = open(path, "rb").read()
+    assert text.index(b" spread") in bounds
+    assert text.index(b"M3\n%\n")+3 in bounds
+
+    assert len(parallel.statements) == len(serial.statements) > 0
+    assert ([summarize(st) for st in parallel.statements] ==
+            [summarize(st) for st in serial.statements])
+    assert parallel.invalidLines == serial.invalidLines
+    assert len(serial.invalidLines) == 20*3
@@ -0,0 +1,202 @@
+# Python G-Code simulator
+#
+# Copyright (C) 2011 Peter Rogers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import absolute_import, division, print_function
+
+import math
+import numpy
+import pytest
+
+from gsim import gcode
+from gsim import motion
+
+# Returns a table with a line, a quarter arc each way round, a full circle and
+# a dwell
+def make_table():
+    table = gcode.PathTable()
+    table.add_line((0, 0), (3, 4), 1.0, True, False, 0)
+    table.add_arc((1, 0), (0, 1), (0, 0), 2.0, False, True, 1)
+    table.add_arc((1, 0), (0, 1), (0, 0), 2.0, True, True, 2)
+    table.add_arc((1, 0), (1, 0), (0, 0), 2.0, False, True, 3)
+    table.add_pause(gcode.PATH_DWELL, (1, 0), 1.5, 5)
+    return table
+
+def test_lengths():
+    data = make_table().array
+    expected = [5, math.pi/2, 3*math.pi/2, 2*math.pi, 0]
+    assert numpy.allclose(data["length"], expected)
+
+def test_arc_path_length_matches_table():
+    arc = gcode.Arc(numpy.array([1.0, 0]), numpy.array([0.0, 1]), numpy.array([0.0, 0]),
+                    1.0, clockwise=True)
+    assert arc.length == pytest.approx(3*math.pi/2)
+
+def test_durations():
+    table = make_table()
+    data = table.array
+    expected = [5, math.pi/4, 3*math.pi/4, math.pi, 1.5]
+    assert numpy.allclose(data["duration"], expected)
+    ends = numpy.cumsum(expected)
+    assert numpy.allclose(data["startTime"], ends - expected)
+    assert table.get_end_time() == pytest.approx(ends[-1])
+
+def test_find_time():
+    table = make_table()
+    assert table.find_time(0) == 0
+    assert table.find_time(4.99) == 0
+    assert table.find_time(5) == 1
+    assert table.find_time(5 + math.pi/4 + 0.01) == 2
+    # Past the end gives the last path
+    assert table.find_time(1000) == 4
+    assert gcode.PathTable().find_time(0) == -1
+
+def test_find_statement():
+    table = make_table()
+    assert table.find_statement(0) == 0
+    assert table.find_statement(3) == 3
+    # Statement 4 has no paths, so the next one is found
+    assert table.find_statement(4) == 4
+    assert table.find_statement(6) == 5
+
+def test_indices_count_discarded_rows():
+    table = gcode.PathTable()
+    table.set_offset(10, 0.0, 0.0, 0.0)
+    found = []
+    table.callback = found.append
+    table.add_line((0, 0), (1, 0), 1.0, True, False)
+    table.add_line((1, 0), (2, 0), 1.0, True, False)
+    assert [path.index for path in table] == [10, 11]
+    assert table[1].index == 11
+    assert [path.index for path in found] == [10, 11]
+
+# Adds a long run of short, nearly straight moves with the odd dwell
+def add_moves(table):
+    rand = numpy.random.RandomState(0)
+    pos = (0.0, 0.0)
+    for n in range(2000):
+        if (n % 500 == 250):
+            table.add_pause(gcode.PATH_DWELL, pos, 0.5)
+            continue
+        end = (pos[0] + rand.uniform(0.01, 0.2), pos[1] + rand.uniform(-0.01, 0.01))
+        table.add_line(pos, end, 30.0, True, False)
+        pos = end
+
+# Batches planned one after the other should be timed as if they had been
+# planned all at once
+@pytest.mark.parametrize("keepRows", [True, False])
+def test_planning_across_batches(keepRows):
+    profile = motion.MachineProfile()
+    whole = gcode.PathTable()
+    add_moves(whole)
+    expected = motion.plan_durations(whole.array, profile)
+
+    table = gcode.PathTable()
+    table.profile = profile
+    table.unitScale = 1.0
+    table.CHUNK_SIZE = 100
+    table.keepRows = keepRows
+    found = []
+    table.callback = found.append
+    add_moves(table)
+    table.settle()
+
+    assert [path.index for path in found] == list(range(len(expected)))
+    assert numpy.allclose([path.duration for path in found], expected)
+    assert table.get_end_time() == pytest.approx(expected.sum())
+    if (keepRows):
+        assert numpy.allclose(table.array["duration"], expected)
+
+def test_extents():
+    extents = gcode.path_extents(make_table().array)
+    expected = [
+        [0, 0, 3, 4],
+        # Anticlockwise from 0 to 90 degrees crosses no other quadrants
+        [0, 0, 1, 1],
+        # Clockwise it passes 270 and 180 degrees on the way
+        [-1, -1, 1, 1],
+        [-1, -1, 1, 1],
+        [1, 0, 1, 0],
+    ]
+    assert numpy.allclose(extents, expected)
+
+# The extents of arcs should match those of points taken along them
+def test_arc_extents_match_points():
+    rand = numpy.random.RandomState(0)
+    table = gcode.PathTable()
+    for n in range(200):
+        center = rand.uniform(-5, 5, 2)
+        radius = rand.uniform(0.5, 3)
+        (a, b) = rand.uniform(0, 2*math.pi, 2)
+        start = center + radius*numpy.array([math.cos(a), math.sin(a)])
+        end = center + radius*numpy.array([math.cos(b), math.sin(b)])
+        table.add_arc(start, end, center, 1.0, bool(n % 2), True)
+    data = table.array
+    extents = gcode.path_extents(data)
+    for (row, box) in zip(data, extents):
+        sweep = row["length"]/row["radius"]
+        direction = -1 if (row["clockwise"]) else 1
+        angles = row["angle1"] + direction*numpy.linspace(0, sweep, 2000)
+        points = row["center"] + row["radius"]*numpy.column_stack((numpy.cos(angles), numpy.sin(angles)))
+        assert numpy.allclose(box[:2], points.min(axis=0), atol=1e-5)
+        assert numpy.allclose(box[2:], points.max(axis=0), atol=1e-5)
+
+def test_bounds():
+    table = gcode.PathTable()
+    table.add_line((0, 0), (2, 0), 1.0, False, True, 0)
+    table.add_arc((2, 0), (4, 0), (3, 0), 1.0, True, True, 1, 1)
+    table.add_arc((4, 0), (6, 0), (5, 0), 1.0, False, True, 2, 2)
+    (lo, hi) = table.get_bounds()
+    assert lo.tolist() == [0, -1] and hi.tolist() == [6, 1]
+    (lo, hi) = table.get_bounds(spindleOn=True)
+    assert lo.tolist() == [2, -1] and hi.tolist() == [6, 1]
+    (lo, hi) = table.get_bounds(tool=1)
+    assert lo.tolist() == [2, 0] and hi.tolist() == [4, 1]
+    assert table.get_bounds(tool=5) is None
+    assert table.get_tools() == [0, 1, 2]
+
+# A copy of a growing table (as kept by the render thread) should give the same
+# lookups as a fresh one, while only indexing the rows that are new or retimed
+def test_extend_array():
+    profile = motion.MachineProfile()
+    table = gcode.PathTable()
+    table.profile = profile
+    table.unitScale = 1.0
+    table.CHUNK_SIZE = 100
+    copy = gcode.PathTable()
+    rand = numpy.random.RandomState(1)
+    pos = (0.0, 0.0)
+    for n in range(20):
+        for m in range(150):
+            end = (pos[0] + rand.uniform(0.01, 0.5), pos[1] + rand.uniform(-0.1, 0.1))
+            table.add_line(pos, end, 30.0, True, False, n*150+m)
+            pos = end
+        data = table.array
+        if (n == 0):
+            copy.set_array(data)
+        else:
+            indexed = copy._indexSize
+            copy.extend_array(data)
+            # Most of the index is kept
+            assert copy._indexSize > indexed - copy.INDEX_CHECK*2
+        fresh = gcode.PathTable()
+        fresh.set_array(data.copy())
+        for tm in rand.uniform(0, table.get_end_time(), 20):
+            assert copy.find_time(tm) == fresh.find_time(tm)
+        for line in rand.randint(0, len(data), 20):
+            assert copy.find_statement(line) == fresh.find_statement(line)
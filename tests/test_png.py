@@ -0,0 +1,75 @@
+# Python G-Code simulator
+#
+# Copyright (C) 2011 Peter Rogers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import absolute_import, division, print_function
+
+import io
+import struct
+import zlib
+import numpy
+import pytest
+
+from gsim import png
+
+# Reads back an RGB image written by PNGWriter
+def read_png(data):
+    assert data[:8] == png.PNG_SIGNATURE
+    pos = 8
+    chunks = []
+    while (pos < len(data)):
+        (length,) = struct.unpack(">I", data[pos:pos+4])
+        kind = data[pos+4:pos+8]
+        body = data[pos+8:pos+8+length]
+        (crc,) = struct.unpack(">I", data[pos+8+length:pos+12+length])
+        assert crc == zlib.crc32(kind + body) & 0xffffffff
+        chunks.append((kind, body))
+        pos += 12+length
+    assert chunks[0][0] == b"IHDR" and chunks[-1][0] == b"IEND"
+    (width, height) = struct.unpack(">II", chunks[0][1][:8])
+    # zlib checks the combined Adler-32 checksum
+    raw = zlib.decompress(b"".join(body for (kind, body) in chunks if kind == b"IDAT"))
+    rows = numpy.frombuffer(raw, dtype=numpy.uint8).reshape(height, width*3+1)
+    assert (rows[:,0] == 0).all()
+    return rows[:,1:].reshape(height, width, 3)
+
+@pytest.mark.parametrize("bands", [1, 3, 7])
+def test_round_trip(bands):
+    rand = numpy.random.RandomState(bands)
+    image = rand.randint(0, 256, (50, 31, 3)).astype(numpy.uint8)
+    # Mostly flat, so it compresses
+    image[10:40] = 200
+    fd = io.BytesIO()
+    writer = png.PNGWriter(fd, 31, 50)
+    edges = numpy.linspace(0, 50, bands+1).astype(int)
+    for n in range(bands):
+        last = (n == bands-1)
+        writer.write_band(*png.encode_band(image[edges[n]:edges[n+1]], last), last=last)
+    writer.close()
+    assert numpy.array_equal(read_png(fd.getvalue()), image)
+
+def test_adler32_combine():
+    (a, b) = (b"hello ", b"world" * 1000)
+    combined = png.adler32_combine(zlib.adler32(a), zlib.adler32(b), len(b))
+    assert combined == zlib.adler32(a + b)
+
+def test_close_before_last_band():
+    writer = png.PNGWriter(io.BytesIO(), 1, 2)
+    writer.write_band(*png.encode_band(numpy.zeros((1, 1, 3), dtype=numpy.uint8), False))
+    with pytest.raises(ValueError):
+        writer.close()
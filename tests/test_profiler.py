@@ -0,0 +1,111 @@
+# Python G-Code simulator
+#
+# Copyright (C) 2011 Peter Rogers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import absolute_import, division, print_function
+
+import io
+import os
+import json
+import collections
+
+from gsim import gcode
+from gsim import profiler
+
+PROGRAM = """G21
+#1 = 2
+M3
+G01 X1 Y1 F600
+G01 X[#1] Y0
+G02 X4 Y0 I1 J0
+G04 P0.5
+M5
+G00 X0 Y0
+M02
+"""
+
+def write_program(tmpdir):
+    path = os.path.join(str(tmpdir), "test.ngc")
+    fd = open(path, "w")
+    try:
+        fd.write(PROGRAM)
+    finally:
+        fd.close()
+    return path
+
+def test_wrap_handler():
+    prof = profiler.Profiler()
+    calls = []
+    handler = prof.wrap_handler(lambda state, st: calls.append((state, st)), "G01")
+    handler("state", "st")
+    handler("state", "st")
+    assert calls == [("state", "st")]*2
+    counter = prof.handlers["G01"]
+    assert counter.calls == 2
+    assert counter.time >= 0
+
+def test_attach(tmpdir):
+    path = write_program(tmpdir)
+    prof = profiler.Profiler()
+    prog = gcode.parse_program(path, profiler=prof)
+    state = prog.start()
+    prof.attach(state)
+    state.run()
+
+    # Each handler is counted under its own code
+    expected = collections.Counter(st.code for st in prog.statements)
+    counts = dict((code, counter.calls) for (code, counter) in prof.handlers.items() if counter.calls)
+    assert counts == expected
+    assert prof.phases["parse"].calls == 1
+    assert prof.phases["simulate"].calls == 1
+    assert prof.phases["eval"].calls > 0
+    handlerTime = sum(counter.time for counter in prof.handlers.values())
+    assert handlerTime <= prof.phases["simulate"].time
+
+    # Other states aren't instrumented
+    other = prog.start()
+    other.run()
+    assert prof.phases["simulate"].calls == 1
+    assert sum(counter.calls for counter in prof.handlers.values()) == len(prog.statements)
+
+def test_report(tmpdir):
+    path = write_program(tmpdir)
+    prof = profiler.Profiler()
+    state = gcode.State()
+    prof.attach(state)
+    state.run_stream(path)
+
+    report = prof.report()
+    assert sorted(report["phases"]) == sorted(name for (name, counter) in prof.phases.items() if counter.calls)
+    for (name, data) in report["phases"].items():
+        assert data["calls"] == prof.phases[name].calls
+        assert data["time"] == prof.phases[name].time
+    assert report["phases"]["parse"]["calls"] == len(PROGRAM.splitlines())
+    assert report["phases"]["simulate"]["calls"] == 1
+    assert sum(data["calls"] for data in report["handlers"].values()) == len(PROGRAM.splitlines())
+
+    # The JSON and the table have the same figures
+    fd = io.StringIO()
+    prof.dump(fd)
+    assert json.loads(fd.getvalue())["phases"] == report["phases"]
+    fd = io.StringIO()
+    prof.print_report(fd)
+    lines = fd.getvalue().splitlines()
+    for (name, data) in report["phases"].items():
+        row = [line.split() for line in lines if line.split()[:1] == [name]][0]
+        assert int(row[1]) == data["calls"]
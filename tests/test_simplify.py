@@ -0,0 +1,62 @@
+# Python G-Code simulator
+#
+# Copyright (C) 2011 Peter Rogers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import absolute_import, division, print_function
+
+import numpy
+
+from gsim import gcode
+from gsim import simplify
+
+def test_simplify_rows():
+    table = gcode.PathTable()
+    # A straight run broken into pieces, then a corner
+    for x in range(4):
+        table.add_line((x, 0), (x+1, 0), 1.0, True, False, x)
+    table.add_line((4, 0), (4, 1), 1.0, True, False, 4)
+    # A dwell, which is never merged
+    table.add_pause(gcode.PATH_DWELL, (4, 1), 2.0, 5)
+    # Slightly wobbly, but within the tolerance
+    table.add_line((4, 1), (5, 1.001), 1.0, True, False, 6)
+    table.add_line((5, 1.001), (6, 1), 1.0, True, False, 7)
+    # A different feed rate starts a new line
+    table.add_line((6, 1), (7, 1), 2.0, True, False, 8)
+    rows = table.array
+
+    (result, first) = simplify.simplify_rows(rows, 0.01)
+    assert first.tolist() == [0, 4, 5, 6, 8]
+    assert result["start"].tolist() == [[0, 0], [4, 0], [4, 1], [4, 1], [6, 1]]
+    assert result["end"].tolist() == [[4, 0], [4, 1], [4, 1], [6, 1], [7, 1]]
+    assert result["length"][0] == 4
+    assert numpy.isclose(result["duration"][3], rows["duration"][6:8].sum())
+    assert result["statement"].tolist() == [0, 4, 5, 6, 8]
+
+def test_simplify_keeps_detail_above_tolerance():
+    table = gcode.PathTable()
+    table.add_line((0, 0), (1, 0.1), 1.0, True, False)
+    table.add_line((1, 0.1), (2, 0), 1.0, True, False)
+    (result, first) = simplify.simplify_rows(table.array, 0.01)
+    assert len(result) == 2
+    (result, first) = simplify.simplify_rows(table.array, 0.5)
+    assert len(result) == 1
+
+def test_simplify_empty():
+    (result, first) = simplify.simplify_rows(numpy.zeros(0, dtype=gcode.PATH_DTYPE), 0.1)
+    assert len(result) == 0
+    assert len(first) == 0
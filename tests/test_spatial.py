@@ -0,0 +1,66 @@
+# Python G-Code simulator
+#
+# Copyright (C) 2011 Peter Rogers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import absolute_import, division, print_function
+
+import numpy
+
+from gsim import gcode
+from gsim import spatial
+
+# Checks the index against a brute force search
+def check_queries(extents, rand):
+    index = spatial.GridIndex(extents)
+    assert index.size == len(extents)
+    for n in range(50):
+        (x, y) = rand.uniform(-10, 110, 2)
+        (w, h) = rand.uniform(0, 30, 2)
+        found = index.query(x, y, x+w, y+h)
+        expected = numpy.flatnonzero(spatial.overlaps(extents, x, y, x+w, y+h))
+        assert found.tolist() == expected.tolist()
+
+def test_query():
+    rand = numpy.random.RandomState(1)
+    lo = rand.uniform(0, 100, (500, 2))
+    size = rand.exponential(2, (500, 2))
+    check_queries(numpy.hstack((lo, lo+size)), rand)
+
+def test_query_large_and_degenerate():
+    rand = numpy.random.RandomState(2)
+    lo = rand.uniform(0, 100, (200, 2))
+    extents = numpy.hstack((lo, lo))
+    # A few boxes spanning most of the grid, which are kept out of the cells
+    extents[:5,:2] = 0
+    extents[:5,2:] = 100
+    check_queries(extents, rand)
+
+def test_query_empty():
+    index = spatial.GridIndex(numpy.zeros((0, 4)))
+    assert len(index.query(0, 0, 1, 1)) == 0
+
+def test_distance_to_paths():
+    table = gcode.PathTable()
+    table.add_line((0, 0), (10, 0), 1.0, True, False)
+    table.add_arc((1, 0), (0, 1), (0, 0), 1.0, False, True)
+    table.add_pause(gcode.PATH_DWELL, (5, 5), 1.0)
+    dist = spatial.distance_to_paths(table.array, (2, 2))
+    assert numpy.allclose(dist, [2, numpy.hypot(2, 2)-1, numpy.hypot(3, 3)])
+    # Outside the sweep of the arc the nearer end counts
+    dist = spatial.distance_to_paths(table.array, (0, -2))
+    assert numpy.isclose(dist[1], numpy.hypot(1, 2))
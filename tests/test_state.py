@@ -0,0 +1,229 @@
+# Python G-Code simulator
+#
+# Copyright (C) 2011 Peter Rogers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import absolute_import, division, print_function
+
+import io
+import os
+import numpy
+import pytest
+
+from gsim import gcode
+from gsim import motion
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "examples")
+
+# Returns a program parsed from the given text
+def make_program(text):
+    prog = gcode.Program()
+    prog.statements = list(gcode.iter_statements(io.StringIO(text), prog.invalidLines))
+    return prog
+
+# Returns the text of a program with the given number of moves
+def make_moves(count):
+    lines = ["G21", "M3"]
+    for n in range(count):
+        lines.append("G01 X%d Y%d F600" % (n+1, n%2))
+    return "\n".join(lines) + "\n"
+
+ENDS_EARLY = "G21\nM3\nG01 X1 Y1 F60\nM02\nG01 X50 Y50\n"
+
+def test_run_stops_at_end():
+    state = make_program(ENDS_EARLY).start()
+    state.run()
+    assert state.finished
+    assert len(state.paths) == 1
+    # Running again doesn't carry on past the M02
+    state.run()
+    state.step()
+    assert len(state.paths) == 1
+    assert state.maxPos.tolist() == [1, 1]
+
+def test_ensure_line():
+    state = make_program(make_moves(100)).start()
+    assert state.ensure_line(50)
+    assert state.lineno == 50
+    assert len(state.paths) == 48
+    # Already there
+    assert state.ensure_line(10)
+    assert state.lineno == 50
+    assert not state.ensure_line(1000)
+    assert state.finished
+    assert not state.ensure_line(1001)
+
+def test_ensure_line_stops_at_end():
+    state = make_program(ENDS_EARLY).start()
+    assert not state.ensure_line(5)
+    assert state.finished
+    assert state.lineno == 4
+    assert len(state.paths) == 1
+
+def test_ensure_time():
+    # Each move takes about 0.14 s
+    state = make_program(make_moves(3000)).start()
+    assert state.ensure_time(15.05)
+    assert state.time > 15.05
+    assert not state.finished
+    n = state.paths.find_time(15.05)
+    assert state.paths.array["startTime"][n] <= 15.05
+    assert not state.ensure_time(1e6)
+    assert state.finished
+    count = len(state.paths)
+    assert not state.ensure_time(2e6)
+    assert len(state.paths) == count
+
+def test_ensure_time_stops_at_end():
+    state = make_program(ENDS_EARLY).start()
+    assert not state.ensure_time(100)
+    assert state.finished
+    assert len(state.paths) == 1
+
+# Streaming a file should give the same paths and totals as parsing it first
+@pytest.mark.parametrize("name", ["circle-test.ngc", "output.ngc"])
+@pytest.mark.parametrize("withProfile", [False, True])
+def test_run_stream_matches_run(name, withProfile):
+    path = os.path.join(EXAMPLES, name)
+    profile = motion.MachineProfile() if (withProfile) else None
+    prog = gcode.parse_program(path)
+    prog.profile = profile
+    expected = prog.start()
+    expected.run()
+
+    state = gcode.State(profile=profile)
+    state.run_stream(path)
+    assert len(state.paths) == len(expected.paths) > 0
+    for field in ("kind", "start", "end", "center", "duration", "startTime", "length", "statement"):
+        assert numpy.allclose(state.paths.array[field], expected.paths.array[field])
+    assert state.time == pytest.approx(expected.time)
+    assert state.cutLength == pytest.approx(expected.cutLength)
+    assert state.rapidLength == pytest.approx(expected.rapidLength)
+    assert numpy.allclose(state.bounds, expected.bounds)
+    assert state.lineno == expected.lineno
+
+    # Without keeping the paths, only the totals are left
+    state = gcode.State(profile=profile)
+    state.run_stream(path, keepPaths=False)
+    assert len(state.paths.array) == 0
+    assert state.time == pytest.approx(expected.time)
+    assert state.cutLength == pytest.approx(expected.cutLength)
+    assert numpy.allclose(state.bounds, expected.bounds)
+
+def test_handlers():
+    state = make_program("G21\nG00 X5 Y5\nF300\nT3\nG90\n").start()
+    state.run()
+    assert state.units == "mm"
+    assert state.pos.tolist() == [5, 5]
+    # "F300" and "T3" are handled by the "F" and "T" handlers
+    assert state.feedRate == 300
+    assert state.nextTool == 3
+    assert state.unknownCodes == []
+
+def test_unknown_codes():
+    state = make_program("G99\nM77 P1\nG99\nX1\n").start()
+    state.run()
+    # Each unknown code is only noted once
+    assert state.unknownCodes == ["G99", "M77", "X1"]
+    assert len(state.paths) == 0
+
+def test_register_handler(monkeypatch):
+    calls = []
+    def handle_custom(state, st):
+        calls.append((state, st.code))
+    state = make_program("M77\nG00 X1 Y1\n").start()
+    state.register_handler("M77", handle_custom)
+    # Only the one state is affected
+    assert "M77" not in gcode.HANDLERS
+    other = make_program("M77\n").start()
+    other.run()
+    assert other.unknownCodes == ["M77"]
+    state.run()
+    assert calls == [(state, "M77")]
+    assert state.unknownCodes == []
+
+    # Registering a first letter covers all the codes starting with it
+    monkeypatch.setitem(gcode.HANDLERS, "Q", handle_custom)
+    state = make_program("Q1\nQ22\n").start()
+    state.run()
+    assert calls[1:] == [(state, "Q1"), (state, "Q22")]
+    assert state.unknownCodes == []
+
+def test_bounds():
+    state = make_program("G00 X0 Y0\nM3\nG02 X2 Y0 I1 J0 F60\nM5\nG02 X4 Y0 I1 J0\n").start()
+    state.run()
+    # The top of the first arc is included, the arc made with the spindle off isn't
+    assert state.minPos.tolist() == [0, 0]
+    assert state.maxPos.tolist() == [2, 1]
+    assert state.pos.tolist() == [4, 0]
+
+# Returns the text of a program with moves that depend on variables, which change
+# every so often
+def make_variable_moves(count):
+    lines = ["G21", "M3", "#1 = 0"]
+    for n in range(count):
+        if (n % 700 == 0):
+            lines.append("#<step> = %d" % (n//700 + 1))
+        lines.append("G01 X[#1+%d] Y[#<step>*%d] F600" % (n+1, n%2))
+    return "\n".join(lines) + "\n"
+
+# Returns what should match between a state restored from a keyframe and one that
+# ran from the start
+def summarize(state):
+    return (state.lineno, state.pos.tolist(), state.feedRate, state.spindleOn,
+            state.units, state.variables, len(state.paths) + state.paths._discarded,
+            state.finished)
+
+@pytest.mark.parametrize("withProfile", [False, True])
+def test_state_at(monkeypatch, withProfile):
+    monkeypatch.setattr(gcode, "KEYFRAME_CHECK", 100)
+    monkeypatch.setattr(gcode.State, "keyframeLines", 500)
+    prog = make_program(make_variable_moves(3000))
+    if (withProfile):
+        prog.profile = motion.MachineProfile()
+    full = prog.start()
+    full.run()
+    assert len(prog.keyframes) > 4
+
+    for lineno in (0, 1, 499, 500, 501, 1234, 2999, 3003, 5000):
+        state = prog.state_at(lineno=lineno)
+        assert state.resumed == (lineno >= 500)
+        replay = prog.start()
+        replay.ensure_line(lineno)
+        assert summarize(state) == summarize(replay)
+        # The path timing carries on from the keyframe
+        assert state.cutLength == pytest.approx(replay.cutLength)
+        assert state.time == pytest.approx(replay.time)
+
+    for tm in (0, 10, 123.4, full.time/2, full.time-0.01, full.time+1):
+        state = prog.state_at(time=tm)
+        n = full.paths.find_time(tm)
+        assert state.lineno == full.paths.get_statement_index(n) + 1
+        replay = prog.start()
+        replay.ensure_line(state.lineno)
+        assert summarize(state) == summarize(replay)
+
+# Keyframes share their snapshot of the variables while they don't change
+def test_keyframe_variables(monkeypatch):
+    monkeypatch.setattr(gcode, "KEYFRAME_CHECK", 100)
+    monkeypatch.setattr(gcode.State, "keyframeLines", 100)
+    prog = make_program(make_variable_moves(3000))
+    prog.start().run()
+    snapshots = set(id(frame.variables) for frame in prog.keyframes.frames)
+    assert len(snapshots) == 5
+    for frame in prog.keyframes.frames:
+        assert frame.variables["step"] == (frame.lineno-4)//701 + 1
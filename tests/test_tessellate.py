@@ -0,0 +1,86 @@
+# Python G-Code simulator
+#
+# Copyright (C) 2011 Peter Rogers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import absolute_import, division, print_function
+
+import math
+import numpy
+
+from gsim import gcode
+from gsim import tessellate
+
+# Returns the rows of a table with a line, a quarter arc each way round and a
+# full circle
+def make_rows():
+    table = gcode.PathTable()
+    table.add_line((0, 0), (1, 0), 1.0, True, False)
+    table.add_arc((1, 0), (0, 1), (0, 0), 1.0, False, True)
+    table.add_arc((1, 0), (0, 1), (0, 0), 1.0, True, True)
+    table.add_arc((1, 0), (1, 0), (0, 0), 1.0, False, True)
+    return table.array
+
+def test_arc_sweep():
+    rows = make_rows()[1:]
+    assert numpy.allclose(tessellate.arc_sweep(rows), [math.pi/2, 3*math.pi/2, 2*math.pi])
+
+def test_tessellate_arcs():
+    rows = make_rows()[1:]
+    tolerance = 0.001
+    (points, offsets) = tessellate.tessellate_arcs(rows, tolerance)
+    assert len(offsets) == len(rows)+1
+    for n in range(len(rows)):
+        arc = points[offsets[n]:offsets[n+1]]
+        # The ends match the rows exactly and every point is on the circle
+        assert (arc[0] == rows["start"][n]).all()
+        assert (arc[-1] == rows["end"][n]).all()
+        assert numpy.allclose(numpy.hypot(arc[:,0], arc[:,1]), 1)
+        # The chords stay within the tolerance of the arc
+        mid = (arc[1:] + arc[:-1])/2
+        assert (1 - numpy.hypot(mid[:,0], mid[:,1]) <= tolerance).all()
+    # The quarter arcs go opposite ways round
+    quarter = points[offsets[0]:offsets[1]]
+    assert (quarter[:,0] >= -1e-9).all() and (quarter[:,1] >= -1e-9).all()
+    threeQuarters = points[offsets[1]:offsets[2]]
+    assert (threeQuarters[:,1] < -0.5).any()
+
+def test_tessellation_extend():
+    rows = make_rows()
+    tess = tessellate.Tessellation(0.01)
+    tess.extend(rows[:2])
+    assert tess.get_points(0) is None
+    assert tess.get_points(1) is not None
+    tess.extend(rows)
+    assert tess.size == len(rows)
+    (arcRows, points, offsets) = tess.get_arrays()
+    assert arcRows.tolist() == [1, 2, 3]
+    (expected, expectedOffsets) = tessellate.tessellate_arcs(rows[1:], 0.01)
+    assert numpy.array_equal(points, expected)
+    assert numpy.array_equal(tess.get_points(3), expected[expectedOffsets[2]:])
+
+def test_trace_rows():
+    rows = make_rows()
+    tess = tessellate.Tessellation(0.01)
+    tess.extend(rows)
+    (points, counts) = tessellate.trace_rows(rows, numpy.arange(len(rows)), tess)
+    assert counts[0] == 2
+    assert counts[1:].tolist() == [len(tess.get_points(n)) for n in (1, 2, 3)]
+    (joined, moves) = tessellate.join_polylines(points, counts)
+    # The line runs into the first arc, the other arcs start where it did
+    assert moves.sum() == 3
+    assert len(joined) == len(points) - 1